@@ -0,0 +1,47 @@
+# anchor_logs.py
+"""
+Append new audit rows to the Merkle trees and record a root in log_anchors
+(see models_merkle). Run from cron, or keep it running:
+
+    python anchor_logs.py [--log activity|admin|all] [--every SECONDS]
+
+Each run only hashes rows written since the previous anchor.
+"""
+import argparse
+import time
+
+from models_merkle import LOGS, anchor_log
+
+
+def run(logs: list[str]) -> list:
+    anchors = []
+    for log in logs:
+        t0 = time.monotonic()
+        a = anchor_log(log)
+        if a is None:
+            print(f"  {log}: nothing new")
+        else:
+            anchors.append(a)
+            print(f"[OK] {log}: anchor #{a.id} size={a.tree_size} root={a.root_hash} "
+                  f"({time.monotonic() - t0:.2f}s)")
+    return anchors
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Anchor audit logs with Merkle roots.")
+    parser.add_argument("--log", choices=[*LOGS, "all"], default="all")
+    parser.add_argument("--every", type=float, default=0, help="repeat every N seconds (0: once)")
+    args = parser.parse_args()
+    logs = list(LOGS) if args.log == "all" else [args.log]
+
+    from main import app  # reuse app & db bindings
+    with app.app_context():
+        while True:
+            run(logs)
+            if not args.every:
+                break
+            time.sleep(args.every)
+
+
+if __name__ == "__main__":
+    main()
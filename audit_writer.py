@@ -0,0 +1,250 @@
+# audit_writer.py
+"""
+Group commit for audit appends (ActivityLog / AdminActivityLog).
+
+Request threads hand prepared chain entries (see models_chain.append_batch)
+to one writer thread per process. The writer takes whatever has queued up,
+waits at most AUDIT_FLUSH_MS for more, and appends the lot in a single
+transaction, so concurrent audited requests share one commit/fsync instead
+of paying for one each. Entries are written in submission order, so each
+chain is extended in the order its events happened; hashes are computed
+by the writer against the chain head it reads under the write lock.
+
+    append(entry, durable=True)   wait until the batch holding it committed
+    append(entry, durable=False)  fire and forget; returns immediately
+
+Fire-and-forget events still queued when a process dies are lost; use it
+only for events you could afford to miss. AUDIT_GROUP_COMMIT=0 turns the
+queue off (every append commits on its own, in the caller's thread).
+
+Events that must never be lost are staged instead (stage_activity /
+stage_admin_activity): an audit_outbox row added to the caller's own
+transaction, so the change and its audit record commit together, in one
+fsync. After such a commit the writer is kicked and moves the staged rows
+into their chains (models_chain.drain_outbox); it also polls the outbox
+every AUDIT_OUTBOX_POLL_SECONDS, which picks up rows left behind by a
+crashed process.
+"""
+import atexit
+import logging
+import os
+import queue
+import threading
+import time
+
+from flask import current_app, has_app_context
+from sqlalchemy import event
+from sqlalchemy.orm import Session
+
+from db import db, has_pending_writes
+from models_chain import AuditOutbox, append_batch, append_to_chain, drain_outbox, OUTBOX_BATCH
+
+ENABLED = os.getenv("AUDIT_GROUP_COMMIT", "1") != "0"
+FLUSH_MS = float(os.getenv("AUDIT_FLUSH_MS", "2"))
+BATCH_MAX = int(os.getenv("AUDIT_BATCH_MAX", "256"))
+OUTBOX_POLL_SECONDS = float(os.getenv("AUDIT_OUTBOX_POLL_SECONDS", "1"))
+DURABLE_TIMEOUT_SECONDS = 30
+
+_STAGED = "audit_outbox_staged"   # Session.info flag set by mark_staged()
+
+log = logging.getLogger(__name__)
+
+
+class _Pending:
+    __slots__ = ("entry", "done", "row", "error")
+
+    def __init__(self, entry, durable: bool):
+        self.entry = entry
+        self.done = threading.Event() if durable else None
+        self.row = None
+        self.error = None
+
+
+class AuditWriter:
+    """Background thread that writes queued chain entries in batches."""
+
+    _STOP = object()
+    _KICK = object()
+
+    def __init__(self, app):
+        self.app = app
+        self.queue: queue.SimpleQueue = queue.SimpleQueue()
+        self.batches = 0
+        self.written = 0
+        self.drained = 0
+        self._poisoned: set[int] = set()   # outbox ids that failed to chain on their own
+        self.thread = threading.Thread(target=self._run, name="audit-writer", daemon=True)
+        self.thread.start()
+
+    def submit(self, entry, durable: bool = True):
+        p = _Pending(entry, durable)
+        self.queue.put(p)
+        if not durable:
+            return None
+        if not p.done.wait(DURABLE_TIMEOUT_SECONDS):
+            raise TimeoutError("audit writer did not commit in time")
+        if p.error is not None:
+            raise p.error
+        return p.row
+
+    def kick(self):
+        """Drain the outbox soon (after a commit that staged events)."""
+        self.queue.put(self._KICK)
+
+    def stop(self, timeout: float = 5.0):
+        """Write out what is queued, then end the thread."""
+        self.queue.put(self._STOP)
+        self.thread.join(timeout)
+
+    def _collect(self) -> tuple[list[_Pending], bool, bool]:
+        """(queued appends, drain the outbox?, stopping?)"""
+        try:
+            first = self.queue.get(timeout=OUTBOX_POLL_SECONDS)
+        except queue.Empty:
+            return [], True, False
+        if first is self._STOP:
+            return [], True, True
+        drain = first is self._KICK
+        batch = [] if drain else [first]
+        deadline = time.monotonic() + FLUSH_MS / 1000.0
+        while len(batch) < BATCH_MAX:
+            try:
+                p = self.queue.get_nowait()
+            except queue.Empty:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+                try:
+                    p = self.queue.get(timeout=remaining)
+                except queue.Empty:
+                    break
+            if p is self._STOP:
+                return batch, True, True
+            if p is self._KICK:
+                drain = True
+            else:
+                batch.append(p)
+        return batch, drain, False
+
+    def _run(self):
+        stopping = False
+        while not stopping:
+            batch, drain, stopping = self._collect()
+            try:
+                if batch:
+                    self._write(batch)
+                if drain:
+                    self._drain()
+            except Exception:   # keep the thread alive whatever happens
+                log.exception("audit writer loop")
+
+    def _drain(self):
+        with self.app.app_context():
+            while True:
+                try:
+                    n = drain_outbox(skip=self._poisoned)
+                except Exception:
+                    log.exception("outbox drain failed; retrying rows one by one")
+                    n = self._drain_one_by_one()
+                self.drained += n
+                if n < OUTBOX_BATCH:
+                    return
+
+    def _drain_one_by_one(self) -> int:
+        moved = 0
+        while True:
+            try:
+                n = drain_outbox(limit=1, skip=self._poisoned)
+            except Exception:
+                bad = db.session.execute(
+                    db.select(AuditOutbox.id).where(AuditOutbox.id.not_in(self._poisoned))
+                    .order_by(AuditOutbox.id).limit(1)
+                ).scalar()
+                db.session.rollback()
+                if bad is None:
+                    return moved
+                log.exception("outbox row %s can't be chained; leaving it for an operator", bad)
+                self._poisoned.add(bad)
+                continue
+            if n == 0:
+                return moved
+            moved += n
+
+    def _write(self, batch: list[_Pending]):
+        with self.app.app_context():
+            db.session().expire_on_commit = False   # rows go back to other threads
+            try:
+                for p, row in zip(batch, append_batch([p.entry for p in batch])):
+                    p.row = row
+            except Exception:
+                db.session.rollback()
+                log.exception("audit batch of %d failed; retrying entries one by one", len(batch))
+                for p in batch:   # one bad entry must not sink the others
+                    try:
+                        p.row = append_to_chain(*p.entry)
+                    except Exception as e:
+                        db.session.rollback()
+                        p.error = e
+                        if p.done is None:
+                            log.exception("fire-and-forget audit entry lost: %s", p.entry[:2])
+            finally:
+                db.session.expunge_all()
+                self.batches += 1
+                self.written += sum(1 for p in batch if p.error is None)
+                for p in batch:
+                    if p.done is not None:
+                        p.done.set()
+
+
+_writer: AuditWriter | None = None
+_writer_pid: int | None = None
+_writer_lock = threading.Lock()
+
+
+def get_writer() -> AuditWriter:
+    """This process's writer, started on first use (and again after a fork)."""
+    global _writer, _writer_pid
+    pid = os.getpid()
+    if _writer is None or _writer_pid != pid:
+        with _writer_lock:
+            if _writer is None or _writer_pid != pid:
+                _writer = AuditWriter(current_app._get_current_object())
+                _writer_pid = pid
+    return _writer
+
+
+@atexit.register
+def _flush_on_exit():
+    if _writer is not None and _writer_pid == os.getpid():
+        _writer.stop()
+
+
+def mark_staged(session):
+    """Called by stage_* after adding an outbox row to the session."""
+    session.info[_STAGED] = True
+
+
+@event.listens_for(Session, "after_commit")
+def _kick_after_commit(session):
+    if session.info.pop(_STAGED, False) and has_app_context():
+        get_writer().kick()
+
+
+@event.listens_for(Session, "after_rollback")
+def _forget_staged(session):
+    session.info.pop(_STAGED, None)
+
+
+def append(entry, durable: bool = True):
+    """
+    Append one prepared chain entry. Returns the row (detached, loaded) for
+    durable appends, None for fire-and-forget ones.
+
+    Falls back to a direct append in the calling thread when group commit
+    is off, outside an app context, or when the caller's session still has
+    uncommitted writes: those are committed together with the audit row, as
+    before, and waiting on the writer would deadlock on the caller's lock.
+    """
+    if not ENABLED or not has_app_context() or has_pending_writes(db.session()):
+        return append_to_chain(*entry)
+    return get_writer().submit(entry, durable)
@@ -1,16 +1,30 @@
 # admin_audit.py
-from datetime import datetime
+from datetime import datetime, timedelta
 from io import BytesIO, StringIO
-import json, csv
+import json, csv, queue, threading, time
 
-from flask import Blueprint, request, jsonify, send_file, Response
+from flask import Blueprint, request, jsonify, send_file, Response, current_app, url_for
 
 from db import db
-from auth import require_role, UserModel
-from models_admin import AdminActivityLog  # note: verify_admin_chain removed
+from auth import require_role, UserModel, email_matches
+import limiter
+from principals import Principal
+from models_admin import AdminActivityLog, decrypt_admin_rows, verify_admin_chain
+from models_merkle import LOGS, LogAnchor, get_anchor, inclusion_proof, consistency_proof
+from models_chain import CHAIN_ADMIN, VerifyJob, update_verify_job
 
 admin_audit_bp = Blueprint("admin_audit", __name__)
 
+VERIFY_JOB_PROGRESS_SECONDS = 1.0   # how often a job writes its progress
+VERIFY_JOB_STALE_SECONDS = 60       # a running job silent this long is presumed dead
+VERIFY_STREAMS_PER_CHAIN = 1        # concurrent ?stream=1 runs over one chain, per worker
+
+_streams: dict[int, int] = {}       # admin_id -> live verify-stream threads
+_streams_lock = threading.Lock()
+
+class _StreamClosed(Exception):
+    """The client went away mid-stream."""
+
 def _parse_dt(s: str | None):
     if not s:
         return None
@@ -21,14 +35,14 @@ def _parse_dt(s: str | None):
     except Exception:
         return None
 
-def _build_query(current_admin: UserModel, args):
+def _build_query(current_admin: Principal, args):
     q = AdminActivityLog.query
 
     admin_id = args.get("admin_id", type=int)
     email = (args.get("email") or "").strip().lower()
 
     if email:
-        target_admin = UserModel.query.filter(UserModel.email.ilike(email)).first()
+        target_admin = UserModel.query.filter(email_matches(email)).first()
         if not target_admin:
             return q.filter(db.text("1=0"))
         q = q.filter(AdminActivityLog.admin_id == target_admin.id)
@@ -83,13 +97,13 @@ def _row_to_dict(r: AdminActivityLog):
 
 @admin_audit_bp.route("/admin/activity", methods=["GET"])
 @require_role("admin")
-def list_admin_activity(current_admin: UserModel):
+def list_admin_activity(current_admin: Principal):
     q = _build_query(current_admin, request.args)
 
     # CSV export
     if (request.args.get('format') or '').lower() == 'csv':
         MAX_EXPORT = 5000
-        rows = q.limit(MAX_EXPORT).all()
+        rows = decrypt_admin_rows(q.limit(MAX_EXPORT).all())
         buf = StringIO()
         writer = csv.writer(buf)
         writer.writerow(['id','admin_id','ts','action','target_type','target_id','meta_json','justification','prev_hash','row_hash'])
@@ -109,7 +123,7 @@ def list_admin_activity(current_admin: UserModel):
     limit = min(request.args.get("limit", default=50, type=int) or 50, 500)
     offset = request.args.get("offset", default=0, type=int) or 0
     total = q.count()
-    rows = q.limit(limit).offset(offset).all()
+    rows = decrypt_admin_rows(q.limit(limit).offset(offset).all())
 
     return jsonify({
         "items": [_row_to_dict(r) for r in rows],
@@ -118,11 +132,191 @@ def list_admin_activity(current_admin: UserModel):
         "offset": offset,
     })
 
-# NOTE: verify-chain endpoint removed.
+# ---------- Chain verification (resumes from the stored checkpoint) ----------
+def _flag(name: str) -> bool:
+    return (request.args.get(name) or "").lower() in ("1", "true", "yes")
+
+def _progress_event(p: dict) -> dict:
+    return {"event": "progress", **p, "rows_per_sec": round(p["rows_per_sec"], 1)}
+
+def _stream_verify(admin_id: int, full: bool) -> Response:
+    """
+    NDJSON: one "progress" line per verified batch, then one "result" (or
+    "error") line. The worker stops at the next batch once the response is
+    closed, and a chain that is already being streamed answers 429.
+    """
+    with _streams_lock:
+        if _streams.get(admin_id, 0) >= VERIFY_STREAMS_PER_CHAIN:
+            resp = jsonify({"message": "This chain is already being verified; retry later or use ?async=1"})
+            resp.status_code = 429
+            resp.headers["Retry-After"] = "5"
+            return resp
+        _streams[admin_id] = _streams.get(admin_id, 0) + 1
+
+    app = current_app._get_current_object()
+    events = queue.SimpleQueue()
+    closed = threading.Event()
+
+    def progress(p):
+        if closed.is_set():
+            raise _StreamClosed
+        events.put(_progress_event(p))
+
+    def work():
+        with app.app_context():
+            try:
+                ok, info = verify_admin_chain(admin_id, full=full, progress=progress)
+                events.put({"event": "result", "ok": ok, **info})
+            except _StreamClosed:
+                pass
+            except Exception as e:
+                app.logger.exception("verify-chain stream for admin %s failed", admin_id)
+                events.put({"event": "error", "message": f"{type(e).__name__}: {e}"})
+            finally:
+                events.put(None)
+                with _streams_lock:
+                    _streams[admin_id] -= 1
+                    if not _streams[admin_id]:
+                        del _streams[admin_id]
+
+    # verify on its own thread so each batch is sent as soon as it's checked
+    threading.Thread(target=work, name=f"verify-stream-{admin_id}", daemon=True).start()
+
+    def lines():
+        while (ev := events.get()) is not None:
+            yield json.dumps(ev, default=str) + "\n"
+
+    resp = Response(lines(), mimetype="application/x-ndjson",
+                    headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"})
+    resp.call_on_close(closed.set)
+    return resp
+
+def _run_verify_job(app, job_id: int, admin_id: int, full: bool):
+    last_write = 0.0
+
+    def progress(p):
+        nonlocal last_write
+        now = time.monotonic()
+        if now - last_write >= VERIFY_JOB_PROGRESS_SECONDS:
+            last_write = now
+            update_verify_job(job_id, checked=p["checked"], count=p["count"],
+                              rows_per_sec=round(p["rows_per_sec"], 1))
+
+    with app.app_context():
+        update_verify_job(job_id, status="running")
+        try:
+            ok, info = verify_admin_chain(admin_id, full=full, progress=progress)
+        except Exception as e:
+            app.logger.exception("verify job %s failed", job_id)
+            update_verify_job(job_id, status="error", result={"message": f"{type(e).__name__}: {e}"})
+            return
+        update_verify_job(job_id, status="done", count=info.get("count", 0),
+                          checked=info.get("checked", info.get("count", 0)), result={"ok": ok, **info})
+
+def _start_verify_job(current_admin: Principal, admin_id: int, full: bool) -> VerifyJob:
+    """A live job for the same chain is reused instead of starting a second one."""
+    fresh = datetime.utcnow() - timedelta(seconds=VERIFY_JOB_STALE_SECONDS)
+    job = (VerifyJob.query
+           .filter(VerifyJob.chain_type == CHAIN_ADMIN, VerifyJob.owner_id == admin_id,
+                   VerifyJob.full == full, VerifyJob.status.in_(("queued", "running")),
+                   VerifyJob.updated_at >= fresh)
+           .order_by(VerifyJob.id.desc()).first())
+    if job:
+        return job
+    job = VerifyJob(chain_type=CHAIN_ADMIN, owner_id=admin_id, full=full, requested_by=current_admin.id)
+    db.session.add(job)
+    db.session.commit()
+    threading.Thread(target=_run_verify_job, args=(current_app._get_current_object(), job.id, admin_id, full),
+                     name=f"verify-job-{job.id}", daemon=True).start()
+    return job
+
+@admin_audit_bp.route("/admin/activity/verify-chain", methods=["GET"])
+@require_role("admin")
+def verify_admin_activity_chain(current_admin: Principal):
+    """
+    Verify an admin's chain (?admin_id=, default: the caller's own) from its
+    checkpoint, or from genesis with ?full=1. Plain GET answers JSON
+    {ok, count, ...} (reason/id on a break); ?stream=1 streams NDJSON
+    progress; ?async=1 runs it as a job and answers 202 with a status URL.
+    """
+    admin_id = request.args.get("admin_id", type=int) or current_admin.id
+    full = _flag("full")
+
+    if _flag("async"):
+        job = _start_verify_job(current_admin, admin_id, full)
+        status_url = url_for("admin_audit.verify_job_status", job_id=job.id)
+        resp = jsonify({**job.to_dict(), "status_url": status_url})
+        resp.status_code = 202
+        resp.headers["Location"] = status_url
+        return resp
+    if _flag("stream"):
+        return _stream_verify(admin_id, full)
+
+    ok, info = verify_admin_chain(admin_id, full=full)
+    return jsonify({"ok": ok, **info})
+
+@admin_audit_bp.route("/admin/activity/verify-chain/jobs/<int:job_id>", methods=["GET"])
+@require_role("admin")
+def verify_job_status(current_admin: Principal, job_id: int):
+    job = db.session.get(VerifyJob, job_id)
+    if not job or job.chain_type != CHAIN_ADMIN:
+        return jsonify({"message": "Job not found"}), 404
+    return jsonify(job.to_dict())
+
+# ---------- Merkle anchors / proofs (see models_merkle) ----------
+@admin_audit_bp.route("/admin/activity/<int:row_id>/proof", methods=["GET"])
+@require_role("admin")
+def admin_activity_proof(current_admin: Principal, row_id: int):
+    r = db.session.get(AdminActivityLog, row_id)
+    if not r:
+        return jsonify({"message": "Row not found"}), 404
+
+    anchor = get_anchor(CHAIN_ADMIN, request.args.get("anchor_id", type=int))
+    proof = inclusion_proof(CHAIN_ADMIN, r.id, anchor) if anchor else None
+    if not proof:
+        return jsonify({"message": "Not anchored yet"}), 409
+
+    decrypt_admin_rows([r])
+    row = _row_to_dict(r)
+    row.update(payload_digest=r.payload_digest, hash_v=r.hash_v)
+    return jsonify({"row": row, "proof": proof, "anchor": anchor.to_dict()})
+
+@admin_audit_bp.route("/admin/limits", methods=["GET"])
+@require_role("admin")
+def limiter_state(current_admin: Principal):
+    """Rate-limit configuration and the fullest counters (?top=, default 20)."""
+    top = min(request.args.get("top", default=20, type=int) or 20, 500)
+    return jsonify(limiter.state(top))
+
+
+@admin_audit_bp.route("/admin/anchors", methods=["GET"])
+@require_role("admin")
+def list_anchors(current_admin: Principal):
+    log = (request.args.get("log") or "").strip()
+    limit = min(request.args.get("limit", default=50, type=int) or 50, 500)
+    q = LogAnchor.query
+    if log:
+        q = q.filter(LogAnchor.log_type == log)
+    rows = q.order_by(LogAnchor.id.desc()).limit(limit).all()
+    return jsonify({"items": [a.to_dict() for a in rows]})
+
+@admin_audit_bp.route("/admin/anchors/consistency", methods=["GET"])
+@require_role("admin")
+def anchor_consistency(current_admin: Principal):
+    log = (request.args.get("log") or CHAIN_ADMIN).strip()
+    if log not in LOGS:
+        return jsonify({"message": f"Unknown log '{log}'"}), 400
+    first = get_anchor(log, request.args.get("from", type=int))
+    second = get_anchor(log, request.args.get("to", type=int))
+    if not first or not second:
+        return jsonify({"message": "Anchor not found"}), 404
+    if first.tree_size > second.tree_size:
+        return jsonify({"message": "'from' must not be newer than 'to'"}), 400
+    return jsonify(consistency_proof(log, first, second))
 
 @admin_audit_bp.route("/admin/activity/export", methods=["POST"])
 @require_role("admin")
-def export_admin_activity(current_admin: UserModel):
+def export_admin_activity(current_admin: Principal):
     body = request.get_json(silent=True) or {}
     filters = body.get("filters") or {}
     admin_id = body.get("admin_id")
@@ -136,7 +330,7 @@ def export_admin_activity(current_admin: UserModel):
         args_like["admin_id"] = str(admin_id)
 
     q = _build_query(current_admin, args_like)
-    rows = q.order_by(AdminActivityLog.id.asc()).all()
+    rows = decrypt_admin_rows(q.order_by(AdminActivityLog.id.asc()).all())
 
     payload = [_row_to_dict(r) for r in rows]
     buf = BytesIO()
@@ -1,12 +1,20 @@
 # auth.py
 from flask import Blueprint, request, jsonify, current_app, make_response
 from functools import wraps
-import bcrypt, pyotp, jwt, datetime, secrets, hashlib
-from sqlalchemy import func, func as sa_func
-
-from db import db
-from models_admin import append_admin_activity  # only what we use
-from models_privacy import append_activity      # NEW: log user self-actions
+import bcrypt, pyotp, jwt, datetime, secrets, hashlib, hmac, base64
+from sqlalchemy import func, func as sa_func, and_, or_
+from sqlalchemy.orm import validates
+
+from db import db, begin_immediate
+import passwords
+import principals
+from passwords import PasswordHasherBusy
+from principals import Principal
+from token_cache import verified_tokens
+from limiter import (account_limited, otp_limited, user_bcrypt_limited,
+                     COST_BCRYPT, COST_OTP_SEND, COST_OTP_CHECK)
+from models_admin import append_admin_activity, stage_admin_activity  # only what we use
+from models_privacy import stage_activity       # NEW: log user self-actions
 
 auth_bp = Blueprint('auth', __name__)
 
@@ -15,6 +23,7 @@ OTP_VALIDITY_SECONDS = 300
 RESEND_COOLDOWN_SECONDS = 30
 JWT_EXP_MIN = 15
 REFRESH_EXP_DAYS = 14
+REFRESH_GRACE_SECONDS = 10   # a just-rotated token still yields its successor (parallel tabs)
 
 # ---- Models ----
 class UserModel(db.Model):
@@ -25,14 +34,23 @@ class UserModel(db.Model):
     otp_secret  = db.Column(db.String(32), nullable=False)
     last_otp_at = db.Column(db.DateTime, nullable=True)
     role        = db.Column(db.String(16), nullable=False, default='user')  # 'user' | 'admin'
+    email_norm  = db.Column(db.String(120), nullable=True)  # normalize_email(email); lookups go here
+
+    __table_args__ = (db.Index('ux_users_email_norm', 'email_norm', unique=True),)
+
+    @validates('email')
+    def _set_email_norm(self, key, value):
+        self.email_norm = normalize_email(value)
+        return value
 
 class RefreshToken(db.Model):
     __tablename__ = 'refresh_tokens'
     id                = db.Column(db.Integer, primary_key=True)
     user_id           = db.Column(db.Integer, db.ForeignKey('users.id'), index=True, nullable=False)
     token_hash        = db.Column(db.String(128), unique=True, nullable=False)
-    expires_at        = db.Column(db.DateTime, nullable=False)
+    expires_at        = db.Column(db.DateTime, nullable=False, index=True)
     revoked           = db.Column(db.Boolean, default=False, nullable=False)
+    revoked_at        = db.Column(db.DateTime, nullable=True, index=True)  # refresh_purge.py keys on it
     created_at        = db.Column(db.DateTime, default=datetime.datetime.utcnow, nullable=False)
     replaced_by_token = db.Column(db.String(128), nullable=True)
     user              = db.relationship('UserModel', backref='refresh_tokens')
@@ -41,6 +59,15 @@ class RefreshToken(db.Model):
 def normalize_email(e: str) -> str:
     return (e or '').strip().lower()
 
+def email_matches(email: str):
+    """
+    Filter for the user with this (normalized) email: an index lookup on
+    email_norm, plus a second one for rows migrate_email_norm.py hasn't
+    backfilled yet (email_norm IS NULL).
+    """
+    return or_(UserModel.email_norm == email,
+               and_(UserModel.email_norm.is_(None), func.lower(UserModel.email) == email))
+
 def _create_access_jwt(user_id: int) -> str:
     payload = {
         "user_id": user_id,
@@ -63,12 +90,50 @@ def _mint_refresh(user_id: int) -> tuple[str, 'RefreshToken']:
     db.session.commit()
     return raw, rt
 
-def _rotate_refresh(old_rt: 'RefreshToken') -> str:
-    new_raw, new_rt = _mint_refresh(old_rt.user_id)
-    old_rt.revoked = True
-    old_rt.replaced_by_token = new_rt.token_hash
-    db.session.commit()
-    return new_raw
+def _successor_refresh(raw: str) -> str:
+    """The token that replaces raw on rotation: HMAC(SECRET_KEY, raw), so only the server can derive it."""
+    mac = hmac.new(current_app.config['SECRET_KEY'].encode('utf-8'),
+                   b'refresh-successor:' + raw.encode('utf-8'), hashlib.sha256).digest()
+    return base64.urlsafe_b64encode(mac).rstrip(b'=').decode('ascii')
+
+def _rotate_refresh(old_rt: 'RefreshToken', raw: str) -> str | None:
+    """
+    Revoke old_rt and insert its successor in one transaction. Tabs that
+    refresh with the same cookie at once all derive the same successor, so
+    the ones that lose the race (or come within REFRESH_GRACE_SECONDS of
+    the rotation) get it back instead of a 401. None: not rotatable.
+    """
+    new_raw = _successor_refresh(raw)
+    new_hash = _hash_refresh(new_raw)
+    now = datetime.datetime.utcnow()
+    if not old_rt.revoked:
+        t = RefreshToken.__table__
+        begin_immediate(db.session)
+        try:
+            won = db.session.execute(
+                t.update().where(t.c.id == old_rt.id, t.c.revoked == False)  # noqa: E712
+                .values(revoked=True, revoked_at=now, replaced_by_token=new_hash)
+            ).rowcount
+            if won:
+                db.session.add(RefreshToken(
+                    user_id=old_rt.user_id,
+                    token_hash=new_hash,
+                    expires_at=now + datetime.timedelta(days=REFRESH_EXP_DAYS),
+                ))
+            db.session.commit()
+        except Exception:
+            db.session.rollback()
+            raise
+        if won:
+            return new_raw
+        db.session.refresh(old_rt)   # lost the race: read what the winner wrote
+    if (old_rt.replaced_by_token == new_hash and old_rt.revoked_at is not None
+            and now - old_rt.revoked_at <= datetime.timedelta(seconds=REFRESH_GRACE_SECONDS)):
+        # only while the successor itself is live (logout / password change revoke it)
+        successor = RefreshToken.query.filter_by(token_hash=new_hash).first()
+        if successor and not successor.revoked and successor.expires_at > now:
+            return new_raw
+    return None
 
 def _set_refresh_cookie(resp, raw_refresh: str):
     resp.set_cookie(
@@ -84,8 +149,36 @@ def _set_refresh_cookie(resp, raw_refresh: str):
 def _clear_refresh_cookie(resp):
     resp.delete_cookie('refresh_token', path='/')
 
+def _rehash_password(app, user_id: int, password: str, old_hash: bytes):
+    """Runs on the bcrypt pool: store a hash at the current cost, unless the password changed meanwhile."""
+    new_hash = bcrypt.hashpw(password.encode('utf-8'), passwords.gensalt())
+    with app.app_context():
+        with db.engine.begin() as conn:
+            conn.execute(
+                db.update(UserModel)
+                .where(UserModel.id == user_id, UserModel.password == old_hash)
+                .values(password=new_hash)
+            )
+
+def _maybe_upgrade_hash(user: 'UserModel', password: str):
+    """After a successful check: re-hash an outdated-cost hash in the background (best effort)."""
+    if passwords.needs_rehash(user.password):
+        passwords.run_later(_rehash_password, current_app._get_current_object(),
+                            user.id, password, user.password)
+
+def _load_principal(user_id) -> Principal | None:
+    row = db.session.execute(
+        db.select(UserModel.id, UserModel.email, UserModel.role).where(UserModel.id == user_id)
+    ).first()
+    return Principal(*row) if row else None
+
+def _user_row(principal: Principal) -> 'UserModel | None':
+    """The full row, for the few routes that need the password hash or change the user."""
+    return db.session.get(UserModel, principal.id)
+
 # ---- Auth decorators ----
 def require_auth(fn):
+    """Passes the caller as a Principal (id, email, role), served from principals' cache."""
     @wraps(fn)
     def wrapper(*args, **kwargs):
         auth_header = request.headers.get('Authorization', '')
@@ -93,8 +186,8 @@ def require_auth(fn):
             return jsonify({"message": "Missing token"}), 401
         token = auth_header.split(' ', 1)[1].strip()
         try:
-            data = jwt.decode(token, current_app.config['SECRET_KEY'], algorithms=["HS256"])
-            user = UserModel.query.get(data.get('user_id'))
+            data = verified_tokens.decode(token, current_app.config['SECRET_KEY'])
+            user = principals.get_principal(data.get('user_id'), _load_principal)
             if not user:
                 return jsonify({"message": "User not found"}), 401
         except jwt.ExpiredSignatureError:
@@ -107,15 +200,24 @@ def require_auth(fn):
 def require_role(*roles):
     def decorator(fn):
         @wraps(fn)
-        def wrapper(user: UserModel, *args, **kwargs):
+        def wrapper(user: Principal, *args, **kwargs):
             if user.role not in roles:
                 return jsonify({"message": "Forbidden: insufficient role"}), 403
             return fn(user, *args, **kwargs)
         return require_auth(wrapper)
     return decorator
 
+# ---- Overload: bcrypt pool saturated (see passwords.py) ----
+@auth_bp.app_errorhandler(PasswordHasherBusy)
+def password_hasher_busy(e: PasswordHasherBusy):
+    resp = jsonify({"message": "Server is busy, please retry shortly"})
+    resp.status_code = 503
+    resp.headers['Retry-After'] = str(e.retry_after)
+    return resp
+
 # ---- User Routes ----
 @auth_bp.route('/register', methods=['POST'])
+@account_limited(COST_BCRYPT)
 def register():
     data = request.get_json() or {}
     email = normalize_email(data.get('email'))
@@ -125,7 +227,7 @@ def register():
         return jsonify({"message": "Invalid role"}), 400
     if not email or not password:
         return jsonify({"message": "Email and password required"}), 400
-    if UserModel.query.filter(func.lower(UserModel.email) == email).first():
+    if UserModel.query.filter(email_matches(email)).first():
         return jsonify({"message": "User already exists"}), 400
     if role == 'admin':
         invite = (data.get('admin_code') or '').strip()
@@ -134,7 +236,7 @@ def register():
             return jsonify({"message": "Admin registration is disabled"}), 403
         if invite != server_code:
             return jsonify({"message": "Invalid admin invite code"}), 403
-    hashed_pw = bcrypt.hashpw(password.encode('utf-8'), bcrypt.gensalt())
+    hashed_pw = passwords.hash_password(password)
     otp_secret = pyotp.random_base32()
     new_user = UserModel(email=email, password=hashed_pw, otp_secret=otp_secret, role=role)
     db.session.add(new_user)
@@ -143,13 +245,15 @@ def register():
     return jsonify({"message": "User registered successfully", "role": role}), 200
 
 @auth_bp.route('/login', methods=['POST'])
+@account_limited(COST_BCRYPT)
 def login():
     data = request.get_json() or {}
     email = normalize_email(data.get('email'))
     password = (data.get('password') or '').strip()
-    user = UserModel.query.filter(func.lower(UserModel.email) == email).first()
-    if not user or not bcrypt.checkpw(password.encode('utf-8'), user.password):
+    user = UserModel.query.filter(email_matches(email)).first()
+    if not user or not passwords.check_password(password, user.password):
         return jsonify({"message": "Invalid credentials"}), 401
+    _maybe_upgrade_hash(user, password)
     totp = pyotp.TOTP(user.otp_secret, interval=OTP_VALIDITY_SECONDS)
     otp = totp.now()
     user.last_otp_at = datetime.datetime.utcnow()
@@ -158,10 +262,11 @@ def login():
     return jsonify({"message": "OTP sent to user", "email": email}), 200
 
 @auth_bp.route('/resend-otp', methods=['POST'])
+@account_limited(COST_OTP_SEND)
 def resend_otp():
     data = request.get_json() or {}
     email = normalize_email(data.get('email'))
-    user = UserModel.query.filter(func.lower(UserModel.email) == email).first()
+    user = UserModel.query.filter(email_matches(email)).first()
     if not user:
         return jsonify({"message": "User not found"}), 404
     now = datetime.datetime.utcnow()
@@ -178,11 +283,12 @@ def resend_otp():
     return jsonify({"message": "OTP resent"}), 200
 
 @auth_bp.route('/verify-otp', methods=['POST'])
+@otp_limited(COST_OTP_CHECK)
 def verify_otp():
     data = request.get_json() or {}
     email = normalize_email(data.get('email'))
     otp_input = (data.get('otp') or '').strip()
-    user = UserModel.query.filter(func.lower(UserModel.email) == email).first()
+    user = UserModel.query.filter(email_matches(email)).first()
     if not user:
         return jsonify({"message": "User not found"}), 404
     totp = pyotp.TOTP(user.otp_secret, interval=OTP_VALIDITY_SECONDS)
@@ -202,11 +308,13 @@ def refresh():
         return jsonify({"message": "Missing refresh token"}), 401
     rt_hash = _hash_refresh(raw)
     rt = RefreshToken.query.filter_by(token_hash=rt_hash).first()
-    if not rt or rt.revoked or rt.expires_at < datetime.datetime.utcnow():
+    new_raw = None
+    if rt and rt.expires_at >= datetime.datetime.utcnow():
+        new_raw = _rotate_refresh(rt, raw)
+    if new_raw is None:
         resp = make_response(jsonify({"message": "Invalid refresh"}), 401)
         _clear_refresh_cookie(resp)
         return resp
-    new_raw = _rotate_refresh(rt)
     access = _create_access_jwt(rt.user_id)
     resp = make_response(jsonify({"token": access}), 200)
     _set_refresh_cookie(resp, new_raw)
@@ -220,14 +328,20 @@ def logout():
         rt_hash = _hash_refresh(raw)
         rt = RefreshToken.query.filter_by(token_hash=rt_hash).first()
         if rt:
-            rt.revoked = True
+            # a stale (rotated) cookie also ends its successor; never re-stamp revoked
+            # rows, which would reopen the rotation grace window
+            hashes = [rt.token_hash] + ([rt.replaced_by_token] if rt.replaced_by_token else [])
+            RefreshToken.query.filter(RefreshToken.token_hash.in_(hashes),
+                                      RefreshToken.revoked == False).update(  # noqa: E712
+                {"revoked": True, "revoked_at": datetime.datetime.utcnow()},
+                synchronize_session=False)
             db.session.commit()
     _clear_refresh_cookie(resp)
     return resp
 
 @auth_bp.route('/me', methods=['GET'])
 @require_auth
-def me(user: UserModel):
+def me(user: Principal):
     return jsonify({
         "id": user.id,
         "email": user.email,
@@ -235,32 +349,51 @@ def me(user: UserModel):
     })
 
 # ---------- NEW: user self-service ----------
+_PASSWORD_CHANGE_ERRORS = {
+    "current": ("Current password is incorrect", 401),
+    "short": ("New password must be at least 8 characters", 400),
+    "same": ("New password must be different from the current password", 400),
+}
+
+def _check_password_change(current_pw: str, new_pw: str, stored: bytes) -> tuple[str | None, bytes | None]:
+    """All of change_password's bcrypt work as one bcrypt-pool job: (problem, new hash)."""
+    if not bcrypt.checkpw(current_pw.encode('utf-8'), stored):
+        return "current", None
+    if len(new_pw) < 8:
+        return "short", None
+    if bcrypt.checkpw(new_pw.encode('utf-8'), stored):
+        return "same", None
+    return None, bcrypt.hashpw(new_pw.encode('utf-8'), passwords.gensalt())
+
 @auth_bp.route('/me/password', methods=['PUT'])
+@user_bcrypt_limited(2 * COST_BCRYPT)  # check + new hash
 @require_auth
-def change_password(user: UserModel):
+def change_password(principal: Principal):
+    user = _user_row(principal)
+    if not user:
+        return jsonify({"message": "User not found"}), 401
     data = request.get_json(silent=True) or {}
     current_pw = (data.get('current_password') or '').strip()
     new_pw = (data.get('new_password') or '').strip()
 
     if not current_pw or not new_pw:
         return jsonify({"message": "current_password and new_password are required"}), 400
-    if not bcrypt.checkpw(current_pw.encode('utf-8'), user.password):
-        return jsonify({"message": "Current password is incorrect"}), 401
-    if len(new_pw) < 8:
-        return jsonify({"message": "New password must be at least 8 characters"}), 400
-    if bcrypt.checkpw(new_pw.encode('utf-8'), user.password):
-        return jsonify({"message": "New password must be different from the current password"}), 400
+    problem, new_hash = passwords.run(_check_password_change, current_pw, new_pw, user.password)
+    if problem:
+        return jsonify({"message": _PASSWORD_CHANGE_ERRORS[problem][0]}), _PASSWORD_CHANGE_ERRORS[problem][1]
+
+    # Log activity (staged: commits together with the change below)
+    stage_activity(user.id, "PASSWORD_CHANGED", {})
 
     # Update password
-    user.password = bcrypt.hashpw(new_pw.encode('utf-8'), bcrypt.gensalt())
+    user.password = new_hash
     db.session.add(user)
 
     # Revoke all refresh tokens for this user (security)
-    RefreshToken.query.filter_by(user_id=user.id, revoked=False).update({"revoked": True})
+    RefreshToken.query.filter_by(user_id=user.id, revoked=False).update(
+        {"revoked": True, "revoked_at": datetime.datetime.utcnow()})
     db.session.commit()
-
-    # Log activity
-    append_activity(user.id, "PASSWORD_CHANGED", {})
+    principals.invalidate(user.id)
 
     # Clear refresh cookie so the client must re-login (fresh session)
     resp = make_response(jsonify({"message": "Password updated. Please log in again."}), 200)
@@ -268,45 +401,51 @@ def change_password(user: UserModel):
     return resp
 
 @auth_bp.route('/me/email', methods=['PUT'])
+@user_bcrypt_limited()
 @require_auth
-def change_email(user: UserModel):
+def change_email(principal: Principal):
+    user = _user_row(principal)
+    if not user:
+        return jsonify({"message": "User not found"}), 401
     data = request.get_json(silent=True) or {}
     new_email = normalize_email(data.get('new_email'))
     current_pw = (data.get('current_password') or '').strip()
 
     if not new_email or not current_pw:
         return jsonify({"message": "new_email and current_password are required"}), 400
-    if not bcrypt.checkpw(current_pw.encode('utf-8'), user.password):
+    if not passwords.check_password(current_pw, user.password):
         return jsonify({"message": "Current password is incorrect"}), 401
 
     # Must be unique
-    exists = UserModel.query.filter(func.lower(UserModel.email) == new_email, UserModel.id != user.id).first()
+    exists = UserModel.query.filter(email_matches(new_email), UserModel.id != user.id).first()
     if exists:
         return jsonify({"message": "Email is already taken"}), 409
 
     old_email = user.email
+    # Log activity (staged: commits together with the change)
+    stage_activity(user.id, "EMAIL_CHANGED", {"old": old_email, "new": new_email})
     user.email = new_email
     db.session.add(user)
     db.session.commit()
-
-    # Log activity
-    append_activity(user.id, "EMAIL_CHANGED", {"old": old_email, "new": new_email})
+    principals.invalidate(user.id)
 
     return jsonify({"message": "Email updated", "email": user.email}), 200
 
 # ---------- Admin endpoints (separate OTP flow + admin user mgmt) ----------
 @auth_bp.route('/admin/login', methods=['POST'])
+@account_limited(COST_BCRYPT)
 def admin_login():
     data = request.get_json() or {}
     email = normalize_email(data.get('email'))
     password = (data.get('password') or '').strip()
 
-    user = UserModel.query.filter(func.lower(UserModel.email) == email).first()
-    if not user or not bcrypt.checkpw(password.encode('utf-8'), user.password):
+    user = UserModel.query.filter(email_matches(email)).first()
+    if not user or not passwords.check_password(password, user.password):
         return jsonify({"message": "Invalid credentials"}), 401
 
     if user.role != 'admin':
         return jsonify({"message": "Admins only"}), 403
+    _maybe_upgrade_hash(user, password)
 
     totp = pyotp.TOTP(user.otp_secret, interval=OTP_VALIDITY_SECONDS)
     otp = totp.now()
@@ -317,10 +456,11 @@ def admin_login():
     return jsonify({"message": "OTP sent to admin", "email": email}), 200
 
 @auth_bp.route('/admin/resend-otp', methods=['POST'])
+@account_limited(COST_OTP_SEND)
 def admin_resend_otp():
     data = request.get_json() or {}
     email = normalize_email(data.get('email'))
-    user = UserModel.query.filter(func.lower(UserModel.email) == email).first()
+    user = UserModel.query.filter(email_matches(email)).first()
     if not user:
         return jsonify({"message": "User not found"}), 404
     if user.role != 'admin':
@@ -342,12 +482,13 @@ def admin_resend_otp():
     return jsonify({"message": "Admin OTP resent"}), 200
 
 @auth_bp.route('/admin/verify-otp', methods=['POST'])
+@otp_limited(COST_OTP_CHECK)
 def admin_verify_otp():
     data = request.get_json() or {}
     email = normalize_email(data.get('email'))
     otp_input = (data.get('otp') or '').strip()
 
-    user = UserModel.query.filter(func.lower(UserModel.email) == email).first()
+    user = UserModel.query.filter(email_matches(email)).first()
     if not user:
         return jsonify({"message": "User not found"}), 404
     if user.role != 'admin':
@@ -357,11 +498,8 @@ def admin_verify_otp():
     if not totp.verify(otp_input, valid_window=1):
         return jsonify({"message": "Invalid OTP"}), 401
 
-    access = _create_access_jwt(user.id)
-    raw_refresh, _ = _mint_refresh(user.id)
-
-    # Log successful admin login
-    append_admin_activity(
+    # Log successful admin login (staged: commits with the refresh token below)
+    stage_admin_activity(
         admin_id=user.id,
         action="ADMIN_LOGIN_OK",
         target_type="self",
@@ -369,6 +507,9 @@ def admin_verify_otp():
         meta={"email": user.email},
     )
 
+    access = _create_access_jwt(user.id)
+    raw_refresh, _ = _mint_refresh(user.id)
+
     resp = make_response(jsonify({"message": "OTP verified. Admin login successful!", "token": access}), 200)
     _set_refresh_cookie(resp, raw_refresh)
     print(f"[ADMIN VERIFY] OTP verified for {email}. JWT + refresh issued (admin).")
@@ -376,7 +517,7 @@ def admin_verify_otp():
 
 @auth_bp.route('/admin/users', methods=['GET'])
 @require_role('admin')
-def admin_list_users(user: UserModel):
+def admin_list_users(user: Principal):
     # Log read operation
     append_admin_activity(
         admin_id=user.id,
@@ -384,6 +525,7 @@ def admin_list_users(user: UserModel):
         target_type="user",
         target_id="*",
         meta={"scope": "all"},
+        durable=False,   # read audit: don't hold the response for the commit
     )
     users = UserModel.query.order_by(UserModel.id.asc()).all()
     return jsonify([
@@ -397,7 +539,7 @@ def admin_list_users(user: UserModel):
 
 @auth_bp.route('/admin/users/<int:user_id>/role', methods=['POST'])
 @require_role('admin')
-def admin_change_role(user: UserModel, user_id: int):
+def admin_change_role(user: Principal, user_id: int):
     data = request.get_json() or {}
     new_role = (data.get('role') or '').strip()
     justification = (data.get('justification') or '').strip()
@@ -414,11 +556,8 @@ def admin_change_role(user: UserModel, user_id: int):
         return jsonify({"message": "Refusing to change own role"}), 400
 
     old_role = target.role
-    target.role = new_role
-    db.session.commit()
-
-    # Log role change
-    append_admin_activity(
+    # Log role change (staged: commits together with it)
+    stage_admin_activity(
         admin_id=user.id,
         action="ADMIN_ROLE_CHANGED",
         target_type="user",
@@ -426,13 +565,16 @@ def admin_change_role(user: UserModel, user_id: int):
         meta={"email": target.email, "old_role": old_role, "new_role": new_role},
         justification=justification,
     )
+    target.role = new_role
+    db.session.commit()
+    principals.invalidate(target.id)
 
     return jsonify({"message": "Role updated", "id": target.id, "role": target.role}), 200
 
 # ---------- Admin quick stats ----------
 @auth_bp.route('/admin/stats', methods=['GET'])
 @require_role('admin')
-def admin_stats(current_admin: UserModel):
+def admin_stats(current_admin: Principal):
     total_users = db.session.query(sa_func.count(UserModel.id)).scalar() or 0
     total_admins = db.session.query(sa_func.count()).filter(UserModel.role == 'admin').scalar() or 0
     return jsonify({
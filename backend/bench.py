@@ -0,0 +1,894 @@
+# bench.py
+"""
+Micro-benchmarks for backend hot paths. Every benchmark builds its own
+synthetic data (in memory or in a temp SQLite file) and never touches users.db.
+
+    python bench.py cipher [--rows 20000]
+    python bench.py admin-page [--rows 5000] [--page 500]
+    python bench.py export [--sizes 10000,100000,1000000]
+    python bench.py chain-stress [--procs 2] [--threads 4] [--appends 50]
+    python bench.py verify-rss [--rows 1000000]
+    python bench.py fleet-verify [--owners 64] [--rows 5000] [--workers 1,2,4,8]
+    python bench.py verify-keyless [--rows 200000]
+    python bench.py merkle-proof [--rows 200000] [--proofs 200]
+    python bench.py audit-throughput [--procs 2] [--threads 4] [--requests 200]
+    python bench.py chain-contention [--threads 16] [--appends 100]
+    python bench.py login-burst [--logins 40] [--threads 4]
+    python bench.py me-latency [--requests 3000] [--users 100]
+    python bench.py jwt-cache [--calls 100000] [--tokens 1000]
+    python bench.py email-lookup [--sizes 10000,1000000,10000000] [--lookups 1000] [--scan-lookups 20]
+    python bench.py limiter-overhead [--requests 3000] [--procs 2]
+"""
+import argparse
+import csv
+import io
+import json
+import multiprocessing
+import os
+import resource
+import statistics
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+
+def _ensure_data_key():
+    """Benchmarks run without a configured DATA_KEY; use a throwaway one."""
+    if not os.getenv("DATA_KEY") and not os.getenv("DATA_KEYRING_FILE"):
+        from cryptography.fernet import Fernet
+        os.environ["DATA_KEY"] = Fernet.generate_key().decode()
+
+
+def _temp_app(path: str | None = None):
+    """Flask app bound to a scratch SQLite file with every table created."""
+    _ensure_data_key()
+    from flask import Flask
+    from db import db
+    import auth, models_admin, models_privacy, models_keys, models_merkle  # noqa: F401  (register tables)
+
+    if path is None:
+        path = os.path.join(tempfile.mkdtemp(prefix="osn-bench-"), "bench.db")
+    app = Flask("bench")
+    app.config["SQLALCHEMY_DATABASE_URI"] = f"sqlite:///{path}"
+    app.config["SQLALCHEMY_TRACK_MODIFICATIONS"] = False
+    db.init_app(app)
+    with app.app_context():
+        db.create_all()
+    return app
+
+
+def _timed(fn, n: int) -> float:
+    """Mean microseconds per call over n calls."""
+    t0 = time.perf_counter()
+    for _ in range(n):
+        fn()
+    return (time.perf_counter() - t0) / n * 1e6
+
+
+def _report(title: str, header: list[str], rows: list[list]):
+    print(f"\n{title}")
+    widths = [max(len(str(x)) for x in col) for col in zip(header, *rows)]
+    for line in [header] + rows:
+        print("  " + "  ".join(str(x).rjust(w) for x, w in zip(line, widths)))
+
+
+# ---------- cipher: Fernet vs compact binary AEAD ----------
+SAMPLE_METAS = [
+    {"item": "x"},
+    {"email": "someone@example.com"},
+    {"changed": {"share_usage": {"old": False, "new": True}}},
+    {"email": "user@example.com", "old_role": "user", "new_role": "admin"},
+]
+
+
+def bench_cipher(args):
+    _ensure_data_key()
+    import crypto_utils
+    from crypto_utils import Keyring, DataKey, generate_data_key, encrypt_json, decrypt_json
+
+    keys, _ = crypto_utils._load_keys()
+    rows = []
+    for fmt in ("fernet", "aead"):
+        crypto_utils._keyring = Keyring(keys, aead=(fmt == "aead"))
+        dek = DataKey(generate_data_key())
+        for label, key in (("master", None), ("data key", dek)):
+            for meta in SAMPLE_METAS:
+                ct = encrypt_json(meta, dek=key)
+                enc_us = _timed(lambda: encrypt_json(meta, dek=key), args.rows)
+                dec_us = _timed(lambda: decrypt_json(ct, dek=key), args.rows)
+                plain = len(json.dumps(meta, sort_keys=True, separators=(",", ":")))
+                rows.append([fmt, label, plain, len(ct), f"{enc_us:.2f}", f"{dec_us:.2f}"])
+    crypto_utils._keyring = None
+    _report(f"Bytes per row and cost per call ({args.rows} calls each)",
+            ["format", "key", "plain B", "stored B", "encrypt us", "decrypt us"], rows)
+
+    for fmt in ("fernet", "aead"):
+        sizes = [int(r[3]) for r in rows if r[0] == fmt]
+        print(f"  {fmt}: mean stored size {statistics.mean(sizes):.0f} B")
+
+
+# ---------- admin-page: memoized / bulk decryption of /admin/activity ----------
+def _seed_admin_rows(n: int, admin_id: int = 1):
+    """Insert n DEK-sealed admin rows directly (the chain is irrelevant here)."""
+    from datetime import datetime
+    from db import db
+    from crypto_utils import f_encrypt
+    from models_admin import AdminActivityLog, _json_canon
+    from models_keys import get_data_key
+
+    dek = get_data_key(admin_id, create=True)
+    now = datetime.utcnow().replace(microsecond=0)
+    batch = []
+    for i in range(n):
+        batch.append({
+            "admin_id": admin_id, "ts": now, "action": "ADMIN_ROLE_CHANGED",
+            "target_type": "user", "target_id": str(i),
+            "meta_enc": f_encrypt(_json_canon({"email": f"u{i}@example.com", "old_role": "user",
+                                               "new_role": "admin"}), dek=dek),
+            "justification_enc": f_encrypt("routine access review", dek=dek),
+            "prev_hash": None, "row_hash": "0" * 64,
+        })
+    db.session.execute(AdminActivityLog.__table__.insert(), batch)
+    db.session.commit()
+
+
+def bench_admin_page(args):
+    app = _temp_app()
+    from db import db
+    from admin_audit import _row_to_dict
+    from models_admin import AdminActivityLog, _json_canon, decrypt_admin_rows
+
+    def load_page():
+        db.session.expunge_all()
+        return AdminActivityLog.query.order_by(AdminActivityLog.id.desc()).limit(args.page).all()
+
+    def lazy(rows):
+        out = [_row_to_dict(r) for r in rows]
+        for r in rows:
+            _json_canon(r.meta), r.justification
+        return out
+
+    def uncached(rows):
+        # pre-memoization behaviour: every read decrypts again (JSON page +
+        # the CSV/verify style second read of meta and justification)
+        out = []
+        for r in rows:
+            out.append(_row_to_dict(r))
+            r._meta_memo = r._justification_memo = None
+            _json_canon(r.meta), r.justification
+            r._meta_memo = r._justification_memo = None
+        return out
+
+    def primed(rows):
+        decrypt_admin_rows(rows)
+        out = [_row_to_dict(r) for r in rows]
+        for r in rows:
+            _json_canon(r.meta), r.justification
+        return out
+
+    with app.app_context():
+        _seed_admin_rows(args.rows)
+        results = []
+        for label, fn in (("no memo, 2 reads/field", uncached),
+                          ("memoized, lazy", lazy),
+                          ("bulk decrypt_admin_rows", primed)):
+            samples = []
+            for _ in range(args.repeat):
+                rows = load_page()
+                t0 = time.perf_counter()
+                fn(rows)
+                samples.append((time.perf_counter() - t0) * 1000)
+            results.append([label, f"{statistics.median(samples):.2f}", f"{min(samples):.2f}"])
+    _report(f"{args.page}-row page of /admin/activity (decrypt + serialize, {args.repeat} runs)",
+            ["path", "median ms", "best ms"], results)
+
+
+def _admin_page_args(p):
+    p.add_argument("--rows", type=int, default=5000)
+    p.add_argument("--page", type=int, default=500)
+    p.add_argument("--repeat", type=int, default=20)
+
+
+# ---------- export: serial vs pooled decryption, time-to-last-byte ----------
+def bench_export(args):
+    _ensure_data_key()
+    import crypto_utils
+    from crypto_utils import DataKey, generate_data_key, f_encrypt, decrypt_many
+
+    dek = DataKey(generate_data_key())
+    # Decrypt cost does not depend on the plaintext, so a pool of distinct
+    # ciphertexts is tiled up to each size instead of encrypting 1M rows.
+    distinct = 5000
+    metas = [f_encrypt(json.dumps({"email": f"u{i}@example.com", "new_role": "admin"}), dek=dek)
+             for i in range(distinct)]
+    justs = [f_encrypt("routine access review", dek=dek) for _ in range(distinct)]
+
+    def export(n: int, parallel: bool) -> float:
+        meta_ct = [metas[i % distinct] for i in range(n)]
+        just_ct = [justs[i % distinct] for i in range(n)]
+        deks = [dek] * n
+        t0 = time.perf_counter()
+        meta_txt = decrypt_many(meta_ct, deks, parallel=parallel)
+        just_txt = decrypt_many(just_ct, deks, parallel=parallel)
+        buf = io.StringIO()
+        writer = csv.writer(buf)
+        for i in range(n):
+            writer.writerow([i, meta_txt[i], just_txt[i]])
+        buf.getvalue()
+        return time.perf_counter() - t0
+
+    rows = []
+    for n in [int(x) for x in args.sizes.split(",")]:
+        serial = export(n, parallel=False)
+        pooled = export(n, parallel=True)
+        rows.append([n, f"{serial:.2f}", f"{pooled:.2f}", f"{serial / pooled:.2f}x"])
+    _report(f"CSV export time-to-last-byte, decrypt pool of {crypto_utils.DECRYPT_POOL_SIZE} "
+            f"(cpus={os.cpu_count()})", ["rows", "serial s", "pooled s", "speedup"], rows)
+
+
+# ---------- chain-stress: concurrent appends must never fork a chain ----------
+def _stress_worker(path: str, threads: int, appends: int, user_id: int, admin_id: int):
+    app = _temp_app(path)
+    from models_privacy import append_activity
+    from models_admin import append_admin_activity
+
+    def run(t):
+        with app.app_context():
+            for i in range(appends):
+                append_activity(user_id, "STRESS", {"pid": os.getpid(), "t": t, "i": i})
+                append_admin_activity(admin_id, "STRESS", meta={"pid": os.getpid(), "t": t, "i": i})
+
+    pool = [threading.Thread(target=run, args=(t,)) for t in range(threads)]
+    for th in pool:
+        th.start()
+    for th in pool:
+        th.join()
+
+
+def bench_chain_stress(args):
+    path = os.path.join(tempfile.mkdtemp(prefix="osn-bench-"), "stress.db")
+    app = _temp_app(path)
+    user_id, admin_id = 1, 2
+    ctx = multiprocessing.get_context("fork")
+    procs = [ctx.Process(target=_stress_worker, args=(path, args.threads, args.appends, user_id, admin_id))
+             for _ in range(args.procs)]
+    t0 = time.perf_counter()
+    for p in procs:
+        p.start()
+    for p in procs:
+        p.join()
+    elapsed = time.perf_counter() - t0
+
+    from db import db
+    from models_privacy import ActivityLog, verify_chain
+    from models_admin import AdminActivityLog, verify_admin_chain
+    expected = args.procs * args.threads * args.appends
+    failed = False
+    with app.app_context():
+        for label, model, owner_col, owner, verify in (
+            ("activity", ActivityLog, ActivityLog.user_id, user_id, verify_chain),
+            ("admin", AdminActivityLog, AdminActivityLog.admin_id, admin_id, verify_admin_chain),
+        ):
+            count = db.session.query(model).filter(owner_col == owner).count()
+            prevs = db.session.query(model.prev_hash).filter(owner_col == owner).all()
+            forks = len(prevs) - len({p for (p,) in prevs})
+            ok, info = verify(owner)
+            failed |= (count != expected) or forks > 0 or not ok
+            print(f"  {label}: rows={count}/{expected} forks={forks} verify={ok} {info}")
+    print(f"  {2 * expected} appends from {args.procs} procs x {args.threads} threads "
+          f"in {elapsed:.2f}s ({2 * expected / elapsed:.0f}/s)")
+    if failed:
+        raise SystemExit("chain-stress FAILED")
+    print("chain-stress OK")
+
+
+def _chain_stress_args(p):
+    p.add_argument("--procs", type=int, default=2)
+    p.add_argument("--threads", type=int, default=4)
+    p.add_argument("--appends", type=int, default=50)
+
+
+# ---------- verify-rss: streaming vs materialized chain verification ----------
+def _seed_activity_chain(n: int, user_id: int = 1, v2: bool = False):
+    """Insert a valid n-row ActivityLog chain (real hashes, DEK-sealed meta); v1 hashes unless v2."""
+    from datetime import datetime, timedelta
+    from db import db
+    from crypto_utils import encrypt_json, payload_digest
+    from models_chain import HASH_V2
+    from models_privacy import ActivityLog, _meta_canon
+    from models_keys import get_data_key
+
+    dek = get_data_key(user_id, create=True)
+    ts0 = datetime.utcnow().replace(microsecond=0)
+    prev, batch = None, []
+    for i in range(n):
+        ts = ts0 + timedelta(seconds=i)
+        meta = {"item": f"setting_{i % 7}", "version": "1"}
+        row = {"user_id": user_id, "ts": ts, "event": "CONSENT_ACCEPTED",
+               "meta_enc": encrypt_json(meta, dek=dek), "prev_hash": prev}
+        if v2:
+            digest = payload_digest(_meta_canon(meta))
+            h = ActivityLog.compute_hash_v2(user_id=user_id, ts=ts, event="CONSENT_ACCEPTED",
+                                            payload_digest=digest, prev_hash=prev)
+            row.update(payload_digest=digest, hash_v=HASH_V2)
+        else:
+            h = ActivityLog.compute_hash_plain(user_id=user_id, ts=ts, event="CONSENT_ACCEPTED",
+                                               meta=meta, prev_hash=prev)
+        batch.append({**row, "row_hash": h})
+        prev = h
+        if len(batch) == 10000:
+            db.session.execute(ActivityLog.__table__.insert(), batch)
+            db.session.commit()
+            batch = []
+    if batch:
+        db.session.execute(ActivityLog.__table__.insert(), batch)
+        db.session.commit()
+
+
+def _verify_materialized(user_id: int):
+    """The pre-streaming verifier: whole chain as ORM objects via .all()."""
+    from models_privacy import ActivityLog
+    rows = ActivityLog.query.filter_by(user_id=user_id).order_by(ActivityLog.id.asc()).all()
+    expected_prev = None
+    for r in rows:
+        if r.prev_hash != (expected_prev or None) or r.row_hash != r.compute_hash(expected_prev):
+            return False, {"id": r.id}
+        expected_prev = r.row_hash
+    return True, {"count": len(rows)}
+
+
+def _verify_rss_child(path: str, impl: str):
+    app = _temp_app(path)
+    from models_privacy import verify_chain
+    with app.app_context():
+        t0 = time.perf_counter()
+        if impl == "streaming":
+            ok, info = verify_chain(1, full=True)
+        else:
+            ok, info = _verify_materialized(1)
+        elapsed = time.perf_counter() - t0
+    peak_kb = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss   # KiB on Linux
+    print(json.dumps({"impl": impl, "ok": ok, "count": info.get("count"),
+                      "seconds": elapsed, "peak_rss_mb": peak_kb / 1024}))
+
+
+def bench_verify_rss(args):
+    if args.child:
+        return _verify_rss_child(args.db, args.child)
+    path = os.path.join(tempfile.mkdtemp(prefix="osn-bench-"), "chain.db")
+    app = _temp_app(path)
+    with app.app_context():
+        t0 = time.perf_counter()
+        _seed_activity_chain(args.rows)
+        print(f"  seeded {args.rows} rows in {time.perf_counter() - t0:.1f}s")
+
+    rows = []
+    for impl in ("materialized", "streaming"):
+        # fresh interpreter per run so peak RSS isn't inherited from seeding
+        out = subprocess.run(
+            [sys.executable, __file__, "verify-rss", "--child", impl, "--db", path],
+            check=True, capture_output=True, text=True, env=os.environ.copy(),
+        ).stdout.strip().splitlines()[-1]
+        r = json.loads(out)
+        rows.append([impl, r["ok"], r["count"], f"{r['seconds']:.1f}",
+                     f"{r['count'] / r['seconds']:.0f}", f"{r['peak_rss_mb']:.0f}"])
+    _report(f"Full verification of a {args.rows}-row chain",
+            ["impl", "ok", "rows", "seconds", "rows/s", "peak RSS MB"], rows)
+
+
+def _verify_rss_args(p):
+    p.add_argument("--rows", type=int, default=1_000_000)
+    p.add_argument("--child", choices=["materialized", "streaming"], help=argparse.SUPPRESS)
+    p.add_argument("--db", help=argparse.SUPPRESS)
+
+
+# ---------- fleet-verify: verify_chains.py scaling with worker count ----------
+def bench_fleet_verify(args):
+    import verify_chains
+
+    path = os.path.join(tempfile.mkdtemp(prefix="osn-bench-"), "fleet.db")
+    app = _temp_app(path)
+    with app.app_context():
+        t0 = time.perf_counter()
+        for owner in range(1, args.owners + 1):
+            _seed_activity_chain(args.rows, user_id=owner, v2=True)
+        print(f"  seeded {args.owners} x {args.rows} rows in {time.perf_counter() - t0:.1f}s")
+
+    rows, base = [], None
+    for w in [int(x) for x in args.workers.split(",")]:
+        rep = verify_chains.run(path, workers=w, full=True, kinds=["activity"], save=False)
+        assert rep["ok"], rep["failures"]
+        base = base or rep["seconds"]   # speedup is relative to the first (narrowest) run
+        rows.append([w, f"{rep['seconds']:.2f}", f"{rep['rows_per_sec']:.0f}",
+                     f"{base / rep['seconds']:.2f}x"])
+    _report(f"Full verification, {args.owners} chains x {args.rows} rows ({os.cpu_count()} CPUs)",
+            ["workers", "seconds", "rows/s", "speedup"], rows)
+
+
+def _fleet_verify_args(p):
+    p.add_argument("--owners", type=int, default=64)
+    p.add_argument("--rows", type=int, default=5000)
+    p.add_argument("--workers", default="1,2,4,8")
+
+
+# ---------- verify-keyless: v1 vs v2 (decrypting) vs v2 keyless ----------
+def bench_verify_keyless(args):
+    from models_privacy import verify_chain
+
+    app = _temp_app()
+    with app.app_context():
+        _seed_activity_chain(args.rows, user_id=1)            # v1: hash over plaintext
+        _seed_activity_chain(args.rows, user_id=2, v2=True)   # v2: hash over payload digest
+        rows = []
+        for label, owner, keyless in (("v1, decrypt", 1, False), ("v2, decrypt + digest", 2, False),
+                                      ("v2, keyless", 2, True)):
+            t0 = time.perf_counter()
+            ok, info = verify_chain(owner, full=True, checkpoint=False, keyless=keyless)
+            elapsed = time.perf_counter() - t0
+            assert ok, info
+            rows.append([label, info["count"], f"{elapsed:.2f}", f"{info['count'] / elapsed:.0f}"])
+    _report(f"Full verification of a {args.rows}-row chain", ["mode", "rows", "seconds", "rows/s"], rows)
+
+
+# ---------- merkle-proof: one-row inclusion proof vs replaying the chain ----------
+def bench_merkle_proof(args):
+    import random
+    from models_privacy import verify_chain
+    import models_merkle as M
+
+    app = _temp_app()
+    with app.app_context():
+        _seed_activity_chain(args.rows, user_id=1, v2=True)
+        t0 = time.perf_counter()
+        anchor = M.anchor_log(M.CHAIN_ACTIVITY)
+        anchor_s = time.perf_counter() - t0
+        ids = [r for (r,) in M.db.session.execute(M.db.select(M.ActivityLog.id))]
+
+        t0 = time.perf_counter()
+        ok, _ = verify_chain(1, full=True, checkpoint=False, keyless=True)
+        replay_ms = (time.perf_counter() - t0) * 1e3
+        assert ok
+
+        root = bytes.fromhex(anchor.root_hash)
+        t_proof = t_check = 0.0
+        for row_id in random.sample(ids, min(args.proofs, len(ids))):
+            t0 = time.perf_counter()
+            p = M.inclusion_proof(M.CHAIN_ACTIVITY, row_id, anchor)
+            t1 = time.perf_counter()
+            assert M.verify_inclusion(bytes.fromhex(p["leaf_hash"]), p["leaf_index"], p["tree_size"],
+                                      [bytes.fromhex(h) for h in p["audit_path"]], root)
+            t_proof += t1 - t0
+            t_check += time.perf_counter() - t1
+        n = min(args.proofs, len(ids))
+        rows = [
+            ["anchor (build tree)", f"{anchor_s * 1e3:.0f}"],
+            ["replay chain (keyless)", f"{replay_ms:.1f}"],
+            ["inclusion proof (server)", f"{t_proof / n * 1e3:.3f}"],
+            ["inclusion check (client)", f"{t_check / n * 1e3:.3f}"],
+        ]
+    _report(f"Proving one row of a {args.rows}-row log (path length {len(p['audit_path'])})",
+            ["operation", "ms"], rows)
+
+
+def _merkle_proof_args(p):
+    p.add_argument("--rows", type=int, default=200000)
+    p.add_argument("--proofs", type=int, default=200)
+
+
+# ---------- audit-throughput: per-request commit vs group commit ----------
+def _audited_requests_worker(path: str, mode: str, threads: int, requests: int, first_user: int, out):
+    app = _temp_app(path)
+    import audit_writer
+    from db import db
+    from models_privacy import UserSettings, append_activity
+    audit_writer.ENABLED = mode != "direct"
+
+    def run(t):
+        user_id = first_user + t
+        with app.app_context():
+            s = UserSettings(user_id=user_id)
+            db.session.add(s)
+            db.session.commit()
+            for i in range(requests):
+                # what update_privacy_settings does: business commit, then the audit row
+                s.share_usage = not s.share_usage
+                db.session.commit()
+                append_activity(user_id, "PRIVACY_UPDATED", {"changed": {"share_usage": s.share_usage}},
+                                durable=(mode != "fire-and-forget"))
+
+    pool = [threading.Thread(target=run, args=(t,)) for t in range(threads)]
+    for th in pool:
+        th.start()
+    for th in pool:
+        th.join()
+    w = audit_writer._writer
+    if w is not None:
+        w.stop()
+        out.put((w.batches, w.written))
+    else:
+        out.put((0, 0))
+
+
+def bench_audit_throughput(args):
+    from db import db
+    from models_privacy import ActivityLog, verify_chain
+
+    ctx = multiprocessing.get_context("fork")
+    rows = []
+    for mode in ("direct", "durable", "fire-and-forget"):
+        path = os.path.join(tempfile.mkdtemp(prefix="osn-bench-"), "audit.db")
+        app = _temp_app(path)
+        out = ctx.Queue()
+        procs = [ctx.Process(target=_audited_requests_worker,
+                             args=(path, mode, args.threads, args.requests, 1 + i * args.threads, out))
+                 for i in range(args.procs)]
+        t0 = time.perf_counter()
+        for p in procs:
+            p.start()
+        for p in procs:
+            p.join()
+        elapsed = time.perf_counter() - t0   # fire-and-forget: includes draining the queue at exit
+        stats = [out.get() for _ in procs]
+        batches, written = sum(b for b, _ in stats), sum(w for _, w in stats)
+
+        total = args.procs * args.threads * args.requests
+        with app.app_context():
+            count = db.session.query(ActivityLog).count()
+            ok = all(verify_chain(u, full=True, checkpoint=False)[0]
+                     for u in range(1, args.procs * args.threads + 1))
+        rows.append([mode, f"{count}/{total}", ok, f"{elapsed:.2f}", f"{total / elapsed:.0f}",
+                     f"{written / batches:.1f}" if batches else "1.0"])
+    _report(f"Audited requests, {args.procs} procs x {args.threads} threads x {args.requests}",
+            ["mode", "rows", "chains ok", "seconds", "req/s", "rows/commit"], rows)
+
+
+def _audit_throughput_args(p):
+    p.add_argument("--procs", type=int, default=2)
+    p.add_argument("--threads", type=int, default=4)
+    p.add_argument("--requests", type=int, default=200)
+
+
+# ---------- chain-contention: many users appending at once, direct (no group commit) ----------
+def bench_chain_contention(args):
+    import audit_writer
+    from db import db, begin_immediate
+    from models_keys import get_data_key
+    from models_privacy import append_activity, verify_chain
+    audit_writer.ENABLED = False   # every append commits on its own, in its own thread
+
+    def run_mode(mode: str, shared_chain: bool):
+        app = _temp_app()
+        owners = [1] * args.threads if shared_chain else list(range(1, args.threads + 1))
+        with app.app_context():
+            for u in set(owners):
+                get_data_key(u, create=True)   # keys exist up front: "global" can't make one under its lock
+        lat = []
+        lock = threading.Lock()
+
+        def run(user_id):
+            mine = []
+            with app.app_context():
+                for i in range(args.appends):
+                    t0 = time.perf_counter()
+                    if mode == "global":
+                        # the whole append (encrypt, read head, hash, insert) under the database write lock
+                        begin_immediate(db.session)
+                    append_activity(user_id, "CONTENTION", {"i": i, "pad": "x" * 200})
+                    mine.append(time.perf_counter() - t0)
+            with lock:
+                lat.extend(mine)
+
+        pool = [threading.Thread(target=run, args=(u,)) for u in owners]
+        t0 = time.perf_counter()
+        for th in pool:
+            th.start()
+        for th in pool:
+            th.join()
+        elapsed = time.perf_counter() - t0
+        with app.app_context():
+            ok = all(verify_chain(u, full=True, checkpoint=False)[0] for u in set(owners))
+        lat.sort()
+        return [mode, "1" if shared_chain else str(args.threads), ok, f"{elapsed:.2f}",
+                f"{len(lat) / elapsed:.0f}", f"{lat[len(lat) // 2] * 1000:.1f}",
+                f"{lat[int(len(lat) * 0.99)] * 1000:.1f}"]
+
+    rows = [run_mode(mode, shared) for shared in (False, True) for mode in ("global", "striped")]
+    _report(f"Direct chain appends, {args.threads} threads x {args.appends}",
+            ["mode", "chains", "chains ok", "seconds", "appends/s", "p50 ms", "p99 ms"], rows)
+
+
+def _chain_contention_args(p):
+    p.add_argument("--threads", type=int, default=16)
+    p.add_argument("--appends", type=int, default=100)
+
+
+# ---------- login-burst: /me latency while a burst of logins hashes ----------
+def bench_login_burst(args):
+    from concurrent.futures import ThreadPoolExecutor
+    import bcrypt
+    import passwords
+    from db import db
+    from auth import auth_bp, UserModel, _create_access_jwt
+
+    app = _temp_app()
+    app.config["SECRET_KEY"] = "bench"
+    app.register_blueprint(auth_bp)
+    with app.app_context():
+        user = UserModel(email="burst@example.com", password=bcrypt.hashpw(b"correct horse", passwords.gensalt()),
+                         otp_secret="BENCHBENCHBENCHB")
+        db.session.add(user)
+        db.session.commit()
+        token = _create_access_jwt(user.id)
+
+    def login():
+        r = app.test_client().post("/login", json={"email": "burst@example.com", "password": "correct horse"})
+        return r.status_code
+
+    def me(submitted):
+        app.test_client().get("/me", headers={"Authorization": f"Bearer {token}"})
+        return time.perf_counter() - submitted
+
+    rows = []
+    for label, size in (("inline", 0), ("pool", passwords.POOL_SIZE or 2)):
+        passwords.POOL_SIZE, passwords._pool, passwords.rejected = size, None, 0
+        # stands in for one gunicorn worker's gthreads
+        with ThreadPoolExecutor(max_workers=args.threads) as request_threads:
+            t0 = time.perf_counter()
+            logins = [request_threads.submit(login) for _ in range(args.logins)]
+            probes = []
+            while not all(f.done() for f in logins):
+                probes.append(request_threads.submit(me, time.perf_counter()))
+                time.sleep(0.02)
+            burst = time.perf_counter() - t0
+            codes = [f.result() for f in logins]
+            lat = sorted(f.result() * 1000 for f in probes)
+        rows.append([label, codes.count(200), codes.count(503), f"{burst:.2f}", len(lat),
+                     f"{lat[len(lat) // 2]:.1f}", f"{lat[int(len(lat) * 0.99)]:.1f}"])
+    _report(f"{args.logins} logins on {args.threads} request threads, /me probed every 20 ms "
+            f"(pool {passwords.POOL_SIZE} + queue {passwords.QUEUE_MAX})",
+            ["bcrypt", "logins ok", "logins 503", "burst s", "/me probes", "/me p50 ms", "/me p99 ms"], rows)
+
+
+def _login_burst_args(p):
+    p.add_argument("--logins", type=int, default=40)
+    p.add_argument("--threads", type=int, default=4)
+
+
+# ---------- me-latency: require_auth with and without the principal cache ----------
+def bench_me_latency(args):
+    import random
+    import principals
+    from db import db
+    from auth import auth_bp, UserModel, _create_access_jwt
+
+    app = _temp_app()
+    app.config["SECRET_KEY"] = "bench"
+    app.register_blueprint(auth_bp)
+    with app.app_context():
+        users = [UserModel(email=f"u{i}@example.com", password=b"x", otp_secret="BENCHBENCHBENCHB")
+                 for i in range(args.users)]
+        db.session.add_all(users)
+        db.session.commit()
+        tokens = [_create_access_jwt(u.id) for u in users]
+    client = app.test_client()
+    rng = random.Random(1)
+    order = [rng.choice(tokens) for _ in range(args.requests)]
+
+    rows = []
+    for label, ttl in (("no cache", 0), ("cache", 30)):
+        principals.PRINCIPAL_CACHE_TTL_SECONDS = principals._cache.ttl = ttl
+        principals._cache.clear()
+        for token in tokens:   # warm-up (and fills the cache)
+            client.get("/me", headers={"Authorization": f"Bearer {token}"})
+        lat = []
+        for token in order:
+            t0 = time.perf_counter()
+            client.get("/me", headers={"Authorization": f"Bearer {token}"})
+            lat.append((time.perf_counter() - t0) * 1e6)
+        lat.sort()
+        rows.append([label, f"{lat[len(lat) // 2]:.0f}", f"{lat[int(len(lat) * 0.99)]:.0f}",
+                     f"{statistics.mean(lat):.0f}"])
+    _report(f"GET /me x {args.requests} over {args.users} users (Flask test client, microseconds)",
+            ["principal", "p50 us", "p99 us", "mean us"], rows)
+
+
+def _me_latency_args(p):
+    p.add_argument("--requests", type=int, default=3000)
+    p.add_argument("--users", type=int, default=100)
+
+
+# ---------- jwt-cache: HS256 verification vs verified-token cache hit ----------
+def bench_jwt_cache(args):
+    import datetime
+    import jwt
+    from token_cache import VerifiedTokenCache
+
+    secret = "bench-secret-" + "x" * 32
+    exp = datetime.datetime.utcnow() + datetime.timedelta(minutes=15)
+    tokens = [jwt.encode({"user_id": i, "exp": exp}, secret, algorithm="HS256") for i in range(args.tokens)]
+    cache = VerifiedTokenCache(len(tokens))
+    for t in tokens:
+        cache.decode(t, secret)   # warm: one miss each
+
+    it = iter(range(1 << 62))
+    pick = lambda: tokens[next(it) % len(tokens)]
+    decode_us = _timed(lambda: jwt.decode(pick(), secret, algorithms=["HS256"]), args.calls)
+    hit_us = _timed(lambda: cache.decode(pick(), secret), args.calls)
+    base_us = _timed(pick, args.calls)   # the loop and token pick themselves
+    stats = cache.stats()
+    _report(f"Access-token check over {args.tokens} live tokens, {args.calls} calls each",
+            ["path", "us/call", "net us/call"],
+            [["jwt.decode (HS256)", f"{decode_us:.2f}", f"{decode_us - base_us:.2f}"],
+             ["cache hit", f"{hit_us:.2f}", f"{hit_us - base_us:.2f}"]])
+    print(f"  speedup {(decode_us - base_us) / max(hit_us - base_us, 1e-9):.0f}x; "
+          f"hits={stats['hits']} misses={stats['misses']} size={stats['size']}")
+
+
+def _jwt_cache_args(p):
+    p.add_argument("--calls", type=int, default=100000)
+    p.add_argument("--tokens", type=int, default=1000)
+
+
+# ---------- email-lookup: lower(email) scan vs indexed email_norm ----------
+def bench_email_lookup(args):
+    import random
+    import sqlite3
+    from sqlalchemy import func
+    from db import db
+    from auth import UserModel, email_matches
+
+    path = os.path.join(tempfile.mkdtemp(prefix="osn-bench-"), "bench.db")
+    app = _temp_app(path)
+    conn = sqlite3.connect(path)
+    rng = random.Random(1)
+    rows, have = [], 0
+    for n in sorted(int(x) for x in args.sizes.split(",")):
+        t0 = time.perf_counter()
+        with conn:   # ORM inserts would take minutes at 10M; same columns as register()
+            conn.executemany(
+                "INSERT INTO users (email, email_norm, password, otp_secret, role) VALUES (?, ?, ?, ?, 'user')",
+                ((f"User{i}@Example.com", f"user{i}@example.com", b"x", "BENCHBENCHBENCHB")
+                 for i in range(have, n)))
+        have = n
+        print(f"  seeded {n} users in {time.perf_counter() - t0:.1f}s")
+
+        def lat(cond, lookups: int) -> list[float]:
+            out = []
+            for _ in range(lookups):
+                email = f"user{rng.randrange(n)}@example.com"
+                t = time.perf_counter()
+                user = UserModel.query.filter(cond(email)).first()
+                out.append((time.perf_counter() - t) * 1e3)
+                assert user is not None
+                db.session.rollback()
+            out.sort()
+            return out
+
+        with app.app_context():
+            for label, cond, lookups in (
+                ("lower(email) =", lambda e: func.lower(UserModel.email) == e, args.scan_lookups),
+                ("email_matches", email_matches, args.lookups),
+            ):
+                ms = lat(cond, lookups)
+                rows.append([n, label, lookups, f"{ms[len(ms) // 2]:.3f}",
+                             f"{ms[min(int(len(ms) * 0.99), len(ms) - 1)]:.3f}"])
+    conn.close()
+    _report("Login lookup by email (UserModel.query...first(), milliseconds)",
+            ["users", "filter", "lookups", "p50 ms", "p99 ms"], rows)
+
+
+def _email_lookup_args(p):
+    p.add_argument("--sizes", default="10000,1000000,10000000")
+    p.add_argument("--lookups", type=int, default=1000)
+    p.add_argument("--scan-lookups", type=int, default=20)
+
+
+# ---------- limiter-overhead: GET /me with no limiter, memory:// and sqlite:// ----------
+def _limiter_app(db_path: str, storage_uri: str | None, limit: str = "1000000 per hour"):
+    from flask_limiter import Limiter
+    from flask_limiter.util import get_remote_address
+    import limit_storage  # noqa: F401
+    from auth import auth_bp
+
+    app = _temp_app(db_path)
+    app.config["SECRET_KEY"] = "bench"
+    if storage_uri:
+        Limiter(get_remote_address, app=app, default_limits=[limit], storage_uri=storage_uri)
+    app.register_blueprint(auth_bp)
+    return app
+
+
+def _limiter_hits_worker(db_path: str, storage_uri: str, limit: int, hits: int, out):
+    client = _limiter_app(db_path, storage_uri, f"{limit} per hour").test_client()
+    out.put(sum(client.get("/me").status_code != 429 for _ in range(hits)))
+
+
+def bench_limiter_overhead(args):
+    from db import db
+    from auth import UserModel, _create_access_jwt
+
+    tmp = tempfile.mkdtemp(prefix="osn-bench-")
+    db_path = os.path.join(tmp, "bench.db")
+    with _limiter_app(db_path, None).app_context():
+        user = UserModel(email="me@example.com", password=b"x", otp_secret="BENCHBENCHBENCHB")
+        db.session.add(user)
+        db.session.commit()
+        token = _create_access_jwt(user.id)
+    headers = {"Authorization": f"Bearer {token}"}
+
+    variants = {"none": None, "memory://": "memory://",
+                "sqlite://": f"sqlite:///{os.path.join(tmp, 'limits.db')}"}
+    clients = {label: _limiter_app(db_path, uri).test_client() for label, uri in variants.items()}
+    lat = {label: [] for label in clients}
+    for i in range(200 + args.requests):   # interleaved, so drift hits every variant alike
+        for label, client in clients.items():
+            t0 = time.perf_counter()
+            client.get("/me", headers=headers)
+            if i >= 200:   # warm-up done
+                lat[label].append((time.perf_counter() - t0) * 1e6)
+    rows, base = [], None
+    for label, ls in lat.items():
+        ls.sort()
+        p50 = ls[len(ls) // 2]
+        base = p50 if base is None else base
+        rows.append([label, f"{p50:.0f}", f"{ls[int(len(ls) * 0.99)]:.0f}", f"{p50 - base:+.0f}"])
+    _report(f"GET /me x {args.requests} (Flask test client, microseconds)",
+            ["limiter storage", "p50 us", "p99 us", "vs none"], rows)
+    from limits.storage import storage_from_string
+    for uri in ("memory://", f"sqlite:///{os.path.join(tmp, 'limits.db')}"):
+        storage = storage_from_string(uri)
+        print(f"  {uri.split(':')[0]} storage.incr alone: "
+              f"{_timed(lambda: storage.incr('bench/key', 3600), args.requests):.1f} us")
+
+    # the point of sqlite://: one budget across processes (memory:// gives each its own)
+    limit, per_proc = 50, 50
+    counts = []
+    for uri in ("memory://", f"sqlite:///{os.path.join(tmp, 'shared.db')}"):
+        ctx = multiprocessing.get_context("spawn")
+        out = ctx.Queue()
+        procs = [ctx.Process(target=_limiter_hits_worker, args=(db_path, uri, limit, per_proc, out))
+                 for _ in range(args.procs)]
+        [p.start() for p in procs]
+        counts.append(sum(out.get() for _ in procs))
+        [p.join() for p in procs]
+    print(f"  {args.procs} processes x {per_proc} hits against one {limit}/hour budget: "
+          f"memory:// allowed {counts[0]}, sqlite:// allowed {counts[1]}")
+
+
+def _limiter_overhead_args(p):
+    p.add_argument("--requests", type=int, default=3000)
+    p.add_argument("--procs", type=int, default=2)
+
+
+COMMANDS = {
+    "cipher": (bench_cipher, lambda p: p.add_argument("--rows", type=int, default=20000)),
+    "admin-page": (bench_admin_page, _admin_page_args),
+    "export": (bench_export, lambda p: p.add_argument("--sizes", default="10000,100000,1000000")),
+    "chain-stress": (bench_chain_stress, _chain_stress_args),
+    "verify-rss": (bench_verify_rss, _verify_rss_args),
+    "fleet-verify": (bench_fleet_verify, _fleet_verify_args),
+    "verify-keyless": (bench_verify_keyless, lambda p: p.add_argument("--rows", type=int, default=200000)),
+    "merkle-proof": (bench_merkle_proof, _merkle_proof_args),
+    "audit-throughput": (bench_audit_throughput, _audit_throughput_args),
+    "chain-contention": (bench_chain_contention, _chain_contention_args),
+    "login-burst": (bench_login_burst, _login_burst_args),
+    "me-latency": (bench_me_latency, _me_latency_args),
+    "jwt-cache": (bench_jwt_cache, _jwt_cache_args),
+    "email-lookup": (bench_email_lookup, _email_lookup_args),
+    "limiter-overhead": (bench_limiter_overhead, _limiter_overhead_args),
+}
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Backend micro-benchmarks.")
+    sub = parser.add_subparsers(dest="command", required=True)
+    for name, (_, configure) in COMMANDS.items():
+        configure(sub.add_parser(name))
+    args = parser.parse_args()
+    COMMANDS[args.command][0](args)
+
+
+if __name__ == "__main__":
+    main()
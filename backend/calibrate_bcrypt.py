@@ -0,0 +1,84 @@
+# calibrate_bcrypt.py
+"""
+Pick the bcrypt cost (BCRYPT_ROUNDS) for this host.
+
+    python calibrate_bcrypt.py [--target-ms 250] [--samples 3] [--min-cost 10] [--max-cost 16]
+
+Times bcrypt.hashpw at increasing costs (each step doubles the work) and
+recommends the highest cost whose median time stays within the target.
+Run it on the production hardware, while it's otherwise idle. Hashes
+below the new cost move up to it on their owners' next login; lowering
+the cost leaves stronger hashes as they are (see passwords.needs_rehash).
+"""
+import argparse
+import os
+import statistics
+import sys
+import time
+
+import bcrypt
+
+from passwords import BCRYPT_ROUNDS, POOL_SIZE
+
+
+def time_cost(cost: int, samples: int) -> float:
+    """Median milliseconds for one hashpw at this cost."""
+    times = []
+    for _ in range(samples):
+        salt = bcrypt.gensalt(rounds=cost)
+        t0 = time.perf_counter()
+        bcrypt.hashpw(b"calibration-password", salt)
+        times.append((time.perf_counter() - t0) * 1000)
+    return statistics.median(times)
+
+
+def calibrate(target_ms: float, samples: int, min_cost: int, max_cost: int) -> tuple[int | None, list]:
+    """(recommended cost or None if even min_cost is too slow, [(cost, ms)])."""
+    measured, best = [], None
+    for cost in range(min_cost, max_cost + 1):
+        ms = time_cost(cost, samples)
+        measured.append((cost, ms))
+        if ms <= target_ms:
+            best = cost
+        else:
+            break   # the next cost only doubles it
+    return best, measured
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Recommend a bcrypt cost for a target hashing time.")
+    parser.add_argument("--target-ms", type=float, default=250.0, help="latency budget for one hash (default 250)")
+    parser.add_argument("--samples", type=int, default=3, help="hashes timed per cost (median is used)")
+    parser.add_argument("--min-cost", type=int, default=10, help="never recommend below this (default 10)")
+    parser.add_argument("--max-cost", type=int, default=16)
+    args = parser.parse_args()
+
+    if not 4 <= args.min_cost <= args.max_cost <= 31:
+        print("❌ costs must satisfy 4 <= min-cost <= max-cost <= 31", file=sys.stderr)
+        sys.exit(2)
+
+    best, measured = calibrate(args.target_ms, args.samples, args.min_cost, args.max_cost)
+    print(f"bcrypt on {os.cpu_count()} CPUs, target {args.target_ms:.0f} ms per hash:")
+    for cost, ms in measured:
+        marks = []
+        if cost == BCRYPT_ROUNDS:
+            marks.append("current")
+        if cost == best:
+            marks.append("recommended")
+        print(f"  cost {cost:2d}: {ms:8.1f} ms{'  <- ' + ', '.join(marks) if marks else ''}")
+
+    if best is None:
+        print(f"❌ Even cost {args.min_cost} takes longer than {args.target_ms:.0f} ms; "
+              f"raise the target or use faster hardware.")
+        sys.exit(1)
+    ms = dict(measured)[best]
+    print(f"\n✅ export BCRYPT_ROUNDS={best}")
+    parallel = max(min(POOL_SIZE, os.cpu_count() or 1), 1)
+    print(f"   ~{1000 / ms * parallel:.1f} logins/s per worker process "
+          f"with BCRYPT_POOL_SIZE={POOL_SIZE}")
+    if best != BCRYPT_ROUNDS:
+        print(f"   (currently {BCRYPT_ROUNDS}; existing hashes move to the new cost on each user's next login)")
+
+
+if __name__ == "__main__":
+    main()
@@ -1,52 +1,434 @@
 # crypto_utils.py
 import os
 import json
+import time
+import base64
+import hashlib
+import hmac
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from cryptography.exceptions import InvalidTag
 from cryptography.fernet import Fernet, InvalidToken
+from cryptography.hazmat.primitives import hashes
+from cryptography.hazmat.primitives.ciphers.aead import AESGCM
+from cryptography.hazmat.primitives.kdf.hkdf import HKDF
 
-def get_fernet() -> Fernet:
+# ---- Keyring ----
+# Ciphertexts are tagged "<kid>:<fernet token>" where kid is a short hash of the
+# key that produced them, so decryption goes straight to the right key.
+# Untagged tokens (written before the keyring existed) are still accepted.
+KID_LEN = 8
+_KID_SEP = b":"
+KEYRING_RELOAD_SECONDS = 5
+
+
+def key_id(key) -> str:
+    """Short, stable identifier for a Fernet key (first 4 bytes of its SHA-256)."""
+    if isinstance(key, str):
+        key = key.encode("ascii")
+    return hashlib.sha256(key.strip()).hexdigest()[:KID_LEN]
+
+
+def _split_token(token: bytes):
+    """Return (kid, fernet_token); kid is None for legacy untagged tokens."""
+    if len(token) > KID_LEN and token[KID_LEN:KID_LEN + 1] == _KID_SEP:
+        return token[:KID_LEN].decode("ascii"), token[KID_LEN + 1:]
+    return None, token
+
+
+# ---- Compact binary format (optional) ----
+# DATA_CIPHER_FORMAT=aead writes raw AES-256-GCM records instead of base64
+# Fernet tokens:
+#   master key:  0x01 | kid (4 bytes) | nonce (12) | ciphertext | tag (16)
+#   data key:    0x02 | nonce (12) | ciphertext | tag (16)
+# The header is authenticated as associated data. Overhead is 33 / 29 bytes,
+# against ~100 for a tagged Fernet token of a short payload. Readers accept
+# every format whatever the setting, so it can be switched either way.
+_AEAD_MASTER = b"\x01"
+_AEAD_DEK = b"\x02"
+_NONCE_LEN = 12
+
+
+def _aead_for(fernet_key) -> AESGCM:
+    """AES-256-GCM key derived from a Fernet key (the Fernet halves are not reused as-is)."""
+    ikm = base64.urlsafe_b64decode(fernet_key)
+    okm = HKDF(algorithm=hashes.SHA256(), length=32, salt=None, info=b"osn-aead-v1").derive(ikm)
+    return AESGCM(okm)
+
+
+def _aead_seal(aead: AESGCM, header: bytes, raw: bytes) -> bytes:
+    nonce = os.urandom(_NONCE_LEN)
+    return header + nonce + aead.encrypt(nonce, raw, header)
+
+
+def _aead_open(aead: AESGCM, header_len: int, token: bytes) -> bytes:
+    header, body = token[:header_len], token[header_len:]
+    try:
+        return aead.decrypt(body[:_NONCE_LEN], body[_NONCE_LEN:], header)
+    except InvalidTag:
+        raise InvalidToken
+
+
+class Keyring:
     """
-    Load DATA_KEY (a base64 Fernet key) from env and return a Fernet instance.
-    Generate once for dev:
-      >>> from cryptography.fernet import Fernet; print(Fernet.generate_key().decode())
+    One active key for new ciphertexts plus any number of retired keys kept
+    for decryption only. Instances are immutable; a new key list builds a
+    new Keyring and replaces the process-wide one atomically.
+    """
+
+    def __init__(self, keys, aead: bool = False):
+        self._fernets: dict[str, Fernet] = {}
+        self._aeads: dict[str, AESGCM] = {}
+        self._raw: dict[str, bytes] = {}
+        self.aead = aead   # write the compact binary format
+        order = []
+        for k in keys:
+            k = (k or "").strip()
+            if not k:
+                continue
+            try:
+                f = Fernet(k)
+            except Exception as e:
+                raise RuntimeError(f"Keyring key {len(order) + 1} is invalid for Fernet.") from e
+            kid = key_id(k)
+            if kid not in self._fernets:
+                self._fernets[kid] = f
+                self._aeads[kid] = _aead_for(k)
+                self._raw[kid] = base64.urlsafe_b64decode(k)
+                order.append(kid)
+        if not order:
+            raise RuntimeError("Keyring has no keys.")
+        # the first key is active, and legacy tokens try it first
+        self.active_kid = order[0]
+        self._order = order
+
+    @property
+    def key_ids(self) -> list[str]:
+        return list(self._order)
+
+    def fernet(self, kid: str | None = None) -> Fernet:
+        return self._fernets[kid or self.active_kid]
+
+    def derive(self, info: bytes, kid: str | None = None) -> bytes:
+        """32-byte subkey of a key (default: the active one) for a separate purpose (HKDF)."""
+        return HKDF(algorithm=hashes.SHA256(), length=32, salt=None, info=info).derive(
+            self._raw[kid or self.active_kid])
+
+    def encrypt(self, raw: bytes) -> bytes:
+        kid = self.active_kid
+        if self.aead:
+            return _aead_seal(self._aeads[kid], _AEAD_MASTER + bytes.fromhex(kid), raw)
+        return kid.encode("ascii") + _KID_SEP + self._fernets[kid].encrypt(raw)
+
+    def decrypt(self, token: bytes) -> bytes:
+        """Raises InvalidToken if no key in the ring can open the token."""
+        if token[:1] == _AEAD_MASTER:
+            aead = self._aeads.get(token[1:5].hex())
+            if aead is None:
+                raise InvalidToken
+            return _aead_open(aead, 5, token)
+        kid, body = _split_token(token)
+        if kid is not None:
+            f = self._fernets.get(kid)
+            if f is None:
+                raise InvalidToken
+            return f.decrypt(body)
+        for kid in self._order:
+            try:
+                return self._fernets[kid].decrypt(body)
+            except InvalidToken:
+                continue
+        raise InvalidToken
+
+    def token_kid(self, token: bytes) -> str | None:
+        """Key id a token is tagged with (None for legacy untagged tokens)."""
+        if token[:1] == _AEAD_MASTER:
+            return token[1:5].hex()
+        return _split_token(token)[0]
+
+
+_keyring: Keyring | None = None
+_keyring_lock = threading.Lock()
+_keyring_checked_at = 0.0
+_keyring_file_mtime = None
+
+
+def _load_keys():
+    """
+    Key sources, in priority order:
+      DATA_KEYRING_FILE  path to a file with one Fernet key per line; the first
+                         key is active. The file is re-checked every
+                         KEYRING_RELOAD_SECONDS, so putting a new key on top
+                         swaps the active key in every worker without a restart.
+      DATA_KEY           the active key
+      DATA_KEYS_RETIRED  comma-separated older keys, used for decryption only
+    DATA_CIPHER_FORMAT ("fernet" or "aead") picks the format for new writes.
     """
+    path = os.getenv("DATA_KEYRING_FILE", "").strip()
+    if path:
+        with open(path, "r", encoding="utf-8") as fh:
+            keys = [ln.strip() for ln in fh if ln.strip() and not ln.lstrip().startswith("#")]
+        return keys, os.path.getmtime(path)
+
     key = os.getenv("DATA_KEY", "").strip()
     if not key:
         raise RuntimeError(
             "DATA_KEY is not set. Generate a Fernet key and set it in your environment. "
             "Example (PowerShell):  $env:DATA_KEY = 'YOUR_FERNET_BASE64_KEY'"
         )
+    retired = [k for k in os.getenv("DATA_KEYS_RETIRED", "").split(",") if k.strip()]
+    return [key] + retired, None
+
+
+def reload_keyring() -> Keyring:
+    """Rebuild the process-wide keyring from the environment / keyring file."""
+    global _keyring, _keyring_checked_at, _keyring_file_mtime
+    with _keyring_lock:
+        keys, mtime = _load_keys()
+        fmt = os.getenv("DATA_CIPHER_FORMAT", "fernet").strip().lower()
+        if fmt not in ("fernet", "aead"):
+            raise RuntimeError("DATA_CIPHER_FORMAT must be 'fernet' or 'aead'.")
+        _keyring = Keyring(keys, aead=(fmt == "aead"))
+        _keyring_file_mtime = mtime
+        _keyring_checked_at = time.monotonic()
+        return _keyring
+
+
+def get_keyring() -> Keyring:
+    """Process-wide keyring; built once, refreshed only if the keyring file changed."""
+    global _keyring_checked_at
+    ring = _keyring
+    if ring is not None:
+        if _keyring_file_mtime is None:
+            return ring
+        now = time.monotonic()
+        if now - _keyring_checked_at < KEYRING_RELOAD_SECONDS:
+            return ring
+        _keyring_checked_at = now
+        if not _keyring_file_changed():
+            return ring
+    return reload_keyring()
+
+
+def _keyring_file_changed() -> bool:
+    try:
+        return os.path.getmtime(os.getenv("DATA_KEYRING_FILE", "")) != _keyring_file_mtime
+    except OSError:
+        return False
+
+
+def _master_decrypt(token: bytes) -> bytes:
+    """
+    Keyring.decrypt on the process-wide ring. A token tagged with a key id the
+    ring lacks was likely written by a worker that already picked up a new
+    keyring file, so re-check the file now (not KEYRING_RELOAD_SECONDS later)
+    and retry once.
+    """
+    ring = get_keyring()
     try:
-        return Fernet(key)
-    except Exception as e:
-        raise RuntimeError("DATA_KEY is invalid for Fernet.") from e
+        return ring.decrypt(token)
+    except InvalidToken:
+        kid = ring.token_kid(token)
+        if kid is None or kid in ring.key_ids:
+            raise
+    current = _keyring
+    if current is ring:   # else another thread has reloaded already
+        if _keyring_file_mtime is None or not _keyring_file_changed():
+            raise InvalidToken
+        current = reload_keyring()
+    return current.decrypt(token)
+
+
+def get_fernet() -> Fernet:
+    """
+    Fernet instance for the active key. Prefer f_encrypt/f_decrypt, which tag
+    ciphertexts with the key id.
+    Generate a key once for dev:
+      >>> from cryptography.fernet import Fernet; print(Fernet.generate_key().decode())
+    """
+    return get_keyring().fernet()
+
+# ---- Envelope encryption (per-user data keys) ----
+# Rows sealed under a per-user data key (DEK) carry the "dk:" prefix (or the
+# 0x02 header in the binary format). The DEK
+# itself is stored wrapped by the master keyring (see models_keys), so a
+# master-key rotation only rewraps DEKs and never touches the rows.
+_DEK_PREFIX = b"dk:"
+
+
+class DataKey:
+    """An unwrapped per-user data key; writes the format the keyring is set to."""
+
+    __slots__ = ("raw", "_fernet", "_aead")
+
+    def __init__(self, raw: bytes):
+        self.raw = raw
+        self._fernet = Fernet(raw)
+        self._aead = _aead_for(raw)
+
+    def encrypt(self, raw: bytes) -> bytes:
+        if get_keyring().aead:
+            return _aead_seal(self._aead, _AEAD_DEK, raw)
+        return _DEK_PREFIX + self._fernet.encrypt(raw)
+
+    def decrypt(self, token: bytes) -> bytes:
+        if token[:1] == _AEAD_DEK:
+            return _aead_open(self._aead, 1, token)
+        return self._fernet.decrypt(token[len(_DEK_PREFIX):])
+
+
+def generate_data_key() -> bytes:
+    return Fernet.generate_key()
+
+def wrap_data_key(raw: bytes) -> bytes:
+    """Encrypt a DEK under the active master key."""
+    return get_keyring().encrypt(raw)
+
+def unwrap_data_key(wrapped: bytes) -> DataKey:
+    """Raises InvalidToken if no master key in the ring can unwrap it."""
+    return DataKey(_master_decrypt(wrapped))
+
+def is_dek_sealed(ciphertext: bytes | None) -> bool:
+    if not ciphertext:
+        return False
+    return ciphertext[:1] == _AEAD_DEK or ciphertext[:len(_DEK_PREFIX)] == _DEK_PREFIX
+
+
+def _seal(raw: bytes, dek: DataKey | None) -> bytes:
+    return dek.encrypt(raw) if dek is not None else get_keyring().encrypt(raw)
+
+def _open(ciphertext: bytes, dek: DataKey | None) -> bytes:
+    if is_dek_sealed(ciphertext):
+        if dek is None:
+            raise InvalidToken   # owner's key missing (or destroyed)
+        return dek.decrypt(ciphertext)
+    return _master_decrypt(ciphertext)
 
 # ---- Simple string helpers ----
-def f_encrypt(plaintext: str) -> bytes:
+# Pass dek= to seal under a per-user data key; without it the master keyring
+# is used. Decryption accepts both, so rows written before envelope
+# encryption stay readable.
+def f_encrypt(plaintext: str, dek: DataKey | None = None) -> bytes:
     if plaintext is None:
         return b""
-    return get_fernet().encrypt(plaintext.encode("utf-8"))
+    return _seal(plaintext.encode("utf-8"), dek)
 
-def f_decrypt(ciphertext: bytes) -> str:
+def f_decrypt(ciphertext: bytes, dek: DataKey | None = None) -> str:
     if not ciphertext:
         return ""
     try:
-        return get_fernet().decrypt(ciphertext).decode("utf-8")
+        return _open(ciphertext, dek).decode("utf-8")
     except InvalidToken:
-        # Key rotated/changed or data corrupted
+        # Key rotated/changed/destroyed or data corrupted
         return ""
 
 # ---- JSON helpers (for encrypted activity meta) ----
-def encrypt_json(obj) -> bytes:
+def encrypt_json(obj, dek: DataKey | None = None) -> bytes:
     """Encrypt any JSON-serializable object."""
     raw = json.dumps(obj or {}, sort_keys=True, separators=(",", ":")).encode("utf-8")
-    return get_fernet().encrypt(raw)
+    return _seal(raw, dek)
 
-def decrypt_json(ciphertext: bytes):
+def decrypt_json(ciphertext: bytes, dek: DataKey | None = None):
     """Return python object or {} if key/record invalid."""
     if not ciphertext:
         return {}
     try:
-        raw = get_fernet().decrypt(ciphertext).decode("utf-8")
+        raw = _open(ciphertext, dek).decode("utf-8")
         return json.loads(raw)
     except InvalidToken:
         return {}
+
+# ---- Batch decryption ----
+# Large list/export responses decrypt thousands of rows. The cipher work runs
+# in OpenSSL, which releases the GIL, so chunks are fanned out to a small
+# bounded pool. Below the threshold the pool's hand-off costs more than it saves.
+DECRYPT_POOL_SIZE = int(os.getenv("DECRYPT_POOL_SIZE", str(min(4, os.cpu_count() or 1))))
+PARALLEL_DECRYPT_MIN_ROWS = int(os.getenv("PARALLEL_DECRYPT_MIN_ROWS", "2000"))
+DECRYPT_CHUNK = 512
+
+_decrypt_pool = None
+_decrypt_pool_pid = None
+_decrypt_pool_lock = threading.Lock()
+
+
+def _get_decrypt_pool() -> ThreadPoolExecutor:
+    """One pool per process (gunicorn forks after preload, threads don't survive)."""
+    global _decrypt_pool, _decrypt_pool_pid
+    pid = os.getpid()
+    if _decrypt_pool is None or _decrypt_pool_pid != pid:
+        with _decrypt_pool_lock:
+            if _decrypt_pool is None or _decrypt_pool_pid != pid:
+                _decrypt_pool = ThreadPoolExecutor(max_workers=DECRYPT_POOL_SIZE,
+                                                   thread_name_prefix="decrypt")
+                _decrypt_pool_pid = pid
+    return _decrypt_pool
+
+
+def _decrypt_chunk(ciphertexts, deks) -> list[str]:
+    return [f_decrypt(ct, dek=d) for ct, d in zip(ciphertexts, deks)]
+
+
+def decrypt_many(ciphertexts, deks=None, *, parallel: bool | None = None) -> list[str]:
+    """
+    f_decrypt over a list, results in input order. deks is None or a list of
+    the same length with the DataKey (or None) for each ciphertext. At
+    PARALLEL_DECRYPT_MIN_ROWS and above (or with parallel=True) the work is
+    split into chunks on the shared decrypt pool.
+    """
+    ciphertexts = list(ciphertexts)
+    n = len(ciphertexts)
+    deks = [None] * n if deks is None else list(deks)
+    if parallel is None:
+        parallel = n >= PARALLEL_DECRYPT_MIN_ROWS
+    if not parallel or DECRYPT_POOL_SIZE < 2 or n <= DECRYPT_CHUNK:
+        return _decrypt_chunk(ciphertexts, deks)
+
+    pool = _get_decrypt_pool()
+    futures = [
+        pool.submit(_decrypt_chunk, ciphertexts[i:i + DECRYPT_CHUNK], deks[i:i + DECRYPT_CHUNK])
+        for i in range(0, n, DECRYPT_CHUNK)
+    ]
+    out: list[str] = []
+    for f in futures:
+        out.extend(f.result())
+    return out
+
+
+# ---- Keyed payload digests (audit chains) ----
+# Audit rows store HMAC-SHA256(digest key, canonical plaintext) next to the
+# ciphertext and the hash chain commits to that digest, so chain continuity
+# can be checked without any decryption key. Keyed so the digest can't be
+# used to confirm guesses of low-entropy plaintext. Set AUDIT_DIGEST_KEY in
+# production; without it the digest key is derived from the active master
+# key, and digests written under retired master keys still check out as
+# long as those keys stay in the ring.
+_DIGEST_INFO = b"osn-audit-digest-v1"
+_digest_keys_cache: tuple[Keyring, list[bytes]] | None = None
+
+
+def _digest_keys() -> list[bytes]:
+    """Current digest key first, then older ones accepted when checking."""
+    global _digest_keys_cache
+    configured = os.getenv("AUDIT_DIGEST_KEY", "").strip()
+    if configured:
+        return [configured.encode("utf-8")]
+    ring = get_keyring()
+    cached = _digest_keys_cache
+    if cached is None or cached[0] is not ring:
+        cached = _digest_keys_cache = (ring, [ring.derive(_DIGEST_INFO, kid) for kid in ring.key_ids])
+    return cached[1]
+
+
+def payload_digest(text: str) -> str:
+    """Hex HMAC-SHA256 of a canonical plaintext payload."""
+    return hmac.new(_digest_keys()[0], text.encode("utf-8"), hashlib.sha256).hexdigest()
+
+
+def payload_digest_matches(text: str, digest: str | None) -> bool:
+    if not digest:
+        return False
+    raw = text.encode("utf-8")
+    return any(
+        hmac.compare_digest(hmac.new(k, raw, hashlib.sha256).hexdigest(), digest)
+        for k in _digest_keys()
+    )
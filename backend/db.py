@@ -1,5 +1,85 @@
 # db.py
+import sqlite3
 from flask_sqlalchemy import SQLAlchemy
+from sqlalchemy import event, inspect, text
+from sqlalchemy.engine import Engine
 
 # Single, shared SQLAlchemy instance
 db = SQLAlchemy()
+
+SQLITE_BUSY_TIMEOUT_MS = 5000
+
+@event.listens_for(Engine, "connect")
+def _sqlite_pragmas(dbapi_conn, _record):
+    """
+    WAL lets gunicorn workers keep reading while a writer (request or a
+    background batch job) commits; busy_timeout makes writers wait for the
+    lock instead of failing with 'database is locked'.
+    """
+    if isinstance(dbapi_conn, sqlite3.Connection):
+        cur = dbapi_conn.cursor()
+        cur.execute("PRAGMA journal_mode=WAL")
+        cur.execute(f"PRAGMA busy_timeout={SQLITE_BUSY_TIMEOUT_MS}")
+        cur.close()
+
+
+def begin_immediate(session):
+    """
+    Start the session's SQLite transaction with BEGIN IMMEDIATE, i.e. take the
+    write lock before the first read, so a read-modify-write sequence can't
+    interleave with another writer. No-op if the connection is already in a
+    transaction or isn't SQLite.
+    """
+    dbapi_conn = session.connection().connection.dbapi_connection
+    if isinstance(dbapi_conn, sqlite3.Connection) and not dbapi_conn.in_transaction:
+        dbapi_conn.execute("BEGIN IMMEDIATE")
+
+
+def holds_write_lock(session) -> bool:
+    """
+    True if the session's SQLite connection is inside a write transaction
+    (BEGIN IMMEDIATE, or a statement that wrote). Plain reads don't count:
+    sqlite3 only opens a transaction before the first write.
+    """
+    if not session.in_transaction():
+        return False
+    dbapi_conn = session.connection().connection.dbapi_connection
+    return isinstance(dbapi_conn, sqlite3.Connection) and dbapi_conn.in_transaction
+
+
+def has_pending_writes(session) -> bool:
+    """
+    True if the session has unflushed changes or holds an open SQLite write
+    transaction, i.e. committing it would write something.
+    """
+    if session.new or session.dirty or session.deleted:
+        return True
+    return holds_write_lock(session)
+
+
+def add_missing_columns(engine) -> list[str]:
+    """
+    create_all() never alters existing tables: add model columns that an
+    older users.db doesn't have yet (ALTER TABLE ... ADD COLUMN, so they must
+    be nullable or have a server default), plus any index the model declares
+    that the table lacks. Returns the "table.column" names added.
+    """
+    insp = inspect(engine)
+    existing = set(insp.get_table_names())
+    added = []
+    for table in db.metadata.sorted_tables:
+        if table.name not in existing:
+            continue   # create_all() makes it whole
+        have = {c["name"] for c in insp.get_columns(table.name)}
+        new_cols = [c for c in table.columns if c.name not in have]
+        if new_cols:
+            with engine.begin() as conn:
+                for col in new_cols:
+                    ddl = f"ALTER TABLE {table.name} ADD COLUMN {col.name} {col.type.compile(dialect=engine.dialect)}"
+                    if col.server_default is not None:
+                        ddl += f" DEFAULT {col.server_default.arg}"
+                    conn.execute(text(ddl))
+                    added.append(f"{table.name}.{col.name}")
+        for idx in table.indexes:
+            idx.create(bind=engine, checkfirst=True)
+    return added
@@ -1,9 +1,13 @@
 # ensure_tables.py
 from main import app, db
+from db import add_missing_columns
 # Import models so SQLAlchemy knows about them
 from auth import UserModel, RefreshToken
+import models_chain, models_keys, models_privacy, models_merkle  # noqa: F401
 
 if __name__ == "__main__":
     with app.app_context():
         db.create_all()
+        for col in add_missing_columns(db.engine):
+            print(f"  + added column {col}")
         print("✅ tables ensured (including refresh_tokens)")
@@ -1,10 +1,19 @@
 # models_admin.py
 from datetime import datetime
+from contextlib import closing
 import hashlib, json
 from typing import Tuple
 
 from db import db
-from crypto_utils import f_encrypt, f_decrypt
+import audit_writer
+from crypto_utils import (
+    f_encrypt, f_decrypt, is_dek_sealed, decrypt_many, payload_digest, payload_digest_matches,
+)
+from models_keys import get_data_key, data_key_for, preload_data_keys
+from models_chain import (
+    CHAIN_ADMIN, HASH_V2, OUTBOX_BUILDERS, AuditOutbox, load_checkpoint, save_checkpoint,
+    stream_chain, reseal_chain, VerifyProgress,
+)
 
 
 def _json_canon(obj) -> str:
@@ -12,6 +21,23 @@ def _json_canon(obj) -> str:
     return json.dumps(obj or {}, sort_keys=True, separators=(",", ":"))
 
 
+def _payload_canon(meta_json: str, justification_text: str) -> str:
+    """What payload_digest covers for an admin row (both encrypted fields)."""
+    return _json_canon({"meta_json": meta_json, "justification": justification_text or ""})
+
+
+def _decode_meta(ct: bytes | None, dek) -> dict:
+    return _parse_meta(f_decrypt(ct or b"", dek=dek))
+
+
+def _parse_meta(txt: str) -> dict:
+    try:
+        # We store canonical JSON as text; loading -> dict keeps verify path simple
+        return json.loads(txt) if txt else {}
+    except Exception:
+        return {}
+
+
 class AdminActivityLog(db.Model):
     __tablename__ = "admin_activity_log"
 
@@ -25,7 +51,7 @@ class AdminActivityLog(db.Model):
     target_type         = db.Column(db.String(64), nullable=True)
     target_id           = db.Column(db.String(64), nullable=True)
 
-    # encrypted blobs
+    # encrypted blobs (under the admin's data key, see models_keys)
     meta_enc            = db.Column(db.LargeBinary, nullable=True)
     justification_enc   = db.Column(db.LargeBinary, nullable=True)
 
@@ -33,19 +59,35 @@ class AdminActivityLog(db.Model):
     prev_hash           = db.Column(db.String(64), nullable=True)
     row_hash            = db.Column(db.String(64), nullable=True)
 
+    # v2 rows: keyed digest of meta + justification, which row_hash commits
+    # to instead of the plaintext (NULL hash_v = v1, see models_chain.HASH_V2)
+    payload_digest      = db.Column(db.String(64), nullable=True)
+    hash_v              = db.Column(db.SmallInteger, nullable=True)
+
     # ---- convenience (decrypted) ----
+    # Decrypted values are memoized on the instance together with the
+    # ciphertext they came from; a new ciphertext (assignment or refresh from
+    # the DB) is a different bytes object and triggers a fresh decrypt.
+    # Treat the returned dict as read-only.
+    def _memo(self, name: str, ct, load):
+        memo = getattr(self, name, None)
+        if memo is None or memo[0] is not ct:
+            memo = (ct, load())
+            setattr(self, name, memo)
+        return memo[1]
+
     @property
     def meta(self):
-        txt = f_decrypt(self.meta_enc or b"")
-        try:
-            # We store canonical JSON as text; loading -> dict keeps verify path simple
-            return json.loads(txt) if txt else {}
-        except Exception:
-            return {}
+        ct = self.meta_enc
+        return self._memo("_meta_memo", ct, lambda: _decode_meta(ct, data_key_for(self.admin_id, ct)))
 
     @property
     def justification(self):
-        return f_decrypt(self.justification_enc or b"") or ""
+        ct = self.justification_enc
+        return self._memo(
+            "_justification_memo", ct,
+            lambda: f_decrypt(ct or b"", dek=data_key_for(self.admin_id, ct)) or "",
+        )
 
     # ---- hashing (plaintext, deterministic) ----
     @staticmethod
@@ -81,6 +123,80 @@ class AdminActivityLog(db.Model):
         blob = json.dumps(payload, sort_keys=True, separators=(",", ":")).encode("utf-8")
         return hashlib.sha256(blob).hexdigest()
 
+    @staticmethod
+    def compute_hash_v2(
+        *,
+        admin_id: int,
+        ts: datetime,
+        action: str,
+        target_type: str | None,
+        target_id: str | None,
+        payload_digest: str,        # see _payload_canon
+        prev_hash: str | None,
+    ) -> str:
+        payload = {
+            "v": HASH_V2,
+            "admin_id": admin_id,
+            "ts": AdminActivityLog._iso_seconds(ts),
+            "action": action,
+            "target_type": (target_type or ""),
+            "target_id": (target_id or ""),
+            "payload_digest": payload_digest,
+            "prev_hash": (prev_hash or ""),
+        }
+        blob = json.dumps(payload, sort_keys=True, separators=(",", ":")).encode("utf-8")
+        return hashlib.sha256(blob).hexdigest()
+
+
+def _admin_entry(admin_id: int, ts: datetime, action: str, target_type: str | None,
+                 target_id: str | None, meta_enc: bytes, justification_enc: bytes, digest: str):
+    """append_batch entry for one prepared admin event (see models_chain)."""
+    def build(prev):
+        # Hash over the plaintext digest (with normalized timestamp)
+        row_hash = AdminActivityLog.compute_hash_v2(
+            admin_id=admin_id,
+            ts=ts,
+            action=action,
+            target_type=target_type,
+            target_id=target_id,
+            payload_digest=digest,
+            prev_hash=prev,
+        )
+        # Store ciphertext for meta/justification; store the hash/prev_hash
+        return AdminActivityLog(
+            admin_id=admin_id,
+            ts=ts,
+            action=action,
+            target_type=target_type,
+            target_id=target_id,
+            meta_enc=meta_enc,
+            justification_enc=justification_enc,
+            prev_hash=prev,
+            row_hash=row_hash,
+            payload_digest=digest,
+            hash_v=HASH_V2,
+        )
+
+    return (CHAIN_ADMIN, admin_id, AdminActivityLog, AdminActivityLog.admin_id, build)
+
+
+def _prepare_admin_activity(admin_id: int, target_id, meta: dict | None, justification: str | None):
+    """Timestamp, canonical plaintext, ciphertexts and digest, all outside the chain's write lock."""
+    # FIX: set timestamp BEFORE hashing and normalize to seconds for consistency
+    ts_now = datetime.utcnow().replace(microsecond=0)
+
+    # Canonical JSON for hashing
+    meta_json = _json_canon(meta)
+    justification_text = (justification or "")
+    # target_id is a string column; hash what will be read back
+    target_id = str(target_id) if target_id is not None else None
+
+    dek = get_data_key(admin_id, create=True)
+    meta_enc = f_encrypt(meta_json, dek=dek)      # encrypt the canonical JSON string
+    justification_enc = f_encrypt(justification_text, dek=dek)
+    digest = payload_digest(_payload_canon(meta_json, justification_text))
+    return ts_now, target_id, meta_enc, justification_enc, digest
+
 
 def append_admin_activity(
     admin_id: int,
@@ -90,116 +206,228 @@ def append_admin_activity(
     target_id: str | None = None,
     meta: dict | None = None,
     justification: str | None = None,
-) -> AdminActivityLog:
+    durable: bool = True,
+) -> AdminActivityLog | None:
     """
-    Append an admin event, hashing deterministically over PLAINTEXT
-    values (normalized timestamp, canonical JSON). Encryption is for storage only.
+    Append an admin event. The hash covers a keyed digest of the PLAINTEXT
+    meta/justification (canonical JSON) plus the clear columns with a
+    normalized timestamp. Encryption is for storage only.
+    The previous hash comes from chain_heads; rows are written by the
+    group-commit writer (see audit_writer). durable=False returns at once,
+    before the row is written. To record an event together with a change,
+    use stage_admin_activity instead.
     """
-    from sqlalchemy import desc
-
-    # Find previous hash in this admin's chain
-    last = (
-        AdminActivityLog.query
-        .filter_by(admin_id=admin_id)
-        .order_by(desc(AdminActivityLog.id))
-        .first()
+    ts_now, target_id, meta_enc, justification_enc, digest = _prepare_admin_activity(
+        admin_id, target_id, meta, justification)
+    row = audit_writer.append(
+        _admin_entry(admin_id, ts_now, action, target_type, target_id, meta_enc, justification_enc, digest),
+        durable,
     )
-    prev = last.row_hash if last else None
+    if row is not None:   # durable=False returns before the row exists
+        print(row)
+    return row
 
-    # FIX: set timestamp BEFORE hashing and normalize to seconds for consistency
-    ts_now = datetime.utcnow().replace(microsecond=0)
 
-    # Canonical JSON for hashing
-    meta_json = _json_canon(meta)
-    justification_text = (justification or "")
+def stage_admin_activity(
+    admin_id: int,
+    action: str,
+    *,
+    target_type: str | None = None,
+    target_id: str | None = None,
+    meta: dict | None = None,
+    justification: str | None = None,
+) -> None:
+    """
+    Stage an admin event in audit_outbox inside the caller's transaction;
+    it commits with the change it records and is chained right after (see
+    models_privacy.stage_activity).
+    """
+    ts_now, target_id, meta_enc, justification_enc, digest = _prepare_admin_activity(
+        admin_id, target_id, meta, justification)
+    db.session.add(AuditOutbox(
+        chain_type=CHAIN_ADMIN, owner_id=admin_id, ts=ts_now, action=action,
+        target_type=target_type, target_id=target_id,
+        meta_enc=meta_enc, justification_enc=justification_enc, payload_digest=digest,
+    ))
+    audit_writer.mark_staged(db.session())
 
-    # Compute hash on plaintexts (with normalized timestamp)
-    row_hash = AdminActivityLog.compute_hash_plain(
-        admin_id=admin_id,
-        ts=ts_now,
-        action=action,
-        target_type=target_type,
-        target_id=target_id,
-        meta_json=meta_json,
-        justification_text=justification_text,
-        prev_hash=prev,
-    )
 
-    # Store ciphertext for meta/justification; store the hash/prev_hash
-    row = AdminActivityLog(
-        admin_id=admin_id,
-        ts=ts_now,
-        action=action,
-        target_type=target_type,
-        target_id=target_id,
-        meta_enc=f_encrypt(meta_json),               # encrypt the canonical JSON string
-        justification_enc=f_encrypt(justification_text),
-        prev_hash=prev,
-        row_hash=row_hash,
-    )
-    db.session.add(row)
-    db.session.commit()
-    print(row)
-    return row
+OUTBOX_BUILDERS[CHAIN_ADMIN] = lambda o: _admin_entry(
+    o.owner_id, o.ts, o.action, o.target_type, o.target_id, o.meta_enc, o.justification_enc,
+    o.payload_digest)
 
 
-def verify_admin_chain(admin_id: int) -> Tuple[bool, dict]:
+def decrypt_admin_rows(rows: list[AdminActivityLog]) -> list[AdminActivityLog]:
     """
-    Recompute the chain for an admin, decrypting and re-serializing
-    meta/justification canonically and normalizing timestamp the same way.
-    Returns (ok, info).
+    Decrypt meta/justification for a whole page up front: one key lookup for
+    all owners on the page, then the plaintext is memoized on each row so
+    later .meta / .justification reads are free. Large pages (exports) are
+    decrypted on the shared pool, see crypto_utils.decrypt_many.
     """
-    rows = (
-        AdminActivityLog.query
-        .filter_by(admin_id=admin_id)
-        .order_by(AdminActivityLog.id.asc())
-        .all()
+    deks = preload_data_keys(
+        r.admin_id for r in rows
+        if is_dek_sealed(r.meta_enc) or is_dek_sealed(r.justification_enc)
     )
-    prev = None
-    count = 0
+    row_deks = [deks.get(r.admin_id) for r in rows]
+    metas = decrypt_many([r.meta_enc for r in rows], row_deks)
+    justifications = decrypt_many([r.justification_enc for r in rows], row_deks)
+    for r, meta_txt, just_txt in zip(rows, metas, justifications):
+        r._meta_memo = (r.meta_enc, _parse_meta(meta_txt))
+        r._justification_memo = (r.justification_enc, just_txt or "")
+    return rows
+
+
+_A = AdminActivityLog
+# id, ts, action, target_type, target_id, prev_hash, row_hash, hash_v, payload_digest
+# [, meta_enc, justification_enc]
+_VERIFY_COLS = (_A.id, _A.ts, _A.action, _A.target_type, _A.target_id, _A.prev_hash, _A.row_hash,
+                _A.hash_v, _A.payload_digest)
+_ENC_COLS = (_A.meta_enc, _A.justification_enc)
+
+
+def _check_admin_row(admin_id: int, row, plain: tuple[str, str] | None, prev: str | None):
+    """
+    None if the row checks out against the expected prev hash, else a
+    failure dict. plain is (decrypted meta, decrypted justification), or
+    None when verifying without keys.
+    """
+    rid, ts, action, target_type, target_id, prev_hash, row_hash, hash_v, digest = row[:9]
 
-    for r in rows:
-        meta_json = _json_canon(r.meta)          # canon again from decrypted dict
-        justification_text = r.justification or ""
+    if plain is not None and plain[0] == "" and row[9]:
+        return {"id": rid, "reason": "meta_unreadable"}   # data key missing or destroyed
 
+    if hash_v == HASH_V2:
+        expected = AdminActivityLog.compute_hash_v2(
+            admin_id=admin_id, ts=ts, action=action, target_type=target_type,
+            target_id=target_id, payload_digest=digest, prev_hash=prev,
+        )
+    elif plain is None:
+        return {"id": rid, "reason": "legacy_row_needs_key"}   # see migrate_chain_digests.py
+    else:
+        meta_txt, justification_text = plain
+        meta_json = _json_canon(_parse_meta(meta_txt))   # canon again from decrypted dict
         expected = AdminActivityLog.compute_hash_plain(
-            admin_id=r.admin_id,
-            ts=r.ts,                              # compute_hash_plain normalizes to seconds
-            action=r.action,
-            target_type=r.target_type,
-            target_id=r.target_id,
+            admin_id=admin_id,
+            ts=ts,                                # compute_hash_plain normalizes to seconds
+            action=action,
+            target_type=target_type,
+            target_id=target_id,
             meta_json=meta_json,
-            justification_text=justification_text,
+            justification_text=justification_text or "",
             prev_hash=prev,
         )
-
-        if r.row_hash != expected:
-            return (
-                False,
-                {
-                    "id": r.id,
-                    "reason": "hash_mismatch",
-                    "expected": expected,
-                    "got": r.row_hash,
-                    "prev_expected": prev,
-                    "prev_got": r.prev_hash,
-                    "count": count,
-                },
+        if row_hash != expected and (target_id or "").isdigit():
+            # rows appended before target_id was normalized hashed it as an int
+            legacy = AdminActivityLog.compute_hash_plain(
+                admin_id=admin_id, ts=ts, action=action, target_type=target_type,
+                target_id=int(target_id), meta_json=meta_json,
+                justification_text=justification_text or "", prev_hash=prev,
             )
+            if legacy == row_hash:
+                expected = legacy
 
-        if r.prev_hash != (prev or None):
-            return (
-                False,
-                {
-                    "id": r.id,
-                    "reason": "prev_pointer_mismatch",
-                    "expected_prev": prev,
-                    "got_prev": r.prev_hash,
-                    "count": count,
-                },
-            )
+    if row_hash != expected:
+        return {
+            "id": rid,
+            "reason": "hash_mismatch",
+            "expected": expected,
+            "got": row_hash,
+            "prev_expected": prev,
+            "prev_got": prev_hash,
+        }
+
+    if prev_hash != (prev or None):
+        return {
+            "id": rid,
+            "reason": "prev_pointer_mismatch",
+            "expected_prev": prev,
+            "got_prev": prev_hash,
+        }
+
+    if hash_v == HASH_V2 and plain is not None:
+        meta_txt, justification_text = plain
+        canon = _payload_canon(_json_canon(_parse_meta(meta_txt)), justification_text or "")
+        if not payload_digest_matches(canon, digest):
+            return {"id": rid, "reason": "payload_digest_mismatch"}
+    return None
+
+
+def _decrypt_batch(batch, dek) -> list[tuple[str, str]]:
+    deks = [dek] * len(batch)
+    metas = decrypt_many([b[9] for b in batch], deks)
+    justifications = decrypt_many([b[10] for b in batch], deks)
+    return list(zip(metas, justifications))
+
+
+def verify_admin_chain(admin_id: int, full: bool = False, progress=None,
+                       checkpoint: bool = True, keyless: bool = False) -> Tuple[bool, dict]:
+    """
+    Recompute the chain for an admin. v2 rows are checked against their
+    stored payload digest, v1 rows by decrypting and re-serializing
+    meta/justification canonically; timestamps are normalized either way.
+    Resumes from the stored checkpoint unless full=True (audit from genesis);
+    a successful run moves the checkpoint to the newest row (unless
+    checkpoint=False; last_id / last_hash are returned either way). Rows are
+    streamed in batches as plain column tuples, so memory stays flat;
+    progress(info) is called after every batch.
 
-        prev = r.row_hash
-        count += 1
+    keyless=True skips decryption entirely and only checks continuity over
+    the hash/digest columns; it never moves the checkpoint, and v1 rows
+    fail it until migrated.
+    Returns (ok, info).
+    """
+    start_id, prev, count = 0, None, 0
+    if not full:
+        cp, broken = load_checkpoint(CHAIN_ADMIN, admin_id, AdminActivityLog, AdminActivityLog.admin_id)
+        if broken:
+            return False, broken
+        if cp:
+            start_id, prev, count = cp
+
+    dek = None if keyless else get_data_key(admin_id)
+    tracker = VerifyProgress(progress, CHAIN_ADMIN, admin_id)
+    last_id = None
+    cols = _VERIFY_COLS if keyless else _VERIFY_COLS + _ENC_COLS
+
+    with closing(stream_chain(cols, _A.admin_id, admin_id, start_id)) as batches:
+        for batch in batches:
+            plains = [None] * len(batch) if keyless else _decrypt_batch(batch, dek)
+            for row, plain in zip(batch, plains):
+                failure = _check_admin_row(admin_id, row, plain, prev)
+                if failure:
+                    return False, {**failure, "count": count}
+                prev = row[6]
+                count += 1
+                last_id = row[0]
+            tracker.batch_done(len(batch), count, last_id)
+
+    if last_id is not None and checkpoint and not keyless:
+        save_checkpoint(CHAIN_ADMIN, admin_id, last_id, prev, count)
+    return True, {"count": count, "checked": tracker.checked, "from_id": start_id,
+                  "last_id": last_id, "last_hash": prev}
+
+
+def reseal_admin_chain(admin_id: int) -> Tuple[bool, dict]:
+    """
+    Migrate an admin's chain to v2 hashes (see models_chain.reseal_chain).
+    Rows are verified as stored first; a chain that doesn't verify is left as is.
+    """
+    dek = get_data_key(admin_id)
+
+    def reseal_row(row, plain, old_prev, new_prev):
+        failure = _check_admin_row(admin_id, row, plain, old_prev)
+        if failure:
+            return failure["reason"], None
+        meta_txt, justification_text = plain
+        digest = payload_digest(_payload_canon(_json_canon(_parse_meta(meta_txt)), justification_text or ""))
+        _, ts, action, target_type, target_id = row[:5]
+        return None, {
+            "_old_hash": row[6], "prev_hash": new_prev, "payload_digest": digest, "hash_v": HASH_V2,
+            "row_hash": AdminActivityLog.compute_hash_v2(
+                admin_id=admin_id, ts=ts, action=action, target_type=target_type,
+                target_id=target_id, payload_digest=digest, prev_hash=new_prev,
+            ),
+        }
 
-    return True, {"count": count}
+    return reseal_chain(CHAIN_ADMIN, admin_id, _A, _A.admin_id, _VERIFY_COLS + _ENC_COLS,
+                        lambda batch: _decrypt_batch(batch, dek), reseal_row)
@@ -0,0 +1,443 @@
+# models_chain.py
+import json
+import threading
+import time
+from contextlib import closing, contextmanager
+from datetime import datetime
+
+from sqlalchemy import insert, func
+from sqlalchemy.dialects.sqlite import insert as sqlite_insert
+
+from db import db, begin_immediate, holds_write_lock
+
+# Chain types (one hash chain per owner within each)
+CHAIN_ACTIVITY = "activity"   # ActivityLog, owner = user_id
+CHAIN_ADMIN    = "admin"      # AdminActivityLog, owner = admin_id
+
+APPEND_ATTEMPTS = 5
+LOCK_STRIPES = 64
+VERIFY_BATCH = 1000
+
+# Row hash versions (hash_v column). NULL/1: hash over decrypted plaintext.
+# 2: hash over a keyed digest of the plaintext (payload_digest column), so
+# continuity can be verified without decrypting; see crypto_utils.payload_digest.
+HASH_V2 = 2
+
+
+class ChainConflict(RuntimeError):
+    """The chain head moved between reading it and advancing it."""
+
+
+# ---------- Latest row per chain ----------
+class ChainHead(db.Model):
+    __tablename__ = "chain_heads"
+    chain_type = db.Column(db.String(16), primary_key=True)
+    owner_id   = db.Column(db.Integer, primary_key=True, autoincrement=False)
+    last_id    = db.Column(db.Integer, nullable=False)
+    last_hash  = db.Column(db.String(64), nullable=False)
+
+
+def _read_head(chain_type: str, owner_id: int, model, owner_col) -> tuple[str | None, bool]:
+    """
+    (prev_hash, head_row_exists). One primary-key lookup; chains that predate
+    chain_heads fall back to their newest log row once, until the first
+    append through here creates the head.
+    """
+    head = db.session.execute(
+        db.select(ChainHead.last_hash)
+        .where(ChainHead.chain_type == chain_type, ChainHead.owner_id == owner_id)
+    ).scalar()
+    if head is not None:
+        return head, True
+    last = db.session.execute(
+        db.select(model.row_hash).where(owner_col == owner_id).order_by(model.id.desc()).limit(1)
+    ).scalar()
+    return last, False
+
+
+def _advance_head(chain_type: str, owner_id: int, expected: str | None, exists: bool,
+                  new_id: int, new_hash: str) -> bool:
+    """Compare-and-set the head; False if another writer got there first."""
+    if exists:
+        res = db.session.execute(
+            db.update(ChainHead)
+            .where(ChainHead.chain_type == chain_type, ChainHead.owner_id == owner_id,
+                   ChainHead.last_hash == expected)
+            .values(last_id=new_id, last_hash=new_hash)
+        )
+        return res.rowcount == 1
+    res = db.session.execute(
+        insert(ChainHead.__table__).prefix_with("OR IGNORE"),
+        {"chain_type": chain_type, "owner_id": owner_id, "last_id": new_id, "last_hash": new_hash},
+    )
+    return res.rowcount == 1
+
+
+# ---------- Per-chain locks ----------
+_stripes = [threading.RLock() for _ in range(LOCK_STRIPES)]
+_write_gate = threading.Lock()
+
+
+@contextmanager
+def _write_turn():
+    """
+    This process's turn at SQLite's write lock. SQLite has one writer per
+    database whatever the chain, and threads that all hit BEGIN IMMEDIATE
+    at once spin in its busy handler (sleeps of up to 100 ms); queueing
+    here for the short insert-and-commit section keeps the tail latency
+    down. Same no-op rule as chain_locks.
+    """
+    if holds_write_lock(db.session()):
+        yield
+        return
+    with _write_gate:
+        yield
+
+
+@contextmanager
+def chain_locks(keys):
+    """
+    Hold this process's locks for the given (chain_type, owner_id) chains.
+    Chains hash onto LOCK_STRIPES locks, taken in stripe order so two
+    callers can't deadlock. Appenders to one chain queue here, not in a CAS
+    retry loop; appenders to other chains go straight on.
+
+    No-op when the session already holds SQLite's write lock: nobody can
+    write under it anyway, and waiting for a stripe whose holder is waiting
+    for that lock would deadlock.
+    """
+    if holds_write_lock(db.session()):
+        yield
+        return
+    held = sorted({hash(k) % LOCK_STRIPES for k in keys})
+    for i in held:
+        _stripes[i].acquire()
+    try:
+        yield
+    finally:
+        for i in reversed(held):
+            _stripes[i].release()
+
+
+def append_to_chain(chain_type: str, owner_id: int, model, owner_col, build_row):
+    """
+    Append one row to a hash chain and commit.
+
+    build_row(prev_hash) must return an unsaved model instance with prev_hash
+    and row_hash filled in. Under the chain's stripe lock the head is read
+    and the row built before the write lock is taken; BEGIN IMMEDIATE then
+    only covers the insert, the head update and the commit. The head update
+    is conditional on the hash that was read, so a writer in another process
+    that got in first makes this one retry instead of forking the chain.
+    The row goes in under a SAVEPOINT: losing the CAS undoes only the row,
+    never changes the caller had pending, and the retry then runs with the
+    write lock already held, so it can't lose again.
+    """
+    with chain_locks([(chain_type, owner_id)]):
+        for _ in range(APPEND_ATTEMPTS):
+            prev, exists = _read_head(chain_type, owner_id, model, owner_col)
+            row = build_row(prev)
+            with _write_turn():
+                begin_immediate(db.session)
+                attempt = db.session.begin_nested()
+                db.session.add(row)
+                db.session.flush()   # assigns row.id
+                if _advance_head(chain_type, owner_id, prev, exists, row.id, row.row_hash):
+                    attempt.commit()
+                    db.session.commit()
+                    return row
+                attempt.rollback()
+    raise ChainConflict(f"{chain_type} chain {owner_id}: head kept moving, gave up")
+
+
+def append_batch(entries, commit: bool = True) -> list:
+    """
+    Append several rows, possibly to several chains, in ONE transaction (one
+    commit, one fsync). entries are (chain_type, owner_id, model, owner_col,
+    build_row) as for append_to_chain; rows of the same chain are linked in
+    list order. Heads are read and rows built under the chains' stripe
+    locks, then every head is compare-and-set once under BEGIN IMMEDIATE;
+    if another process moved one, the whole batch is rebuilt (under a
+    SAVEPOINT, as in append_to_chain).
+    """
+    with chain_locks({(e[0], e[1]) for e in entries}):
+        for _ in range(APPEND_ATTEMPTS):
+            heads = {}   # (chain_type, owner_id) -> [head read, exists, last row]
+            rows = []
+            for chain_type, owner_id, model, owner_col, build_row in entries:
+                head = heads.get((chain_type, owner_id))
+                if head is None:
+                    prev, exists = _read_head(chain_type, owner_id, model, owner_col)
+                    head = heads[(chain_type, owner_id)] = [prev, exists, None]
+                row = build_row(head[2].row_hash if head[2] is not None else head[0])
+                head[2] = row
+                rows.append(row)
+            with _write_turn():
+                begin_immediate(db.session)
+                attempt = db.session.begin_nested()
+                db.session.add_all(rows)
+                db.session.flush()   # assigns ids, in order
+                if all(_advance_head(chain_type, owner_id, prev, exists, last.id, last.row_hash)
+                       for (chain_type, owner_id), (prev, exists, last) in heads.items()):
+                    attempt.commit()
+                    if commit:
+                        db.session.commit()
+                    return rows
+                attempt.rollback()
+    raise ChainConflict(f"batch of {len(entries)}: heads kept moving, gave up")
+
+
+# ---------- Transactional outbox ----------
+OUTBOX_BATCH = 500
+
+# chain type -> fn(AuditOutbox row) -> append_batch entry; filled in by the
+# model modules (models_privacy, models_admin) so this one imports neither.
+OUTBOX_BUILDERS = {}
+
+
+class AuditOutbox(db.Model):
+    """
+    Audit events staged in the same transaction as the change they record
+    (see models_privacy.stage_activity / models_admin.stage_admin_activity).
+    Everything is prepared at staging time (timestamp, ciphertext, payload
+    digest), so draining needs no keys; drain_outbox() moves rows into their
+    chain and deletes them in one transaction.
+    """
+    __tablename__ = "audit_outbox"
+    id                = db.Column(db.Integer, primary_key=True)
+    chain_type        = db.Column(db.String(16), nullable=False)
+    owner_id          = db.Column(db.Integer, nullable=False)
+    ts                = db.Column(db.DateTime, nullable=False)
+    action            = db.Column(db.String(128), nullable=False)   # event / action
+    target_type       = db.Column(db.String(64), nullable=True)
+    target_id         = db.Column(db.String(64), nullable=True)
+    meta_enc          = db.Column(db.LargeBinary, nullable=True)
+    justification_enc = db.Column(db.LargeBinary, nullable=True)
+    payload_digest    = db.Column(db.String(64), nullable=False)
+
+
+def drain_outbox(limit: int = OUTBOX_BATCH, skip=()) -> int:
+    """
+    Append up to `limit` staged events (oldest first, ids in `skip` left
+    alone) to their chains and delete them, all in one write transaction;
+    safe to run from several processes at once. Returns the number moved.
+    """
+    q = db.select(AuditOutbox.id)
+    if skip:
+        q = q.where(AuditOutbox.id.not_in(skip))
+    if db.session.execute(q.limit(1)).first() is None:   # cheap check before taking the lock
+        db.session.rollback()
+        return 0
+
+    begin_immediate(db.session)
+    try:
+        q = db.select(AuditOutbox).order_by(AuditOutbox.id).limit(limit)
+        if skip:
+            q = q.where(AuditOutbox.id.not_in(skip))
+        staged = db.session.execute(q).scalars().all()
+        if not staged:
+            db.session.rollback()
+            return 0
+        append_batch([OUTBOX_BUILDERS[o.chain_type](o) for o in staged], commit=False)
+        db.session.execute(db.delete(AuditOutbox).where(AuditOutbox.id.in_([o.id for o in staged])))
+        db.session.commit()
+        return len(staged)
+    except Exception:
+        db.session.rollback()
+        raise
+
+
+# ---------- Verified prefixes ----------
+class ChainCheckpoint(db.Model):
+    """Everything up to and including last_id was verified; row_hash is that row's hash."""
+    __tablename__ = "chain_checkpoints"
+    chain_type  = db.Column(db.String(16), primary_key=True)
+    owner_id    = db.Column(db.Integer, primary_key=True, autoincrement=False)
+    last_id     = db.Column(db.Integer, nullable=False)
+    row_hash    = db.Column(db.String(64), nullable=False)
+    count       = db.Column(db.Integer, nullable=False)
+    verified_at = db.Column(db.DateTime, default=datetime.utcnow, nullable=False)
+
+
+def load_checkpoint(chain_type: str, owner_id: int, model, owner_col):
+    """
+    Starting point for an incremental verification: (last_id, row_hash, count),
+    or None to start from genesis. The checkpoint is only trusted if its row
+    still carries the same hash and the verified prefix still has the same
+    number of rows (both cheap, no decryption); otherwise returns a failure
+    dict instead.
+    """
+    cp = db.session.get(ChainCheckpoint, (chain_type, owner_id))
+    if cp is None:
+        return None, None
+    stored = db.session.execute(
+        db.select(model.row_hash).where(model.id == cp.last_id, owner_col == owner_id)
+    ).scalar()
+    if stored != cp.row_hash:
+        return None, {"id": cp.last_id, "reason": "checkpoint_row_changed", "count": 0}
+    prefix = db.session.execute(
+        db.select(func.count(model.id)).where(owner_col == owner_id, model.id <= cp.last_id)
+    ).scalar()
+    if prefix != cp.count:
+        return None, {"id": cp.last_id, "reason": "checkpoint_prefix_changed",
+                      "expected_count": cp.count, "got_count": prefix, "count": 0}
+    return (cp.last_id, cp.row_hash, cp.count), None
+
+
+def save_checkpoint(chain_type: str, owner_id: int, last_id: int, row_hash: str, count: int):
+    """
+    Upsert a checkpoint; never moves an existing one backwards. Written on
+    its own short connection so verifying never commits what the caller has
+    pending; if the caller already holds the write lock it rides along in
+    the caller's transaction instead (a second connection would wait on it),
+    and commits only when the caller does.
+    """
+    stmt = sqlite_insert(ChainCheckpoint.__table__).values(
+        chain_type=chain_type, owner_id=owner_id, last_id=last_id,
+        row_hash=row_hash, count=count, verified_at=datetime.utcnow(),
+    )
+    stmt = stmt.on_conflict_do_update(
+        index_elements=["chain_type", "owner_id"],
+        set_={"last_id": stmt.excluded.last_id, "row_hash": stmt.excluded.row_hash,
+              "count": stmt.excluded.count, "verified_at": stmt.excluded.verified_at},
+        where=ChainCheckpoint.__table__.c.last_id <= stmt.excluded.last_id,
+    )
+    if holds_write_lock(db.session()):
+        db.session.execute(stmt)
+        return
+    with db.engine.begin() as conn:
+        conn.execute(stmt)
+
+
+# ---------- Streaming verification helpers ----------
+def stream_chain(columns, owner_col, owner_id: int, start_id: int, batch: int = VERIFY_BATCH):
+    """
+    Yield lists of up to `batch` row tuples (columns[0] must be the id) in id
+    order, after start_id. Column-only select with yield_per, so memory stays
+    flat however long the chain is. Close the generator if you stop early.
+    """
+    id_col = columns[0]
+    stmt = (
+        db.select(*columns)
+        .where(owner_col == owner_id, id_col > start_id)
+        .order_by(id_col)
+        .execution_options(yield_per=batch)
+    )
+    result = db.session.execute(stmt)
+    try:
+        for part in result.partitions():
+            yield part
+    finally:
+        result.close()
+
+
+class VerifyProgress:
+    """Calls progress(info) after each batch with counts and rows/s; no-op without a callback."""
+
+    def __init__(self, callback, chain_type: str, owner_id: int):
+        self.callback = callback
+        self.base = {"chain": chain_type, "owner_id": owner_id}
+        self.started = time.monotonic()
+        self.checked = 0
+
+    def batch_done(self, n: int, count: int, last_id: int):
+        self.checked += n
+        if self.callback:
+            elapsed = max(time.monotonic() - self.started, 1e-9)
+            self.callback({**self.base, "checked": self.checked, "count": count,
+                           "last_id": last_id, "rows_per_sec": self.checked / elapsed})
+
+
+# ---------- Background verification jobs ----------
+class VerifyJob(db.Model):
+    """A chain verification run in the background; polled through its status URL."""
+    __tablename__ = "verify_jobs"
+    id           = db.Column(db.Integer, primary_key=True)
+    chain_type   = db.Column(db.String(16), nullable=False)
+    owner_id     = db.Column(db.Integer, nullable=False)
+    full         = db.Column(db.Boolean, nullable=False, default=False)
+    status       = db.Column(db.String(16), nullable=False, default="queued")   # queued | running | done | error
+    requested_by = db.Column(db.Integer, nullable=True)
+    checked      = db.Column(db.Integer, nullable=False, default=0)
+    count        = db.Column(db.Integer, nullable=False, default=0)
+    rows_per_sec = db.Column(db.Float, nullable=True)
+    result_json  = db.Column(db.Text, nullable=True)
+    created_at   = db.Column(db.DateTime, default=datetime.utcnow, nullable=False)
+    updated_at   = db.Column(db.DateTime, default=datetime.utcnow, nullable=False)
+
+    __table_args__ = (db.Index("ix_verify_jobs_chain", "chain_type", "owner_id", "status"),)
+
+    def to_dict(self) -> dict:
+        return {
+            "id": self.id,
+            "chain": self.chain_type,
+            "owner_id": self.owner_id,
+            "full": self.full,
+            "status": self.status,
+            "checked": self.checked,
+            "count": self.count,
+            "rows_per_sec": self.rows_per_sec,
+            "result": json.loads(self.result_json) if self.result_json else None,
+            "created_at": self.created_at.isoformat() + "Z",
+            "updated_at": self.updated_at.isoformat() + "Z",
+        }
+
+
+def update_verify_job(job_id: int, **values):
+    """
+    Update a job row on its own short connection: the verifier's session
+    is in the middle of streaming the chain and must not commit.
+    """
+    if "result" in values:
+        values["result_json"] = json.dumps(values.pop("result"), default=str)
+    values["updated_at"] = datetime.utcnow()
+    with db.engine.begin() as conn:
+        conn.execute(db.update(VerifyJob).where(VerifyJob.id == job_id).values(**values))
+
+
+# ---------- Re-sealing (hash version migration) ----------
+def reseal_chain(chain_type: str, owner_id: int, model, owner_col, columns, prepare, reseal_row):
+    """
+    Rewrite a whole chain in one write transaction (BEGIN IMMEDIATE, so no
+    append can interleave). columns[0] must be the id; rows are streamed as
+    tuples, prepare(batch) returns per-row extras (e.g. decrypted text), and
+    reseal_row(row, extra, old_prev, new_prev) returns (None, new_values) or
+    (failure_reason, None); new_values carries "_old_hash" (the row's stored
+    hash, the next row's old_prev) besides the columns to write. reseal_row must check the stored hash against
+    old_prev first: a chain that doesn't verify is rolled back, never
+    re-sealed. On success the head and the checkpoint move to the new hashes.
+    """
+    begin_immediate(db.session)
+    old_prev = new_prev = None
+    count, last_id = 0, None
+    try:
+        with closing(stream_chain(columns, owner_col, owner_id, 0)) as batches:
+            for batch in batches:
+                extras = prepare(batch)
+                updates = []
+                for row, extra in zip(batch, extras):
+                    reason, values = reseal_row(row, extra, old_prev, new_prev)
+                    if reason:
+                        db.session.rollback()
+                        return False, {"id": row[0], "reason": reason, "count": count}
+                    old_prev, new_prev = values.pop("_old_hash"), values["row_hash"]
+                    updates.append({"id": row[0], **values})
+                    count += 1
+                    last_id = row[0]
+                db.session.execute(db.update(model), updates)   # bulk UPDATE by primary key
+    except Exception:
+        db.session.rollback()
+        raise
+
+    if last_id is None:
+        db.session.rollback()
+        return True, {"count": 0, "last_id": None, "last_hash": None}
+    db.session.execute(
+        sqlite_insert(ChainHead.__table__)
+        .values(chain_type=chain_type, owner_id=owner_id, last_id=last_id, last_hash=new_prev)
+        .on_conflict_do_update(index_elements=["chain_type", "owner_id"],
+                               set_={"last_id": last_id, "last_hash": new_prev})
+    )
+    save_checkpoint(chain_type, owner_id, last_id, new_prev, count)
+    db.session.commit()
+    return True, {"count": count, "last_id": last_id, "last_hash": new_prev}
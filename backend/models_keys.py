@@ -0,0 +1,174 @@
+# models_keys.py
+import os
+import threading
+import time
+from collections import OrderedDict
+from datetime import datetime
+
+from cryptography.fernet import InvalidToken
+from sqlalchemy import event, insert
+from sqlalchemy.orm import Session
+
+from db import db, holds_write_lock
+from crypto_utils import (
+    DataKey, generate_data_key, wrap_data_key, unwrap_data_key, is_dek_sealed,
+)
+
+# Unwrapped DEKs kept in-process. The TTL bounds how long another gunicorn
+# worker can keep using a key after destroy_data_key() deleted it.
+DEK_CACHE_SIZE = int(os.getenv("DEK_CACHE_SIZE", "1024"))
+DEK_CACHE_TTL_SECONDS = int(os.getenv("DEK_CACHE_TTL_SECONDS", "300"))
+
+_CREATED = "data_keys_created"   # Session.info: user ids whose key the open transaction inserted
+
+
+# ---------- Wrapped per-user data keys ----------
+class UserDataKey(db.Model):
+    __tablename__ = "user_data_keys"
+    user_id      = db.Column(db.Integer, primary_key=True, autoincrement=False)
+    wrapped_key  = db.Column(db.LargeBinary, nullable=False)   # DEK encrypted under the master keyring
+    created_at   = db.Column(db.DateTime, default=datetime.utcnow, nullable=False)
+
+
+class _DekCache:
+    """Small thread-safe LRU of unwrapped keys: user_id -> (DataKey, expires_at)."""
+
+    def __init__(self, size: int, ttl: float):
+        self.size = size
+        self.ttl = ttl
+        self._items: OrderedDict[int, tuple[DataKey, float]] = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, user_id: int) -> DataKey | None:
+        with self._lock:
+            hit = self._items.get(user_id)
+            if hit is None:
+                return None
+            if hit[1] < time.monotonic():
+                del self._items[user_id]
+                return None
+            self._items.move_to_end(user_id)
+            return hit[0]
+
+    def put(self, user_id: int, dek: DataKey):
+        with self._lock:
+            self._items[user_id] = (dek, time.monotonic() + self.ttl)
+            self._items.move_to_end(user_id)
+            while len(self._items) > self.size:
+                self._items.popitem(last=False)
+
+    def evict(self, user_id: int | None = None):
+        with self._lock:
+            if user_id is None:
+                self._items.clear()
+            else:
+                self._items.pop(user_id, None)
+
+
+_cache = _DekCache(DEK_CACHE_SIZE, DEK_CACHE_TTL_SECONDS)
+
+
+def _create_data_key(user_id: int) -> bytes:
+    """
+    Insert a fresh wrapped DEK for user_id unless one exists, and return the
+    stored wrapped key. If the caller's session already holds the write lock
+    the insert joins its transaction (a connection of our own would only
+    wait on that lock) and the user id is noted in session.info until that
+    transaction ends; otherwise it runs on its own connection and commits at
+    once. Either way two workers racing here end up with the same key.
+    """
+    row = {"user_id": user_id, "wrapped_key": wrap_data_key(generate_data_key()),
+           "created_at": datetime.utcnow()}
+    stmt = insert(UserDataKey.__table__).prefix_with("OR IGNORE")
+    select_key = db.select(UserDataKey.wrapped_key).where(UserDataKey.user_id == user_id)
+    session = db.session()
+    if holds_write_lock(session):
+        session.execute(stmt, row)
+        session.info.setdefault(_CREATED, set()).add(user_id)
+        return session.execute(select_key).scalar_one()
+    with db.engine.begin() as conn:
+        conn.execute(stmt, row)
+        return conn.execute(select_key).scalar_one()
+
+
+@event.listens_for(Session, "after_transaction_end")
+def _forget_created(session, transaction):
+    if transaction.parent is None:   # committed or rolled back: later reads may cache it
+        session.info.pop(_CREATED, None)
+
+
+def get_data_key(user_id: int, create: bool = False) -> DataKey | None:
+    """
+    Unwrapped DEK for a user, or None if the user has no key (never created,
+    or destroyed) and create is False. Call with create=True before writing.
+    """
+    dek = _cache.get(user_id)
+    if dek is not None:
+        return dek
+    with db.session.no_autoflush:   # never take the write lock just to read a key
+        wrapped = db.session.execute(
+            db.select(UserDataKey.wrapped_key).where(UserDataKey.user_id == user_id)
+        ).scalar()
+    if wrapped is None:
+        if not create:
+            return None
+        wrapped = _create_data_key(user_id)
+    try:
+        dek = unwrap_data_key(wrapped)
+    except InvalidToken:
+        return None   # master key that wrapped it is no longer in the keyring
+    if user_id not in db.session.info.get(_CREATED, ()):   # never cache a key that may still roll back
+        _cache.put(user_id, dek)
+    return dek
+
+
+def preload_data_keys(user_ids) -> dict[int, DataKey]:
+    """
+    DEKs for many owners at once: cache hits first, then one IN (...) query
+    per 500 misses. Owners without a (readable) key are absent from the result.
+    """
+    found: dict[int, DataKey] = {}
+    missing = []
+    created = db.session.info.get(_CREATED, ())
+    for uid in set(user_ids):
+        dek = _cache.get(uid)
+        if dek is not None:
+            found[uid] = dek
+        else:
+            missing.append(uid)
+    for i in range(0, len(missing), 500):
+        chunk = missing[i:i + 500]
+        with db.session.no_autoflush:
+            rows = db.session.execute(
+                db.select(UserDataKey.user_id, UserDataKey.wrapped_key)
+                .where(UserDataKey.user_id.in_(chunk))
+            ).all()
+        for uid, wrapped in rows:
+            try:
+                dek = unwrap_data_key(wrapped)
+            except InvalidToken:
+                continue
+            if uid not in created:
+                _cache.put(uid, dek)
+            found[uid] = dek
+    return found
+
+
+def data_key_for(owner_id: int, ciphertext: bytes | None) -> DataKey | None:
+    """DEK needed to open ciphertext; skips the lookup for master-key (legacy) rows."""
+    if not is_dek_sealed(ciphertext):
+        return None
+    return get_data_key(owner_id)
+
+
+def destroy_data_key(user_id: int) -> bool:
+    """
+    Crypto-shred a user: deleting the wrapped DEK makes every row sealed under
+    it unreadable, in one single-row delete and without touching the logs.
+    Rows still under the master key (written before envelope encryption and
+    not yet migrated by reencrypt.py) are not covered.
+    """
+    deleted = UserDataKey.query.filter_by(user_id=user_id).delete()
+    db.session.commit()
+    _cache.evict(user_id)
+    return bool(deleted)
@@ -1,26 +1,19 @@
 # models_privacy.py
 from datetime import datetime
+from contextlib import closing
 import hashlib
 import json
-from sqlalchemy.types import TypeDecorator, LargeBinary
-from sqlalchemy import desc, asc
 from db import db
-from crypto_utils import f_encrypt, f_decrypt, encrypt_json, decrypt_json
-
-# ---------- Encrypted JSON column for activity meta ----------
-class EncryptedJSON(TypeDecorator):
-    impl = LargeBinary
-    cache_ok = True
-
-    def process_bind_param(self, value, dialect):
-        if value is None:
-            return None
-        return encrypt_json(value)
-
-    def process_result_value(self, value, dialect):
-        if value is None:
-            return {}
-        return decrypt_json(value)
+import audit_writer
+from crypto_utils import (
+    f_encrypt, f_decrypt, encrypt_json, decrypt_json, is_dek_sealed, decrypt_many,
+    payload_digest, payload_digest_matches,
+)
+from models_keys import get_data_key, data_key_for, preload_data_keys
+from models_chain import (
+    CHAIN_ACTIVITY, HASH_V2, OUTBOX_BUILDERS, AuditOutbox, load_checkpoint, save_checkpoint,
+    stream_chain, reseal_chain, VerifyProgress,
+)
 
 # ---------- Settings / Consent ----------
 class UserSettings(db.Model):
@@ -52,55 +45,229 @@ class ActivityLog(db.Model):
     ts      = db.Column(db.DateTime, default=datetime.utcnow, index=True, nullable=False)
     event   = db.Column(db.String(128), nullable=False)
 
-    # Encrypted at rest
-    meta_enc = db.Column(EncryptedJSON, nullable=True)
+    # Encrypted at rest under the user's data key (see models_keys)
+    meta_enc = db.Column(db.LargeBinary, nullable=True)
 
     # Chain fields
     prev_hash = db.Column(db.String(64), nullable=True)
     row_hash  = db.Column(db.String(64), nullable=True)
+    # v2 rows: keyed digest of the canonical meta, which row_hash commits to
+    # instead of the plaintext (NULL hash_v = v1, see models_chain.HASH_V2)
+    payload_digest = db.Column(db.String(64), nullable=True)
+    hash_v         = db.Column(db.SmallInteger, nullable=True)
 
-    # Convenience property for decrypted meta
+    # Convenience property for decrypted meta, memoized per ciphertext
+    # (assigning meta_enc or refreshing the row invalidates it). Read-only.
     @property
     def meta(self):
-        return self.meta_enc or {}
+        ct = self.meta_enc
+        memo = getattr(self, "_meta_memo", None)
+        if memo is None or memo[0] is not ct:
+            memo = (ct, decrypt_json(ct, dek=data_key_for(self.user_id, ct)))
+            self._meta_memo = memo
+        return memo[1]
 
     @meta.setter
     def meta(self, value):
-        self.meta_enc = value or {}
+        self.meta_enc = encrypt_json(value or {}, dek=get_data_key(self.user_id, create=True))
 
-    def compute_hash(self, prev_hash: str | None):
+    @staticmethod
+    def compute_hash_plain(*, user_id: int, ts: datetime | None, event: str, meta: dict,
+                           prev_hash: str | None) -> str:
         data = {
-            "user_id": self.user_id,
-            "ts": self.ts.replace(microsecond=0).isoformat() if self.ts else None,
-            "event": self.event,
-            "meta": self.meta,  # use decrypted object for hashing
+            "user_id": user_id,
+            "ts": ts.replace(microsecond=0).isoformat() if ts else None,
+            "event": event,
+            "meta": meta,  # use decrypted object for hashing
             "prev_hash": prev_hash or "",
         }
         blob = json.dumps(data, sort_keys=True, separators=(",", ":")).encode("utf-8")
         return hashlib.sha256(blob).hexdigest()
 
-def append_activity(user_id: int, event: str, meta_dict: dict | None = None):
-    last = ActivityLog.query.filter_by(user_id=user_id).order_by(desc(ActivityLog.id)).first()
-    prev = last.row_hash if last else None
-
-    row = ActivityLog(user_id=user_id, event=event)
-    row.meta = meta_dict or {}   # encrypted via EncryptedJSON
-    row.prev_hash = prev
-    row.row_hash = row.compute_hash(prev)
-    db.session.add(row)
-    db.session.commit()
-
-def verify_chain(user_id: int):
-    rows = ActivityLog.query.filter_by(user_id=user_id).order_by(asc(ActivityLog.id)).all()
-    expected_prev = None
-    for r in rows:
-        if r.prev_hash != (expected_prev or None):
-            return False, {"id": r.id, "reason": "prev_hash mismatch"}
-        expected_hash = r.compute_hash(expected_prev)
-        if r.row_hash != expected_hash:
-            return False, {"id": r.id, "reason": "row_hash mismatch"}
-        expected_prev = r.row_hash
-    return True, {"count": len(rows)}
+    @staticmethod
+    def compute_hash_v2(*, user_id: int, ts: datetime, event: str, payload_digest: str,
+                        prev_hash: str | None) -> str:
+        data = {
+            "v": HASH_V2,
+            "user_id": user_id,
+            "ts": ts.replace(microsecond=0).isoformat(),
+            "event": event,
+            "payload_digest": payload_digest,
+            "prev_hash": prev_hash or "",
+        }
+        blob = json.dumps(data, sort_keys=True, separators=(",", ":")).encode("utf-8")
+        return hashlib.sha256(blob).hexdigest()
+
+    def compute_hash(self, prev_hash: str | None, legacy_ts: bool = False):
+        # legacy_ts: rows appended before the timestamp was set ahead of
+        # hashing were hashed with "ts": null.
+        return ActivityLog.compute_hash_plain(
+            user_id=self.user_id, ts=None if legacy_ts else self.ts, event=self.event,
+            meta=self.meta, prev_hash=prev_hash,
+        )
+
+def _meta_canon(meta: dict) -> str:
+    return json.dumps(meta or {}, sort_keys=True, separators=(",", ":"))
+
+def _parse_meta(txt: str | None) -> dict:
+    """Decrypted meta text -> dict; {} if empty or not JSON."""
+    try:
+        return json.loads(txt) if txt else {}
+    except ValueError:
+        return {}
+
+def _activity_entry(user_id: int, ts: datetime, event: str, meta_enc: bytes, digest: str, meta=None):
+    """append_batch entry for one prepared event (see models_chain)."""
+    def build(prev):
+        row = ActivityLog(user_id=user_id, ts=ts, event=event, meta_enc=meta_enc, prev_hash=prev,
+                          payload_digest=digest, hash_v=HASH_V2)
+        row.row_hash = ActivityLog.compute_hash_v2(
+            user_id=user_id, ts=ts, event=event, payload_digest=digest, prev_hash=prev,
+        )
+        if meta is not None:
+            row._meta_memo = (meta_enc, meta)
+        return row
+
+    return (CHAIN_ACTIVITY, user_id, ActivityLog, ActivityLog.user_id, build)
+
+def _prepare_activity(user_id: int, meta_dict: dict | None):
+    """Encrypt, digest and fix the timestamp: everything done outside the chain's write lock."""
+    meta_json = _meta_canon(meta_dict)
+    meta = json.loads(meta_json)
+    meta_enc = encrypt_json(meta, dek=get_data_key(user_id, create=True))
+    return datetime.utcnow().replace(microsecond=0), meta, meta_enc, payload_digest(meta_json)
+
+def append_activity(user_id: int, event: str, meta_dict: dict | None = None, *,
+                    durable: bool = True) -> ActivityLog | None:
+    """
+    Append to the user's chain through the group-commit writer (see
+    audit_writer). durable=False returns at once, before the row is written.
+    To record an event together with a change, use stage_activity instead.
+    """
+    ts_now, meta, meta_enc, digest = _prepare_activity(user_id, meta_dict)
+    return audit_writer.append(_activity_entry(user_id, ts_now, event, meta_enc, digest, meta), durable)
+
+def stage_activity(user_id: int, event: str, meta_dict: dict | None = None) -> None:
+    """
+    Stage an event in audit_outbox inside the caller's transaction: it
+    commits (or rolls back) with the change it records, and the audit
+    writer moves it into the chain right after.
+    """
+    ts_now, _, meta_enc, digest = _prepare_activity(user_id, meta_dict)
+    db.session.add(AuditOutbox(chain_type=CHAIN_ACTIVITY, owner_id=user_id, ts=ts_now, action=event,
+                               meta_enc=meta_enc, payload_digest=digest))
+    audit_writer.mark_staged(db.session())
+
+OUTBOX_BUILDERS[CHAIN_ACTIVITY] = lambda o: _activity_entry(
+    o.owner_id, o.ts, o.action, o.meta_enc, o.payload_digest)
+
+def decrypt_activity_rows(rows: list[ActivityLog]) -> list[ActivityLog]:
+    """Decrypt meta for a page of rows with one key lookup; memoizes on each row."""
+    deks = preload_data_keys(r.user_id for r in rows if is_dek_sealed(r.meta_enc))
+    texts = decrypt_many([r.meta_enc for r in rows], [deks.get(r.user_id) for r in rows])
+    for r, txt in zip(rows, texts):
+        r._meta_memo = (r.meta_enc, _parse_meta(txt))
+    return rows
+
+# id, ts, event, prev_hash, row_hash, hash_v, payload_digest[, meta_enc]
+_VERIFY_COLS = (ActivityLog.id, ActivityLog.ts, ActivityLog.event, ActivityLog.prev_hash,
+                ActivityLog.row_hash, ActivityLog.hash_v, ActivityLog.payload_digest)
+
+def _check_activity_row(user_id: int, row, txt: str | None, prev: str | None) -> str | None:
+    """Failure reason for one row given the expected prev hash, or None.
+    txt is the decrypted meta, or None when verifying without keys."""
+    rid, ts, event, prev_hash, row_hash, hash_v, digest = row[:7]
+    if prev_hash != (prev or None):
+        return "prev_hash mismatch"
+    if txt == "" and row[7]:
+        return "meta unreadable"   # data key missing or destroyed
+    if hash_v == HASH_V2:
+        if row_hash != ActivityLog.compute_hash_v2(user_id=user_id, ts=ts, event=event,
+                                                   payload_digest=digest, prev_hash=prev):
+            return "row_hash mismatch"
+        if txt is not None and not payload_digest_matches(_meta_canon(_parse_meta(txt)), digest):
+            return "payload_digest mismatch"
+        return None
+    if txt is None:
+        return "legacy row needs key"   # v1 hashes cover plaintext; see migrate_chain_digests.py
+    fields = dict(user_id=user_id, event=event, meta=_parse_meta(txt), prev_hash=prev)
+    if (row_hash != ActivityLog.compute_hash_plain(ts=ts, **fields)
+            and row_hash != ActivityLog.compute_hash_plain(ts=None, **fields)):
+        # (ts=None: rows appended before ts was set ahead of hashing)
+        return "row_hash mismatch"
+    return None
+
+def verify_chain(user_id: int, full: bool = False, progress=None, checkpoint: bool = True,
+                 keyless: bool = False):
+    """
+    Verify a user's chain. By default resumes from the stored checkpoint and
+    only hashes rows appended since; full=True re-checks from genesis.
+    Rows are streamed in batches as plain column tuples (no ORM objects), so
+    memory stays flat; progress(info) is called after every batch.
+    A successful run moves the checkpoint to the newest row unless
+    checkpoint=False (read-only callers save it themselves from last_id /
+    last_hash, see verify_chains.py).
+
+    keyless=True checks continuity over prev_hash/row_hash/payload_digest
+    only: no data key, no decryption. It can't vouch for the ciphertext
+    itself, so it never moves the checkpoint; v1 rows fail it until
+    migrated.
+    """
+    start_id, expected_prev, count = 0, None, 0
+    if not full:
+        cp, broken = load_checkpoint(CHAIN_ACTIVITY, user_id, ActivityLog, ActivityLog.user_id)
+        if broken:
+            return False, broken
+        if cp:
+            start_id, expected_prev, count = cp
+
+    dek = None if keyless else get_data_key(user_id)
+    tracker = VerifyProgress(progress, CHAIN_ACTIVITY, user_id)
+    last_id = None
+    cols = _VERIFY_COLS if keyless else _VERIFY_COLS + (ActivityLog.meta_enc,)
+    with closing(stream_chain(cols, ActivityLog.user_id, user_id, start_id)) as batches:
+        for batch in batches:
+            if keyless:
+                texts = [None] * len(batch)
+            else:
+                texts = decrypt_many([b[7] for b in batch], [dek] * len(batch))
+            for row, txt in zip(batch, texts):
+                reason = _check_activity_row(user_id, row, txt, expected_prev)
+                if reason:
+                    return False, {"id": row[0], "reason": reason, "count": count}
+                expected_prev = row[4]
+                count += 1
+                last_id = row[0]
+            tracker.batch_done(len(batch), count, last_id)
+
+    if last_id is not None and checkpoint and not keyless:
+        save_checkpoint(CHAIN_ACTIVITY, user_id, last_id, expected_prev, count)
+    return True, {"count": count, "checked": tracker.checked, "from_id": start_id,
+                  "last_id": last_id, "last_hash": expected_prev}
+
+def reseal_activity_chain(user_id: int):
+    """
+    Migrate a user's chain to v2 hashes (see models_chain.reseal_chain). Every
+    row is verified the v1 way first; a chain that doesn't verify is left as is.
+    """
+    dek = get_data_key(user_id)
+
+    def prepare(batch):
+        return decrypt_many([b[7] for b in batch], [dek] * len(batch))
+
+    def reseal_row(row, txt, old_prev, new_prev):
+        reason = _check_activity_row(user_id, row, txt, old_prev)
+        if reason:
+            return reason, None
+        digest = payload_digest(_meta_canon(_parse_meta(txt)))
+        return None, {
+            "_old_hash": row[4], "prev_hash": new_prev, "payload_digest": digest, "hash_v": HASH_V2,
+            "row_hash": ActivityLog.compute_hash_v2(user_id=user_id, ts=row[1], event=row[2],
+                                                    payload_digest=digest, prev_hash=new_prev),
+        }
+
+    return reseal_chain(CHAIN_ACTIVITY, user_id, ActivityLog, ActivityLog.user_id,
+                        _VERIFY_COLS + (ActivityLog.meta_enc,), prepare, reseal_row)
 
 # ---------- Encrypted profile ----------
 class UserProfile(db.Model):
@@ -114,8 +281,9 @@ class UserProfile(db.Model):
 
     @property
     def phone(self) -> str:
-        return f_decrypt(self.encrypted_phone or b"")
+        ct = self.encrypted_phone or b""
+        return f_decrypt(ct, dek=data_key_for(self.user_id, ct))
 
     @phone.setter
     def phone(self, value: str):
-        self.encrypted_phone = f_encrypt(value or "")
+        self.encrypted_phone = f_encrypt(value or "", dek=get_data_key(self.user_id, create=True))
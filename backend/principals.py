@@ -0,0 +1,126 @@
+# principals.py
+"""
+Cache of authenticated principals (id, email, role) for require_auth, so a
+page load that makes several API calls doesn't look the user up each time.
+
+Entries expire after PRINCIPAL_CACHE_TTL_SECONDS. Changes must show up at
+once, in every gunicorn worker, so each user id also maps to a counter
+slot in a small file that all workers mmap (PRINCIPAL_EPOCH_FILE). An
+entry remembers its slot's value from when it was loaded. invalidate()
+bumps the slot after the change is committed, and every worker's next
+lookup then misses. Checking a slot is one read of shared memory. Users
+sharing a slot only cost each other an extra miss.
+"""
+import mmap
+import os
+import struct
+import threading
+import time
+from collections import OrderedDict
+from typing import NamedTuple
+
+PRINCIPAL_CACHE_SIZE = int(os.getenv("PRINCIPAL_CACHE_SIZE", "4096"))
+PRINCIPAL_CACHE_TTL_SECONDS = float(os.getenv("PRINCIPAL_CACHE_TTL_SECONDS", "30"))
+PRINCIPAL_EPOCH_FILE = os.getenv(
+    "PRINCIPAL_EPOCH_FILE",
+    os.path.join(os.path.dirname(os.path.abspath(__file__)), "principal_epochs.bin"),
+)
+EPOCH_SLOTS = 4096
+_SLOT = struct.Struct("<Q")
+
+
+class Principal(NamedTuple):
+    id: int
+    email: str
+    role: str
+
+
+class _EpochTable:
+    """Per-user change counters in a MAP_SHARED file; mapped on first use."""
+
+    def __init__(self, path: str, slots: int):
+        self.path = path
+        self.slots = slots
+        self._mm = None
+        self._lock = threading.Lock()
+
+    def _map(self) -> mmap.mmap:
+        if self._mm is None:
+            with self._lock:
+                if self._mm is None:
+                    size = self.slots * _SLOT.size
+                    fd = os.open(self.path, os.O_RDWR | os.O_CREAT, 0o600)
+                    try:
+                        if os.fstat(fd).st_size < size:
+                            os.ftruncate(fd, size)   # new slots read as zero
+                        self._mm = mmap.mmap(fd, size)
+                    finally:
+                        os.close(fd)
+        return self._mm
+
+    def get(self, user_id: int) -> int:
+        return _SLOT.unpack_from(self._map(), (user_id % self.slots) * _SLOT.size)[0]
+
+    def bump(self, user_id: int):
+        # read-add-write isn't atomic across processes, but two racing bumps
+        # still move the slot past every value cached before either of them
+        mm = self._map()
+        offset = (user_id % self.slots) * _SLOT.size
+        with self._lock:
+            _SLOT.pack_into(mm, offset, (_SLOT.unpack_from(mm, offset)[0] + 1) % (1 << 64))
+
+
+class _PrincipalCache:
+    """Thread-safe LRU: user_id -> (Principal, epoch, expires_at)."""
+
+    def __init__(self, size: int, ttl: float, epochs: _EpochTable):
+        self.size = size
+        self.ttl = ttl
+        self.epochs = epochs
+        self.hits = 0
+        self.misses = 0
+        self._items: OrderedDict[int, tuple[Principal, int, float]] = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, user_id: int, load) -> Principal | None:
+        """The cached principal, or load(user_id) (None: no such user, not cached)."""
+        epoch = self.epochs.get(user_id)   # read before loading: a later bump must invalidate
+        with self._lock:
+            hit = self._items.get(user_id)
+            if hit is not None and hit[1] == epoch and hit[2] > time.monotonic():
+                self._items.move_to_end(user_id)
+                self.hits += 1
+                return hit[0]
+            self.misses += 1
+        principal = load(user_id)
+        if principal is not None:
+            with self._lock:
+                self._items[user_id] = (principal, epoch, time.monotonic() + self.ttl)
+                self._items.move_to_end(user_id)
+                while len(self._items) > self.size:
+                    self._items.popitem(last=False)
+        return principal
+
+    def invalidate(self, user_id: int):
+        self.epochs.bump(user_id)
+        with self._lock:
+            self._items.pop(user_id, None)
+
+    def clear(self):
+        with self._lock:
+            self._items.clear()
+
+
+_cache = _PrincipalCache(PRINCIPAL_CACHE_SIZE, PRINCIPAL_CACHE_TTL_SECONDS,
+                         _EpochTable(PRINCIPAL_EPOCH_FILE, EPOCH_SLOTS))
+
+
+def get_principal(user_id: int, load) -> Principal | None:
+    if PRINCIPAL_CACHE_TTL_SECONDS <= 0:
+        return load(user_id)
+    return _cache.get(user_id, load)
+
+
+def invalidate(user_id: int):
+    """Call after committing a change to the user's email, role or password."""
+    _cache.invalidate(user_id)
@@ -0,0 +1,174 @@
+# reencrypt.py
+"""
+Online re-encryption after a DATA_KEY rotation.
+
+Put the new key in DATA_KEY (old one in DATA_KEYS_RETIRED, or on the second
+line of DATA_KEYRING_FILE), then run:
+
+    python reencrypt.py [--batch 500] [--pause-ms 20] [--restart]
+
+With envelope encryption a rotation only has to rewrap user_data_keys.
+Data columns are still walked so rows written before envelope encryption
+(sealed directly under the master key) get moved under their owner's data
+key; rows already sealed under a data key are skipped.
+
+Each column is walked in primary-key order, one small batch per
+transaction, so gunicorn workers only ever wait for a single short commit.
+Progress is checkpointed in the same transaction as the batch, so an
+interrupted run resumes where it stopped. Only ciphertext bytes change: the
+plaintext is decrypted and re-encrypted as-is, so ActivityLog and
+AdminActivityLog hash chains (computed over plaintext) stay valid.
+"""
+import argparse
+import time
+from datetime import datetime
+
+from cryptography.fernet import InvalidToken
+from sqlalchemy import text
+
+from db import db
+from crypto_utils import get_keyring, is_dek_sealed
+from models_keys import UserDataKey, get_data_key
+
+# (table, column, owner column). Rows are resealed under the owner's data
+# key; owner None means the column itself holds master-wrapped keys. Names
+# are fixed here, never taken from user input, so interpolating them into
+# SQL is safe.
+TARGETS = [
+    ("user_data_keys", "wrapped_key", None),
+    ("activity_log", "meta_enc", "user_id"),
+    ("admin_activity_log", "meta_enc", "admin_id"),
+    ("admin_activity_log", "justification_enc", "admin_id"),
+    ("user_profile", "encrypted_phone", "user_id"),
+]
+
+
+class ReencryptCheckpoint(db.Model):
+    __tablename__ = "reencrypt_checkpoints"
+    table_name  = db.Column(db.String(64), primary_key=True)
+    column_name = db.Column(db.String(64), primary_key=True)
+    target_kid  = db.Column(db.String(16), nullable=False)
+    last_id     = db.Column(db.Integer, nullable=False, default=0)
+    rewritten   = db.Column(db.Integer, nullable=False, default=0)
+    updated_at  = db.Column(db.DateTime, default=datetime.utcnow, onupdate=datetime.utcnow)
+
+
+def _checkpoint(table: str, column: str, target_kid: str, restart: bool) -> ReencryptCheckpoint:
+    cp = db.session.get(ReencryptCheckpoint, (table, column))
+    if cp is None:
+        cp = ReencryptCheckpoint(table_name=table, column_name=column, target_kid=target_kid,
+                                 last_id=0, rewritten=0)
+        db.session.add(cp)
+    elif restart or cp.target_kid != target_kid:
+        # A different active key means a new rotation: start from the top.
+        cp.target_kid, cp.last_id, cp.rewritten = target_kid, 0, 0
+    db.session.commit()
+    return cp
+
+
+def reencrypt_column(table: str, column: str, owner: str | None = None, *, batch_size: int = 500,
+                     pause: float = 0.0, restart: bool = False, progress=None) -> dict:
+    """
+    Re-encrypt one column: under the owner's data key when owner is given,
+    otherwise under the active master key. Returns stats:
+    scanned / rewritten / skipped (already current or empty) / unreadable.
+    """
+    ring = get_keyring()
+    active = ring.active_kid
+    cp = _checkpoint(table, column, active, restart)
+    last_id = cp.last_id
+
+    pk = "user_id" if owner is None else "id"
+    owner_col = owner or pk
+    select_sql = text(
+        f"SELECT {pk}, {owner_col}, {column} FROM {table} WHERE {pk} > :last ORDER BY {pk} LIMIT :n"
+    )
+    # Compare-and-set on the old ciphertext: a row rewritten by a request in
+    # the meantime is left alone (it is already under the current key).
+    update_sql = text(
+        f"UPDATE {table} SET {column} = :new WHERE {pk} = :id AND {column} = :old"
+    )
+
+    stats = {"table": table, "column": column, "scanned": 0, "rewritten": 0,
+             "skipped": 0, "unreadable": 0}
+    started = time.monotonic()
+
+    while True:
+        rows = db.session.execute(select_sql, {"last": last_id, "n": batch_size}).all()
+        if not rows:
+            break
+
+        updates = []
+        for rid, owner_id, ct in rows:
+            if not ct or is_dek_sealed(ct) or (owner is None and ring.token_kid(ct) == active):
+                stats["skipped"] += 1
+                continue
+            try:
+                raw = ring.decrypt(ct)
+            except InvalidToken:
+                stats["unreadable"] += 1
+                continue
+            if owner is None:
+                new = ring.encrypt(raw)
+            else:
+                dek = get_data_key(owner_id, create=True)
+                if dek is None:
+                    stats["unreadable"] += 1
+                    continue
+                new = dek.encrypt(raw)
+            updates.append({"id": rid, "old": ct, "new": new})
+
+        if updates:
+            db.session.execute(update_sql, updates)
+        last_id = rows[-1][0]
+        cp.last_id = last_id
+        cp.rewritten += len(updates)
+        db.session.commit()   # one short write transaction per batch
+
+        stats["scanned"] += len(rows)
+        stats["rewritten"] += len(updates)
+        if progress:
+            elapsed = max(time.monotonic() - started, 1e-9)
+            progress({**stats, "last_id": last_id, "rows_per_sec": stats["scanned"] / elapsed})
+        if pause:
+            time.sleep(pause)
+
+    stats["seconds"] = round(time.monotonic() - started, 3)
+    return stats
+
+
+def run(*, batch_size: int = 500, pause: float = 0.0, restart: bool = False, progress=None) -> list[dict]:
+    for model in (ReencryptCheckpoint, UserDataKey):
+        model.__table__.create(bind=db.engine, checkfirst=True)
+    return [
+        reencrypt_column(table, column, owner, batch_size=batch_size, pause=pause,
+                         restart=restart, progress=progress)
+        for table, column, owner in TARGETS
+    ]
+
+
+def _print_progress(p: dict):
+    print(f"  {p['table']}.{p['column']}: id<={p['last_id']} scanned={p['scanned']} "
+          f"rewritten={p['rewritten']} unreadable={p['unreadable']} "
+          f"({p['rows_per_sec']:.0f} rows/s)")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Re-encrypt stored data under the active DATA_KEY.")
+    parser.add_argument("--batch", type=int, default=500, help="rows per transaction")
+    parser.add_argument("--pause-ms", type=int, default=20, help="sleep between batches")
+    parser.add_argument("--restart", action="store_true", help="ignore saved checkpoints")
+    args = parser.parse_args()
+
+    from main import app  # reuse app & db bindings
+    with app.app_context():
+        print(f"Active key id: {get_keyring().active_kid}")
+        for s in run(batch_size=args.batch, pause=args.pause_ms / 1000.0,
+                     restart=args.restart, progress=_print_progress):
+            rate = s["scanned"] / s["seconds"] if s["seconds"] else 0.0
+            print(f"[OK] {s['table']}.{s['column']}: scanned={s['scanned']} rewritten={s['rewritten']} "
+                  f"skipped={s['skipped']} unreadable={s['unreadable']} in {s['seconds']}s ({rate:.0f} rows/s)")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,105 @@
+# refresh_purge.py
+"""
+Delete dead refresh_tokens rows. Every /verify-otp, /admin/verify-otp and
+/refresh inserts one, and revoking only flags it, so the table (and its
+unique token_hash index) otherwise grows forever. Run from cron, or keep
+it running:
+
+    python refresh_purge.py [--retention-days N] [--batch 500] [--every SECONDS]
+
+A row goes once it has expired, or once it has been revoked for longer than
+the retention period (REFRESH_REVOKED_RETENTION_DAYS, default 3). Until
+then a replayed revoked token is still recognised as one. Retention of
+REFRESH_EXP_DAYS or more keeps every revoked row until it expires. Rows
+revoked before revoked_at existed have none and go when they expire.
+
+Both conditions are index range scans (expires_at, revoked_at). Rows are
+deleted --batch at a time, each batch its own short write transaction,
+with --pause seconds between batches so request writes get the lock.
+"""
+import argparse
+import datetime
+import os
+import time
+
+from sqlalchemy import delete, func, select, text
+
+from db import db, begin_immediate
+from auth import RefreshToken, REFRESH_EXP_DAYS
+
+REVOKED_RETENTION_DAYS = float(os.getenv("REFRESH_REVOKED_RETENTION_DAYS", "3"))
+
+
+def _delete_batch(cond, batch: int) -> int:
+    t = RefreshToken.__table__
+    begin_immediate(db.session)
+    try:
+        ids = select(t.c.id).where(cond).limit(batch).scalar_subquery()
+        deleted = db.session.execute(delete(t).where(t.c.id.in_(ids))).rowcount
+        db.session.commit()
+        return deleted
+    except Exception:
+        db.session.rollback()
+        raise
+
+
+def purge(retention_days: float = REVOKED_RETENTION_DAYS, batch: int = 500,
+          pause: float = 0.01) -> dict:
+    """Delete expired and long-revoked tokens; counts per reason plus timings."""
+    t = RefreshToken.__table__
+    now = datetime.datetime.utcnow()
+    reasons = {
+        "expired": t.c.expires_at < now,
+        "revoked": t.c.revoked_at < now - datetime.timedelta(days=retention_days),
+    }
+    stats = {"expired": 0, "revoked": 0, "batches": 0, "max_batch_ms": 0.0}
+    t0 = time.monotonic()
+    for reason, cond in reasons.items():
+        while True:
+            b0 = time.monotonic()
+            n = _delete_batch(cond, batch)
+            if not n:
+                break
+            stats[reason] += n
+            stats["batches"] += 1
+            stats["max_batch_ms"] = max(stats["max_batch_ms"], (time.monotonic() - b0) * 1000)
+            if n < batch:
+                break
+            time.sleep(pause)
+    stats["seconds"] = time.monotonic() - t0
+    stats["remaining"] = db.session.execute(select(func.count()).select_from(t)).scalar()
+    stats["free_pages"] = db.session.execute(text("PRAGMA freelist_count")).scalar()
+    db.session.rollback()
+    return stats
+
+
+def run(retention_days: float, batch: int, pause: float) -> dict:
+    s = purge(retention_days, batch, pause)
+    print(f"[OK] reclaimed {s['expired'] + s['revoked']} refresh tokens "
+          f"({s['expired']} expired, {s['revoked']} revoked > {retention_days:g}d) "
+          f"in {s['batches']} batches, {s['seconds']:.2f}s, longest batch {s['max_batch_ms']:.1f}ms; "
+          f"{s['remaining']} left, {s['free_pages']} free pages")
+    return s
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Purge expired and revoked refresh tokens.")
+    parser.add_argument("--retention-days", type=float, default=REVOKED_RETENTION_DAYS,
+                        help=f"keep revoked tokens this long for reuse detection "
+                             f"(>= {REFRESH_EXP_DAYS}: until they expire)")
+    parser.add_argument("--batch", type=int, default=500, help="rows per write transaction")
+    parser.add_argument("--pause", type=float, default=0.01, help="seconds between batches")
+    parser.add_argument("--every", type=float, default=0, help="repeat every N seconds (0: once)")
+    args = parser.parse_args()
+
+    from main import app  # reuse app & db bindings
+    with app.app_context():
+        while True:
+            run(args.retention_days, args.batch, args.pause)
+            if not args.every:
+                break
+            time.sleep(args.every)
+
+
+if __name__ == "__main__":
+    main()
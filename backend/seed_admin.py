@@ -6,7 +6,8 @@ import pyotp
 
 from flask import Flask
 from db import db
-from auth import UserModel
+from auth import UserModel, email_matches
+from passwords import gensalt
 from main import app  # reuse app & db bindings
 
 def main():
@@ -22,7 +23,7 @@ def main():
             print("No email provided.")
             return
 
-        existing = UserModel.query.filter_by(email=email).first()
+        existing = UserModel.query.filter(email_matches(email)).first()
         if existing:
             print("User already exists; aborting.")
             return
@@ -32,7 +33,7 @@ def main():
             print("Password must be at least 8 chars.")
             return
 
-        hashed_pw = bcrypt.hashpw(pwd.encode("utf-8"), bcrypt.gensalt())
+        hashed_pw = bcrypt.hashpw(pwd.encode("utf-8"), gensalt())
         otp_secret = pyotp.random_base32()
 
         u = UserModel(email=email, password=hashed_pw, otp_secret=otp_secret, role='admin')
@@ -0,0 +1,119 @@
+# tests/test_chain_fork.py
+"""
+Concurrent appends from several processes (and threads in each) must never
+fork a hash chain: every row's prev_hash is unique and the chain verifies.
+Also: losing a head CAS must not drop the caller's pending changes.
+
+    python -m pytest -q backend/tests
+"""
+import multiprocessing
+import os
+import sys
+import threading
+
+import pytest
+from cryptography.fernet import Fernet
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+os.environ.setdefault("DATA_KEY", Fernet.generate_key().decode())
+
+PROCS, THREADS, APPENDS = 3, 4, 15
+USER_ID, ADMIN_ID = 1, 2
+
+
+@pytest.fixture(autouse=True)
+def _fresh_key_cache():
+    """Each test has its own database; keys cached for the last one's user ids would be wrong."""
+    import models_keys
+    models_keys._cache.evict()
+    yield
+    models_keys._cache.evict()
+
+
+def _app(path: str):
+    from flask import Flask
+    from db import db
+    import auth, models_admin, models_privacy, models_keys, models_merkle  # noqa: F401  (register tables)
+
+    app = Flask("test")
+    app.config["SQLALCHEMY_DATABASE_URI"] = f"sqlite:///{path}"
+    app.config["SQLALCHEMY_TRACK_MODIFICATIONS"] = False
+    db.init_app(app)
+    with app.app_context():
+        db.create_all()
+    return app
+
+
+def _append_worker(path: str, data_key: str, group_commit: bool):
+    os.environ["DATA_KEY"] = data_key
+    os.environ["AUDIT_GROUP_COMMIT"] = "1" if group_commit else "0"
+    app = _app(path)
+    from models_privacy import append_activity
+    from models_admin import append_admin_activity
+
+    def run(t):
+        with app.app_context():
+            for i in range(APPENDS):
+                append_activity(USER_ID, "FORK_TEST", {"pid": os.getpid(), "t": t, "i": i})
+                append_admin_activity(ADMIN_ID, "FORK_TEST", meta={"pid": os.getpid(), "t": t, "i": i})
+
+    pool = [threading.Thread(target=run, args=(t,)) for t in range(THREADS)]
+    for th in pool:
+        th.start()
+    for th in pool:
+        th.join()
+
+
+@pytest.mark.parametrize("group_commit", [True, False], ids=["group-commit", "direct"])
+def test_concurrent_appends_never_fork(tmp_path, group_commit):
+    path = str(tmp_path / "chains.db")
+    app = _app(path)
+    ctx = multiprocessing.get_context("spawn")
+    procs = [ctx.Process(target=_append_worker, args=(path, os.environ["DATA_KEY"], group_commit))
+             for _ in range(PROCS)]
+    for p in procs:
+        p.start()
+    for p in procs:
+        p.join(120)
+        assert p.exitcode == 0
+
+    from db import db
+    from models_privacy import ActivityLog, verify_chain
+    from models_admin import AdminActivityLog, verify_admin_chain
+    expected = PROCS * THREADS * APPENDS
+    with app.app_context():
+        for model, owner_col, owner, verify in (
+            (ActivityLog, ActivityLog.user_id, USER_ID, verify_chain),
+            (AdminActivityLog, AdminActivityLog.admin_id, ADMIN_ID, verify_admin_chain),
+        ):
+            prevs = [p for (p,) in db.session.query(model.prev_hash).filter(owner_col == owner)]
+            assert len(prevs) == expected
+            assert len(set(prevs)) == len(prevs), "two rows share a prev_hash: the chain forked"
+            ok, info = verify(owner, full=True)
+            assert ok, info
+
+
+def test_lost_cas_keeps_pending_changes(tmp_path, monkeypatch):
+    import models_chain
+    from db import db
+    from auth import UserModel
+    from models_admin import AdminActivityLog, _admin_entry, _prepare_admin_activity
+
+    app = _app(str(tmp_path / "cas.db"))
+    real = models_chain._advance_head
+    calls = []
+
+    def lose_first(*args):
+        calls.append(args)
+        return len(calls) > 1 and real(*args)
+
+    monkeypatch.setattr(models_chain, "_advance_head", lose_first)
+    with app.app_context():
+        db.session.add(UserModel(email="pending@example.com", password=b"x", otp_secret="A" * 16))
+        ts, target_id, meta_enc, just_enc, digest = _prepare_admin_activity(ADMIN_ID, None, {}, None)
+        entry = _admin_entry(ADMIN_ID, ts, "CAS_TEST", None, target_id, meta_enc, just_enc, digest)
+        models_chain.append_batch([entry])
+        assert len(calls) == 2
+        db.session.remove()
+        assert UserModel.query.filter_by(email="pending@example.com").count() == 1
+        assert AdminActivityLog.query.count() == 1
@@ -0,0 +1,75 @@
+# tests/test_data_keys.py
+"""
+A user's first data key, created inside the caller's write transaction, is
+never cached before that transaction commits: a rollback must not leave a
+cached key that has no row.
+
+    python -m pytest -q backend/tests
+"""
+import os
+import sys
+
+import pytest
+from cryptography.fernet import Fernet
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+os.environ.setdefault("DATA_KEY", Fernet.generate_key().decode())
+
+USER_ID = 1
+
+
+@pytest.fixture(autouse=True)
+def _fresh_key_cache():
+    """Each test has its own database; keys cached for the last one's user ids would be wrong."""
+    import models_keys
+    models_keys._cache.evict()
+    yield
+    models_keys._cache.evict()
+
+
+def _app(path: str):
+    from flask import Flask
+    from db import db
+    import auth, models_admin, models_privacy, models_keys, models_merkle  # noqa: F401  (register tables)
+
+    app = Flask("test")
+    app.config["SQLALCHEMY_DATABASE_URI"] = f"sqlite:///{path}"
+    app.config["SQLALCHEMY_TRACK_MODIFICATIONS"] = False
+    db.init_app(app)
+    with app.app_context():
+        db.create_all()
+    return app
+
+
+@pytest.mark.parametrize("second_read", ["get", "preload"])
+def test_rolled_back_key_is_not_cached(tmp_path, second_read):
+    from db import db, begin_immediate
+    from models_keys import UserDataKey, _cache, get_data_key, preload_data_keys
+
+    app = _app(str(tmp_path / "keys.db"))
+    with app.app_context():
+        begin_immediate(db.session)
+        created = get_data_key(USER_ID, create=True)
+        # read again in the same transaction: sees the uncommitted row
+        again = get_data_key(USER_ID) if second_read == "get" else preload_data_keys([USER_ID])[USER_ID]
+        assert again.raw == created.raw
+        assert _cache.get(USER_ID) is None
+        db.session.rollback()
+
+        assert _cache.get(USER_ID) is None
+        assert get_data_key(USER_ID) is None
+        assert db.session.get(UserDataKey, USER_ID) is None
+
+
+def test_committed_key_is_cached_on_next_read(tmp_path):
+    from db import db, begin_immediate
+    from models_keys import _cache, get_data_key
+
+    app = _app(str(tmp_path / "keys.db"))
+    with app.app_context():
+        begin_immediate(db.session)
+        created = get_data_key(USER_ID, create=True)
+        db.session.commit()
+        assert _cache.get(USER_ID) is None
+        assert get_data_key(USER_ID).raw == created.raw
+        assert _cache.get(USER_ID).raw == created.raw
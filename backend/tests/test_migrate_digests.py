@@ -0,0 +1,137 @@
+# tests/test_migrate_digests.py
+"""
+migrate_chain_digests re-seals v1 chains with v2 hashes: the rewrite must be
+committed (read back from a fresh session), verify, and leave the head and
+checkpoint on the new hashes. Also: save_checkpoint, which reseal_chain calls
+with the write lock held, commits or rolls back with such a caller.
+
+    python -m pytest -q backend/tests
+"""
+import os
+import sys
+from datetime import datetime, timedelta
+
+import pytest
+from cryptography.fernet import Fernet
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+os.environ.setdefault("DATA_KEY", Fernet.generate_key().decode())
+
+USER_ID, ADMIN_ID, ROWS = 1, 2, 5
+
+
+@pytest.fixture(autouse=True)
+def _fresh_key_cache():
+    """Each test has its own database; keys cached for the last one's user ids would be wrong."""
+    import models_keys
+    models_keys._cache.evict()
+    yield
+    models_keys._cache.evict()
+
+
+def _app(path: str):
+    from flask import Flask
+    from db import db
+    import auth, models_admin, models_privacy, models_keys, models_merkle  # noqa: F401  (register tables)
+
+    app = Flask("test")
+    app.config["SQLALCHEMY_DATABASE_URI"] = f"sqlite:///{path}"
+    app.config["SQLALCHEMY_TRACK_MODIFICATIONS"] = False
+    db.init_app(app)
+    with app.app_context():
+        db.create_all()
+    return app
+
+
+def _write_v1_chains():
+    """ROWS v1 rows (hash over the plaintext, hash_v NULL) on one activity and one admin chain."""
+    from db import db
+    from crypto_utils import f_encrypt
+    from models_keys import get_data_key
+    from models_privacy import ActivityLog
+    from models_admin import AdminActivityLog, _json_canon
+
+    ts0 = datetime.utcnow().replace(microsecond=0)
+    prev = None
+    for i in range(ROWS):
+        row = ActivityLog(user_id=USER_ID, ts=ts0 + timedelta(seconds=i), event="V1", prev_hash=prev)
+        row.meta = {"i": i}
+        row.row_hash = row.compute_hash(prev)
+        db.session.add(row)
+        prev = row.row_hash
+
+    dek = get_data_key(ADMIN_ID, create=True)
+    prev = None
+    for i in range(ROWS):
+        ts, meta_json = ts0 + timedelta(seconds=i), _json_canon({"i": i})
+        row_hash = AdminActivityLog.compute_hash_plain(
+            admin_id=ADMIN_ID, ts=ts, action="V1", target_type="user", target_id=str(i),
+            meta_json=meta_json, justification_text="why", prev_hash=prev,
+        )
+        db.session.add(AdminActivityLog(
+            admin_id=ADMIN_ID, ts=ts, action="V1", target_type="user", target_id=str(i),
+            meta_enc=f_encrypt(meta_json, dek=dek), justification_enc=f_encrypt("why", dek=dek),
+            prev_hash=prev, row_hash=row_hash,
+        ))
+        prev = row_hash
+    db.session.commit()
+
+
+def test_migration_is_committed(tmp_path):
+    import migrate_chain_digests
+    from db import db
+    from models_chain import CHAIN_ACTIVITY, CHAIN_ADMIN, HASH_V2, ChainCheckpoint, ChainHead
+    from models_privacy import ActivityLog, verify_chain
+    from models_admin import AdminActivityLog, verify_admin_chain
+
+    app = _app(str(tmp_path / "reseal.db"))
+    with app.app_context():
+        _write_v1_chains()
+    with app.app_context():   # as main() does: the context ends right after run()
+        summary = migrate_chain_digests.run(["activity", "admin"])
+        assert summary["resealed"] == 2 and summary["rows"] == 2 * ROWS and not summary["failed"]
+
+    with app.app_context():
+        for model, owner_col, owner, chain, verify in (
+            (ActivityLog, ActivityLog.user_id, USER_ID, CHAIN_ACTIVITY, verify_chain),
+            (AdminActivityLog, AdminActivityLog.admin_id, ADMIN_ID, CHAIN_ADMIN, verify_admin_chain),
+        ):
+            rows = model.query.filter(owner_col == owner).order_by(model.id).all()
+            assert [r.hash_v for r in rows] == [HASH_V2] * ROWS
+            head = db.session.get(ChainHead, (chain, owner))
+            cp = db.session.get(ChainCheckpoint, (chain, owner))
+            assert (head.last_id, head.last_hash) == (rows[-1].id, rows[-1].row_hash)
+            assert (cp.last_id, cp.row_hash, cp.count) == (rows[-1].id, rows[-1].row_hash, ROWS)
+            ok, info = verify(owner, full=True, keyless=True)
+            assert ok, info
+            ok, info = verify(owner, full=True)
+            assert ok, info
+        assert migrate_chain_digests.run(["activity", "admin"])["skipped"] == 2
+
+
+def test_checkpoint_commits_with_the_caller_under_the_write_lock(tmp_path):
+    from db import db, begin_immediate
+    from auth import UserModel
+    from models_chain import CHAIN_ACTIVITY, ChainCheckpoint, save_checkpoint
+
+    app = _app(str(tmp_path / "cp.db"))
+    with app.app_context():
+        # no write lock: written on its own connection, the caller's pending row isn't committed
+        db.session.add(UserModel(email="pending@example.com", password=b"x", otp_secret="A" * 16))
+        save_checkpoint(CHAIN_ACTIVITY, USER_ID, 1, "a" * 64, 1)
+        db.session.rollback()
+        assert db.session.get(ChainCheckpoint, (CHAIN_ACTIVITY, USER_ID)).last_id == 1
+        assert UserModel.query.count() == 0
+
+        # write lock held: part of the caller's transaction, gone with its rollback...
+        begin_immediate(db.session)
+        save_checkpoint(CHAIN_ACTIVITY, USER_ID, 2, "b" * 64, 2)
+        db.session.rollback()
+        assert db.session.get(ChainCheckpoint, (CHAIN_ACTIVITY, USER_ID)).last_id == 1
+
+        # ...and kept by its commit
+        begin_immediate(db.session)
+        save_checkpoint(CHAIN_ACTIVITY, USER_ID, 2, "b" * 64, 2)
+        db.session.commit()
+    with app.app_context():
+        assert db.session.get(ChainCheckpoint, (CHAIN_ACTIVITY, USER_ID)).last_id == 2
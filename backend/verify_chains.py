@@ -0,0 +1,199 @@
+# verify_chains.py
+"""
+Nightly integrity check of every audit hash chain: each user's ActivityLog
+chain and each admin's AdminActivityLog chain.
+
+    python verify_chains.py [--workers N] [--full] [--keyless] [--chain activity|admin|all]
+                            [--db users.db] [--out report.json] [--no-checkpoint]
+
+Chain owners are spread over a process pool. Each worker opens its own
+read-only SQLite connection (file:...?mode=ro) so it never takes the write
+lock and can run next to gunicorn. Big chains are handed out first, so one
+long chain doesn't leave the other cores idle at the end.
+
+By default each chain resumes from its stored checkpoint (see
+models_chain.ChainCheckpoint); --full re-checks from genesis. Workers can't
+write, so the parent moves the checkpoints of healthy chains forward once
+the pool is done (skip with --no-checkpoint).
+
+--keyless checks continuity over the hash/digest columns only, without
+DATA_KEY or any decryption (v2 rows, see migrate_chain_digests.py). It
+never advances checkpoints.
+
+Prints a JSON report (or writes it to --out). Exit status is 1 if any chain
+is broken.
+"""
+import argparse
+import json
+import multiprocessing
+import os
+import sqlite3
+import sys
+import time
+from datetime import datetime
+
+DB_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), "users.db")
+
+# chain type -> (table, owner column)
+CHAINS = {
+    "activity": ("activity_log", "user_id"),
+    "admin": ("admin_activity_log", "admin_id"),
+}
+
+_app = None   # per-worker Flask app, bound read-only
+
+
+def _make_app(db_path: str, readonly: bool):
+    from flask import Flask
+    from db import db
+    import models_privacy, models_admin, models_keys, models_chain  # noqa: F401  (register tables)
+
+    app = Flask("verify_chains")
+    if readonly:
+        app.config["SQLALCHEMY_DATABASE_URI"] = f"sqlite:///file:{db_path}?mode=ro&uri=true"
+    else:
+        app.config["SQLALCHEMY_DATABASE_URI"] = f"sqlite:///{db_path}"
+    app.config["SQLALCHEMY_TRACK_MODIFICATIONS"] = False
+    db.init_app(app)
+    return app
+
+
+def _init_worker(db_path: str):
+    global _app
+    _app = _make_app(db_path, readonly=True)
+
+
+def _verify_one(task: tuple[str, int, bool, bool]) -> dict:
+    chain_type, owner_id, full, keyless = task
+    from models_privacy import verify_chain
+    from models_admin import verify_admin_chain
+    verify = verify_chain if chain_type == "activity" else verify_admin_chain
+
+    started = time.monotonic()
+    result = {"chain": chain_type, "owner_id": owner_id}
+    try:
+        with _app.app_context():
+            ok, info = verify(owner_id, full=full, checkpoint=False, keyless=keyless)
+    except Exception as e:   # one unreadable chain shouldn't sink the whole run
+        ok, info = False, {"reason": "error", "error": f"{type(e).__name__}: {e}"}
+    elapsed = time.monotonic() - started
+
+    result["ok"] = ok
+    result["seconds"] = round(elapsed, 3)
+    if ok:
+        result.update(count=info["count"], checked=info["checked"], from_id=info["from_id"],
+                      last_id=info["last_id"], last_hash=info["last_hash"])
+    else:
+        result.update(first_bad_id=info.get("id"), reason=info.get("reason"),
+                      count=info.get("count", 0), checked=info.get("count", 0), detail=info)
+    result["rows_per_sec"] = round(result["checked"] / elapsed, 1) if elapsed > 0 else None
+    return result
+
+
+def list_chains(db_path: str, kinds: list[str]) -> list[tuple[str, int, int]]:
+    """(chain type, owner id, row count) for every chain, largest first."""
+    conn = sqlite3.connect(f"file:{db_path}?mode=ro", uri=True)
+    try:
+        chains = []
+        for kind in kinds:
+            table, owner = CHAINS[kind]
+            try:
+                rows = conn.execute(f"SELECT {owner}, COUNT(*) FROM {table} GROUP BY {owner}").fetchall()
+            except sqlite3.OperationalError:   # table not created yet
+                rows = []
+            chains.extend((kind, owner_id, n) for owner_id, n in rows)
+    finally:
+        conn.close()
+    chains.sort(key=lambda c: c[2], reverse=True)
+    return chains
+
+
+def _save_checkpoints(db_path: str, results: list[dict]) -> int:
+    from models_chain import ChainCheckpoint, save_checkpoint
+    from db import db
+
+    app = _make_app(db_path, readonly=False)
+    saved = 0
+    with app.app_context():
+        ChainCheckpoint.__table__.create(bind=db.engine, checkfirst=True)
+        for r in results:
+            if r["ok"] and r["last_id"] is not None:
+                save_checkpoint(r["chain"], r["owner_id"], r["last_id"], r["last_hash"], r["count"])
+                saved += 1
+    return saved
+
+
+def run(db_path: str = DB_PATH, *, workers: int | None = None, full: bool = False,
+        kinds: list[str] | None = None, save: bool = True, keyless: bool = False) -> dict:
+    kinds = kinds or list(CHAINS)
+    workers = workers or os.cpu_count() or 1
+    chains = list_chains(db_path, kinds)
+    tasks = [(kind, owner_id, full, keyless) for kind, owner_id, _ in chains]
+
+    started = time.monotonic()
+    results = []
+    if tasks:
+        ctx = multiprocessing.get_context()
+        with ctx.Pool(min(workers, len(tasks)), initializer=_init_worker, initargs=(db_path,)) as pool:
+            # chunksize 1: tasks are sorted largest-first, keep them that way
+            for r in pool.imap_unordered(_verify_one, tasks, chunksize=1):
+                results.append(r)
+    elapsed = time.monotonic() - started
+
+    results.sort(key=lambda r: (r["chain"], r["owner_id"]))
+    broken = [r for r in results if not r["ok"]]
+    checked = sum(r["checked"] for r in results)
+    report = {
+        "db": db_path,
+        "started_at": datetime.utcnow().isoformat(timespec="seconds") + "Z",
+        "workers": workers,
+        "full": full,
+        "keyless": keyless,
+        "ok": not broken,
+        "chains": len(results),
+        "broken": len(broken),
+        "rows_checked": checked,
+        "seconds": round(elapsed, 3),
+        "rows_per_sec": round(checked / elapsed, 1) if elapsed > 0 else None,
+        "failures": [{k: r[k] for k in ("chain", "owner_id", "first_bad_id", "reason")} for r in broken],
+        "results": results,
+    }
+    if save and not keyless:
+        # healthy chains only; a broken chain keeps its last good checkpoint
+        report["checkpoints_saved"] = _save_checkpoints(db_path, results) if results else 0
+    return report
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Verify every audit hash chain on a process pool.")
+    parser.add_argument("--db", default=DB_PATH, help="SQLite file (default: users.db next to this script)")
+    parser.add_argument("--workers", type=int, default=None, help="processes (default: CPU count)")
+    parser.add_argument("--full", action="store_true", help="ignore checkpoints, verify from genesis")
+    parser.add_argument("--keyless", action="store_true", help="no decryption: hash/digest columns only")
+    parser.add_argument("--chain", choices=["activity", "admin", "all"], default="all")
+    parser.add_argument("--out", help="write the JSON report here instead of stdout")
+    parser.add_argument("--no-checkpoint", action="store_true", help="don't advance checkpoints")
+    args = parser.parse_args()
+
+    if not os.path.exists(args.db):
+        print(f"❌ Database file not found: {args.db}", file=sys.stderr)
+        sys.exit(2)
+
+    kinds = list(CHAINS) if args.chain == "all" else [args.chain]
+    report = run(os.path.abspath(args.db), workers=args.workers, full=args.full,
+                 kinds=kinds, save=not args.no_checkpoint, keyless=args.keyless)
+
+    out = json.dumps(report, indent=2, default=str)
+    if args.out:
+        with open(args.out, "w") as fh:
+            fh.write(out + "\n")
+    else:
+        print(out)
+    print(f"{'✅' if report['ok'] else '❌'} {report['chains']} chains, {report['broken']} broken, "
+          f"{report['rows_checked']} rows in {report['seconds']}s ({report['rows_per_sec']} rows/s)",
+          file=sys.stderr)
+    sys.exit(0 if report["ok"] else 1)
+
+
+if __name__ == "__main__":
+    main()
@@ -5,3 +5,10 @@ worker_class = "gthread"
 threads = 4
 timeout = 60
 preload_app = True
+
+
+def post_worker_init(worker):
+    # start the audit writer now, so outbox rows left by a crashed worker drain without waiting for traffic
+    import audit_writer
+    with worker.wsgi.app_context():
+        audit_writer.get_writer().kick()
@@ -0,0 +1,116 @@
+# limit_storage.py
+"""
+Flask-Limiter storage shared by every gunicorn worker on the host, without
+Redis: counters live in a small SQLite file of their own (WAL), so a limit
+means the same thing with 1 worker or 8 and survives restarts.
+
+    storage_uri="sqlite:////abs/path/rate_limits.db"   (importing this module registers "sqlite")
+
+A hit is one UPSERT ... RETURNING statement, so the read-modify-write is
+atomic across processes; an expired window restarts in the same statement.
+Commits skip fsync (synchronous=NORMAL, fine for counters). It is its own
+file so a busy limiter never waits on, or blocks, users.db writers.
+
+Flask-Limiter's strategies only need incr/get/get_expiry; this backs the
+default fixed-window strategy (no moving-window support).
+"""
+import os
+import random
+import sqlite3
+import threading
+import time
+from typing import Optional
+
+from limits.storage import Storage
+
+BUSY_TIMEOUT_MS = 5000
+SWEEP_EVERY = 1000   # ~1 in N hits also deletes expired windows
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS rate_limits (
+    key        TEXT PRIMARY KEY,
+    count      INTEGER NOT NULL,
+    expires_at REAL NOT NULL
+) WITHOUT ROWID
+"""
+
+_INCR = """
+INSERT INTO rate_limits (key, count, expires_at) VALUES (:key, :amount, :now + :expiry)
+ON CONFLICT (key) DO UPDATE SET
+    count      = CASE WHEN expires_at <= :now THEN :amount ELSE count + :amount END,
+    expires_at = CASE WHEN expires_at <= :now OR :elastic THEN :now + :expiry ELSE expires_at END
+RETURNING count
+"""
+
+
+class SQLiteStorage(Storage):
+    STORAGE_SCHEME = ["sqlite"]
+
+    def __init__(self, uri: str, wrap_exceptions: bool = False, **options):
+        super().__init__(uri, wrap_exceptions=wrap_exceptions, **options)
+        # sqlite:///relative.db or sqlite:////abs/path.db, as in SQLAlchemy URLs
+        self.path = uri.split("://", 1)[1][1:]
+        self._local = threading.local()
+        self._pid = None
+        self._conn()   # create the file and table up front
+
+    @property
+    def base_exceptions(self):
+        return sqlite3.Error
+
+    def _conn(self) -> sqlite3.Connection:
+        """One autocommit connection per thread; reopened after fork."""
+        if self._pid != os.getpid():
+            self._local = threading.local()
+            self._pid = os.getpid()
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            conn = sqlite3.connect(self.path, isolation_level=None, timeout=BUSY_TIMEOUT_MS / 1000)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            conn.execute(_SCHEMA)
+            self._local.conn = conn
+        return conn
+
+    def incr(self, key: str, expiry: int, elastic_expiry: bool = False, amount: int = 1) -> int:
+        conn = self._conn()
+        now = time.time()
+        rows = conn.execute(_INCR, {"key": key, "amount": amount, "now": now,
+                                    "expiry": expiry, "elastic": elastic_expiry}).fetchall()
+        if random.randrange(SWEEP_EVERY) == 0:
+            conn.execute("DELETE FROM rate_limits WHERE expires_at <= ?", (now,))
+        return rows[0][0]
+
+    def get(self, key: str) -> int:
+        row = self._conn().execute(
+            "SELECT count FROM rate_limits WHERE key = ? AND expires_at > ?", (key, time.time())
+        ).fetchone()
+        return row[0] if row else 0
+
+    def get_expiry(self, key: str) -> int:
+        row = self._conn().execute(
+            "SELECT expires_at FROM rate_limits WHERE key = ?", (key,)
+        ).fetchone()
+        return int(row[0] if row else time.time())
+
+    def check(self) -> bool:
+        try:
+            self._conn().execute("SELECT 1").fetchone()
+            return True
+        except sqlite3.Error:
+            return False
+
+    def reset(self) -> Optional[int]:
+        return self._conn().execute("DELETE FROM rate_limits").rowcount
+
+    def clear(self, key: str) -> None:
+        self._conn().execute("DELETE FROM rate_limits WHERE key = ?", (key,))
+
+    def top(self, n: int = 20) -> list[dict]:
+        """The n live windows with the highest counts (for tuning limits)."""
+        now = time.time()
+        rows = self._conn().execute(
+            "SELECT key, count, expires_at FROM rate_limits WHERE expires_at > ? "
+            "ORDER BY count DESC LIMIT ?", (now, n)
+        ).fetchall()
+        return [{"key": k, "count": c, "resets_in": round(e - now)} for k, c, e in rows]
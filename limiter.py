@@ -0,0 +1,146 @@
+# limiter.py
+"""
+Rate limits, weighted by what a request costs us.
+
+A budget is spent in cost units, not requests. Routes that run bcrypt
+cost COST_BCRYPT, sending an OTP COST_OTP_SEND, checking one
+COST_OTP_CHECK, anything else 1. Counters live in limit_storage's shared
+SQLite file, so they hold across gunicorn workers.
+
+  - /login, /register, /resend-otp and the /admin versions spend from
+    two budgets: one per account *and* client IP, charged only when the
+    request fails (4xx), and a larger one per IP charged on every
+    request. The first stops guessing at an account without letting
+    anyone lock its owner out from elsewhere, or throttling users behind
+    the same NAT; the second stops one host spraying many emails.
+    /verify-otp has its own per-account-and-IP budget, so wrong codes
+    don't eat into logins. Rejected requests never reach bcrypt, so with
+    passwords' bounded pool this caps bcrypt CPU.
+  - Authenticated routes are counted per user id (IP when there's no
+    valid token): DEFAULT_LIMIT per route, and routes that check the
+    password also spend from USER_BCRYPT_LIMIT.
+
+Limits are Flask-Limiter strings and can be set through the environment.
+GET /admin/limits (admin_audit) shows the configuration and the busiest
+counters.
+"""
+import os
+
+import jwt
+from flask import current_app, request
+from flask_limiter import Limiter
+from flask_limiter.util import get_remote_address
+
+import limit_storage
+import passwords
+from token_cache import verified_tokens
+
+BASE_DIR = os.path.abspath(os.path.dirname(__file__))
+STORAGE_URI = os.getenv("RATELIMIT_STORAGE_URI", f"sqlite:///{os.path.join(BASE_DIR, 'rate_limits.db')}")
+
+DEFAULT_LIMIT = os.getenv("RATELIMIT_DEFAULT", "200 per hour")
+ACCOUNT_LIMIT = os.getenv("RATELIMIT_ACCOUNT", "60 per 15 minutes")
+OTP_LIMIT = os.getenv("RATELIMIT_OTP", "30 per 15 minutes")
+AUTH_IP_LIMIT = os.getenv("RATELIMIT_AUTH_IP", "600 per 15 minutes")
+USER_BCRYPT_LIMIT = os.getenv("RATELIMIT_USER_BCRYPT", "100 per hour")
+
+COST_BCRYPT = 10
+COST_OTP_SEND = 5
+COST_OTP_CHECK = 3
+
+
+def _normalize(e) -> str:
+    # auth.normalize_email, which can't be imported here (auth imports this module)
+    return (e or "").strip().lower() if isinstance(e, str) else ""
+
+
+def ip_key() -> str:
+    return f"ip:{get_remote_address()}"
+
+
+def account_key() -> str:
+    """The account a login/OTP request is for, from this IP (just the IP if the body has no email)."""
+    email = _normalize((request.get_json(silent=True) or {}).get("email"))
+    return f"email:{email}|{ip_key()}" if email else ip_key()
+
+
+def _failed(response) -> bool:
+    return 400 <= response.status_code < 500
+
+
+def user_key() -> str:
+    """The caller's user id from a valid bearer token, else its IP."""
+    auth_header = request.headers.get("Authorization", "")
+    if auth_header.startswith("Bearer "):
+        try:
+            claims = verified_tokens.decode(auth_header.split(" ", 1)[1].strip(),
+                                            current_app.config["SECRET_KEY"])
+            if claims.get("user_id") is not None:
+                return f"user:{claims['user_id']}"
+        except jwt.InvalidTokenError:
+            pass
+    return ip_key()
+
+
+limiter = Limiter(
+    user_key,
+    default_limits=[DEFAULT_LIMIT],
+    storage_uri=STORAGE_URI,   # or "redis://localhost:6379/0"
+)
+
+# endpoint -> [(limit, scope, key, cost, charged)], for /admin/limits
+ROUTE_LIMITS: dict[str, list[tuple[str, str, str, int, str]]] = {}
+
+
+def _register(fn, limit: str, scope: str, key: str, cost: int, charged: str = "every request"):
+    ROUTE_LIMITS.setdefault(fn.__name__, []).append((limit, scope, key, cost, charged))
+
+
+def _auth_limited(limit: str, scope: str, cost: int):
+    def decorator(fn):
+        _register(fn, limit, scope, "email+ip", cost, "failures")
+        _register(fn, AUTH_IP_LIMIT, "auth-ip", "ip", cost)
+        fn = limiter.shared_limit(AUTH_IP_LIMIT, scope="auth-ip", key_func=ip_key, cost=cost)(fn)
+        return limiter.shared_limit(limit, scope=scope, key_func=account_key, cost=cost,
+                                    deduct_when=_failed)(fn)
+    return decorator
+
+
+def account_limited(cost: int):
+    """Failures spend cost from the account's budget at this IP; every call from the IP's auth budget."""
+    return _auth_limited(ACCOUNT_LIMIT, "auth-account", cost)
+
+
+def otp_limited(cost: int):
+    """As account_limited, but OTP checks have a budget of their own."""
+    return _auth_limited(OTP_LIMIT, "auth-otp", cost)
+
+
+def user_bcrypt_limited(cost: int = COST_BCRYPT):
+    """For authenticated routes that check the password: per-user budget on top of DEFAULT_LIMIT."""
+    def decorator(fn):
+        _register(fn, DEFAULT_LIMIT, fn.__name__, "user", 1)
+        _register(fn, USER_BCRYPT_LIMIT, "user-bcrypt", "user", cost)
+        fn = limiter.limit(DEFAULT_LIMIT, key_func=user_key)(fn)
+        return limiter.shared_limit(USER_BCRYPT_LIMIT, scope="user-bcrypt", key_func=user_key, cost=cost)(fn)
+    return decorator
+
+
+def state(top: int = 20) -> dict:
+    """Configuration, the fullest live counters (sqlite storage only) and this worker's bcrypt pool."""
+    storage = limiter.storage
+    counters = storage.top(top) if isinstance(storage, limit_storage.SQLiteStorage) else None
+    return {
+        "storage": STORAGE_URI.split("://", 1)[0],
+        "default": {"limit": DEFAULT_LIMIT, "key": "user", "cost": 1},
+        "costs": {"bcrypt": COST_BCRYPT, "otp_send": COST_OTP_SEND, "otp_check": COST_OTP_CHECK},
+        "routes": {
+            endpoint: [{"limit": l, "scope": s, "key": k, "cost": c, "charged": ch}
+                       for l, s, k, c, ch in limits]
+            for endpoint, limits in sorted(ROUTE_LIMITS.items())
+        },
+        "top": counters,
+        "bcrypt": {"pool_size": passwords.POOL_SIZE, "queue_max": passwords.QUEUE_MAX,
+                   "rejected": passwords.rejected, "deferred_max": passwords.DEFERRED_MAX,
+                   "deferred_dropped": passwords.dropped},
+    }
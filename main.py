@@ -5,10 +5,6 @@ from flask_cors import CORS
 from db import db  # shared SQLAlchemy instance
 from models_admin import AdminActivityLog  # ensure table gets created
 
-# NEW: Flask-Limiter
-from flask_limiter import Limiter
-from flask_limiter.util import get_remote_address
-
 app = Flask(__name__)
 
 # ---------- CORS ----------
@@ -29,13 +25,9 @@ app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = False
 
 db.init_app(app)
 
-# ---------- Rate Limiter (NEW) ----------
-limiter = Limiter(
-    get_remote_address,
-    app=app,
-    default_limits=["200 per hour"],   # global default; safe
-    storage_uri="memory://",           # swap to Redis in prod: "redis://localhost:6379/0"
-)
+# ---------- Rate Limiter (see limiter.py) ----------
+from limiter import limiter
+limiter.init_app(app)
 
 # Register blueprints AFTER init_app
 from auth import auth_bp
@@ -0,0 +1,87 @@
+# migrate_chain_digests.py
+"""
+Move existing audit chains to v2 hashes (keyed payload digests), so they can
+be verified without DATA_KEY: python verify_chains.py --keyless.
+
+    python migrate_chain_digests.py [--chain activity|admin|all] [--dry-run]
+
+Run ensure_tables.py first (adds the payload_digest / hash_v columns).
+Needs the data keys, since the digests are computed over the plaintext.
+
+Each chain is re-sealed in a single write transaction and only after every
+one of its rows verifies as stored, so tampering is never laundered into a
+fresh-looking chain; a chain that fails is reported and left untouched.
+Re-sealing changes every row_hash of the chain: run it before the first
+anchor_logs.py run (Merkle leaves keep the hashes they were anchored with)
+and export anything else that quotes old hashes first. Writers wait on the lock while
+a chain is rewritten, so schedule large installs in a quiet window.
+Chains already fully on v2 are skipped, so re-running is safe.
+"""
+import argparse
+import sys
+import time
+
+from sqlalchemy import func
+
+from db import db
+from models_chain import HASH_V2
+from models_privacy import ActivityLog, reseal_activity_chain
+from models_admin import AdminActivityLog, reseal_admin_chain
+
+# chain type -> (model, owner column, reseal function)
+CHAINS = {
+    "activity": (ActivityLog, ActivityLog.user_id, reseal_activity_chain),
+    "admin": (AdminActivityLog, AdminActivityLog.admin_id, reseal_admin_chain),
+}
+
+
+def pending_owners(model, owner_col) -> list[int]:
+    """Owners with at least one pre-v2 row."""
+    return list(db.session.execute(
+        db.select(owner_col)
+        .where((model.hash_v.is_(None)) | (model.hash_v != HASH_V2))
+        .group_by(owner_col)
+        .order_by(owner_col)
+    ).scalars())
+
+
+def run(kinds: list[str], dry_run: bool = False) -> dict:
+    summary = {"resealed": 0, "rows": 0, "failed": [], "skipped": 0}
+    for kind in kinds:
+        model, owner_col, reseal = CHAINS[kind]
+        owners = pending_owners(model, owner_col)
+        total = db.session.execute(db.select(func.count(func.distinct(owner_col)))).scalar()
+        summary["skipped"] += total - len(owners)
+        print(f"{kind}: {len(owners)} of {total} chains need re-sealing")
+        for owner_id in owners:
+            if dry_run:
+                continue
+            t0 = time.monotonic()
+            ok, info = reseal(owner_id)
+            if ok:
+                summary["resealed"] += 1
+                summary["rows"] += info["count"]
+                print(f"  [OK] {kind} {owner_id}: {info['count']} rows, "
+                      f"head {info['last_hash']} ({time.monotonic() - t0:.2f}s)")
+            else:
+                summary["failed"].append({"chain": kind, "owner_id": owner_id, **info})
+                print(f"  [FAIL] {kind} {owner_id}: {info['reason']} at id {info['id']} (left unchanged)")
+    return summary
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Re-seal audit chains with v2 (digest) hashes.")
+    parser.add_argument("--chain", choices=["activity", "admin", "all"], default="all")
+    parser.add_argument("--dry-run", action="store_true", help="only count chains that need it")
+    args = parser.parse_args()
+
+    from main import app  # reuse app & db bindings
+    with app.app_context():
+        s = run(list(CHAINS) if args.chain == "all" else [args.chain], dry_run=args.dry_run)
+    print(f"✅ re-sealed {s['resealed']} chains ({s['rows']} rows), {s['skipped']} already v2, "
+          f"{len(s['failed'])} failed verification")
+    sys.exit(1 if s["failed"] else 0)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,109 @@
+# migrate_email_norm.py
+"""
+Backfill users.email_norm (normalize_email(email)) for rows created before
+the column existed, so every login is an index lookup.
+
+    python migrate_email_norm.py [--batch 5000] [--dry-run]
+
+Run ensure_tables.py first (adds the column and its unique index). Until a
+row is backfilled it is still found, through a slower lower(email) match
+(see auth.email_matches), so the app can keep running meanwhile.
+
+Rows go in id order, one short write transaction per batch. A row whose
+normalized email already belongs to another user (addresses that differ
+only in case) is left NULL and reported; merge or rename those accounts
+by hand, then run this again. Re-running is safe: only NULL rows are
+touched.
+"""
+import argparse
+import sys
+
+from sqlalchemy import func
+
+from db import db, begin_immediate
+from auth import UserModel, normalize_email
+
+
+def backfill_batch(after_id: int, batch: int) -> tuple[int, int, list[dict]]:
+    """(last id seen, rows filled, conflicts) for the next batch of NULL rows after after_id."""
+    begin_immediate(db.session)
+    try:
+        rows = db.session.execute(
+            db.select(UserModel.id, UserModel.email)
+            .where(UserModel.email_norm.is_(None), UserModel.id > after_id)
+            .order_by(UserModel.id).limit(batch)
+        ).all()
+        if not rows:
+            db.session.rollback()
+            return after_id, 0, []
+
+        wanted = {}   # norm -> first id in this batch
+        conflicts = []
+        for user_id, email in rows:
+            norm = normalize_email(email)
+            if norm in wanted:
+                conflicts.append({"id": user_id, "email_norm": norm, "taken_by": wanted[norm]})
+            else:
+                wanted[norm] = user_id
+        taken = dict(db.session.execute(
+            db.select(UserModel.email_norm, UserModel.id).where(UserModel.email_norm.in_(list(wanted)))
+        ).all())
+        for norm, user_id in list(wanted.items()):
+            if norm in taken:
+                conflicts.append({"id": user_id, "email_norm": norm, "taken_by": taken[norm]})
+                del wanted[norm]
+
+        if wanted:
+            db.session.execute(
+                db.update(UserModel.__table__)
+                .where(UserModel.__table__.c.id == db.bindparam("uid"))
+                .values(email_norm=db.bindparam("norm")),
+                [{"uid": user_id, "norm": norm} for norm, user_id in wanted.items()],
+            )
+        db.session.commit()
+        return rows[-1][0], len(wanted), conflicts
+    except Exception:
+        db.session.rollback()
+        raise
+
+
+def run(batch: int = 5000, dry_run: bool = False) -> dict:
+    pending = db.session.execute(
+        db.select(func.count()).select_from(UserModel).where(UserModel.email_norm.is_(None))
+    ).scalar()
+    print(f"{pending} users without email_norm")
+    summary = {"pending": pending, "filled": 0, "conflicts": []}
+    if dry_run:
+        return summary
+    last_id = 0
+    while True:
+        last_id, filled, conflicts = backfill_batch(last_id, batch)
+        if not filled and not conflicts:
+            break
+        summary["filled"] += filled
+        summary["conflicts"].extend(conflicts)
+        print(f"  up to id {last_id}: {summary['filled']} filled")
+    return summary
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Backfill users.email_norm.")
+    parser.add_argument("--batch", type=int, default=5000, help="rows per write transaction")
+    parser.add_argument("--dry-run", action="store_true", help="only count rows that need it")
+    args = parser.parse_args()
+
+    from main import app  # reuse app & db bindings
+    with app.app_context():
+        s = run(args.batch, dry_run=args.dry_run)
+    if args.dry_run:
+        return
+    for c in s["conflicts"]:
+        print(f"  [CONFLICT] user {c['id']}: '{c['email_norm']}' already used by user {c['taken_by']}")
+    if s["conflicts"]:
+        print(f"❌ {s['filled']} filled, {len(s['conflicts'])} left NULL (case-only duplicates)")
+        sys.exit(1)
+    print(f"✅ {s['filled']} filled")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,289 @@
+# models_merkle.py
+"""
+Merkle anchoring of the audit logs (RFC 6962 / RFC 9162 tree hashing).
+
+Each log (activity_log, admin_activity_log) gets one append-only tree whose
+leaves are the rows' row_hash values in id order. anchor_log() appends every
+row written since the last run and stores the new root in log_anchors.
+
+Only complete subtrees are stored (merkle_nodes, one row per node). A
+complete subtree never changes once all its leaves exist, and any range the
+RFC algorithms need is either one stored node or splits into O(log n) of
+them. Inclusion and consistency proofs therefore cost O(log n) primary-key
+lookups instead of a replay of the chain.
+
+Re-sealing a chain (migrate_chain_digests.py) changes its row hashes; rows
+anchored before that keep their old leaf and no longer match it.
+"""
+import hashlib
+from datetime import datetime
+
+from sqlalchemy import func, insert
+
+from db import db, begin_immediate
+from models_chain import CHAIN_ACTIVITY, CHAIN_ADMIN
+from models_privacy import ActivityLog
+from models_admin import AdminActivityLog
+
+# log type -> model whose rows are the leaves
+LOGS = {
+    CHAIN_ACTIVITY: ActivityLog,
+    CHAIN_ADMIN: AdminActivityLog,
+}
+
+ANCHOR_BATCH = 5000
+
+
+def leaf_hash(row_hash: str | None) -> bytes:
+    return hashlib.sha256(b"\x00" + (bytes.fromhex(row_hash) if row_hash else b"")).digest()
+
+
+def node_hash(left: bytes, right: bytes) -> bytes:
+    return hashlib.sha256(b"\x01" + left + right).digest()
+
+
+def _split(n: int) -> int:
+    """Largest power of two smaller than n (n > 1)."""
+    return 1 << ((n - 1).bit_length() - 1)
+
+
+class MerkleNode(db.Model):
+    """Root of a complete subtree: leaves [idx * 2**level, (idx + 1) * 2**level)."""
+    __tablename__ = "merkle_nodes"
+    log_type = db.Column(db.String(16), primary_key=True)
+    level    = db.Column(db.Integer, primary_key=True, autoincrement=False)
+    idx      = db.Column(db.Integer, primary_key=True, autoincrement=False)
+    hash     = db.Column(db.LargeBinary(32), nullable=False)
+    row_id   = db.Column(db.Integer, nullable=True)   # leaves only
+
+    __table_args__ = (db.Index("ix_merkle_nodes_row", "log_type", "row_id"),)
+
+
+class LogAnchor(db.Model):
+    __tablename__ = "log_anchors"
+    id          = db.Column(db.Integer, primary_key=True)
+    log_type    = db.Column(db.String(16), nullable=False, index=True)
+    tree_size   = db.Column(db.Integer, nullable=False)
+    last_row_id = db.Column(db.Integer, nullable=False)
+    root_hash   = db.Column(db.String(64), nullable=False)
+    created_at  = db.Column(db.DateTime, default=datetime.utcnow, nullable=False)
+
+    __table_args__ = (db.UniqueConstraint("log_type", "tree_size", name="uq_log_anchor_size"),)
+
+    def to_dict(self) -> dict:
+        return {
+            "id": self.id,
+            "log": self.log_type,
+            "tree_size": self.tree_size,
+            "last_row_id": self.last_row_id,
+            "root_hash": self.root_hash,
+            "created_at": self.created_at.isoformat() + "Z",
+        }
+
+
+class _Tree:
+    """Read side of one log's stored tree; node lookups are cached per instance."""
+
+    def __init__(self, log_type: str):
+        self.log_type = log_type
+        self._nodes: dict[tuple[int, int], bytes] = {}
+
+    def node(self, level: int, idx: int) -> bytes:
+        key = (level, idx)
+        if key not in self._nodes:
+            h = db.session.execute(
+                db.select(MerkleNode.hash).where(MerkleNode.log_type == self.log_type,
+                                                 MerkleNode.level == level, MerkleNode.idx == idx)
+            ).scalar()
+            if h is None:
+                raise LookupError(f"{self.log_type} tree: node {key} missing")
+            self._nodes[key] = h
+        return self._nodes[key]
+
+    def mth(self, lo: int, hi: int) -> bytes:
+        """MTH(D[lo:hi])."""
+        n = hi - lo
+        if n & (n - 1) == 0 and lo % n == 0:   # a complete, aligned subtree: stored
+            level = n.bit_length() - 1
+            return self.node(level, lo >> level)
+        k = _split(n)
+        return node_hash(self.mth(lo, lo + k), self.mth(lo + k, hi))
+
+    def path(self, m: int, lo: int, hi: int) -> list[bytes]:
+        """PATH(m, D[lo:hi]), m an absolute leaf index."""
+        if hi - lo == 1:
+            return []
+        k = _split(hi - lo)
+        if m - lo < k:
+            return self.path(m, lo, lo + k) + [self.mth(lo + k, hi)]
+        return self.path(m, lo + k, hi) + [self.mth(lo, lo + k)]
+
+    def subproof(self, m: int, lo: int, hi: int, complete: bool) -> list[bytes]:
+        """SUBPROOF(m, D[lo:hi], b), m counted from lo."""
+        n = hi - lo
+        if m == n:
+            return [] if complete else [self.mth(lo, hi)]
+        k = _split(n)
+        if m <= k:
+            return self.subproof(m, lo, lo + k, complete) + [self.mth(lo + k, hi)]
+        return self.subproof(m - k, lo + k, hi, False) + [self.mth(lo, lo + k)]
+
+
+# ---------- Anchoring ----------
+def _frontier(tree: _Tree, size: int) -> list[tuple[int, bytes]]:
+    """Complete subtrees covering [0, size), largest first, as (level, hash)."""
+    out, offset = [], 0
+    for level in range(size.bit_length() - 1, -1, -1):
+        if size & (1 << level):
+            out.append((level, tree.node(level, offset >> level)))
+            offset += 1 << level
+    return out
+
+
+def anchor_log(log_type: str) -> LogAnchor | None:
+    """
+    Append every row written since the last anchor to the log's tree and
+    store the new root. Runs under the write lock (BEGIN IMMEDIATE), so two
+    anchorers can't interleave. None if there was nothing new.
+    """
+    model = LOGS[log_type]
+    begin_immediate(db.session)
+    try:
+        size, last_row_id = db.session.execute(
+            db.select(func.count(), func.max(MerkleNode.row_id))
+            .where(MerkleNode.log_type == log_type, MerkleNode.level == 0)
+        ).one()
+        last_row_id = start_row_id = last_row_id or 0
+        stack = _frontier(_Tree(log_type), size)
+
+        rows = db.session.execute(
+            db.select(model.id, model.row_hash).where(model.id > last_row_id).order_by(model.id)
+            .execution_options(yield_per=ANCHOR_BATCH)
+        )
+        pending = []
+        for row_id, row_hash in rows:
+            h = leaf_hash(row_hash)
+            pending.append({"log_type": log_type, "level": 0, "idx": size, "hash": h, "row_id": row_id})
+            stack.append((0, h))
+            size += 1
+            last_row_id = row_id
+            # two equal-height subtrees on top merge into their (now complete) parent
+            while len(stack) > 1 and stack[-1][0] == stack[-2][0]:
+                (level, right), (_, left) = stack.pop(), stack.pop()
+                parent = node_hash(left, right)
+                pending.append({"log_type": log_type, "level": level + 1,
+                                "idx": (size >> (level + 1)) - 1, "hash": parent, "row_id": None})
+                stack.append((level + 1, parent))
+            if len(pending) >= ANCHOR_BATCH:
+                db.session.execute(insert(MerkleNode.__table__), pending)
+                pending = []
+        if pending:
+            db.session.execute(insert(MerkleNode.__table__), pending)
+
+        if last_row_id == start_row_id:   # nothing new
+            db.session.rollback()
+            return None
+
+        root = stack[-1][1]
+        for _, h in reversed(stack[:-1]):
+            root = node_hash(h, root)
+        anchor = LogAnchor(log_type=log_type, tree_size=size, last_row_id=last_row_id, root_hash=root.hex())
+        db.session.add(anchor)
+        db.session.commit()
+        return anchor
+    except Exception:
+        db.session.rollback()
+        raise
+
+
+def get_anchor(log_type: str, anchor_id: int | None = None) -> LogAnchor | None:
+    """The given anchor (if it belongs to log_type), else the latest one."""
+    q = LogAnchor.query.filter_by(log_type=log_type)
+    if anchor_id is not None:
+        return q.filter_by(id=anchor_id).first()
+    return q.order_by(LogAnchor.tree_size.desc()).first()
+
+
+# ---------- Proofs ----------
+def inclusion_proof(log_type: str, row_id: int, anchor: LogAnchor) -> dict | None:
+    """Audit path for one row against an anchor; None if the anchor doesn't cover the row."""
+    leaf = db.session.execute(
+        db.select(MerkleNode.idx, MerkleNode.hash)
+        .where(MerkleNode.log_type == log_type, MerkleNode.level == 0, MerkleNode.row_id == row_id)
+    ).first()
+    if leaf is None or leaf.idx >= anchor.tree_size:
+        return None
+    path = _Tree(log_type).path(leaf.idx, 0, anchor.tree_size)
+    return {
+        "log": log_type,
+        "row_id": row_id,
+        "leaf_index": leaf.idx,
+        "leaf_hash": leaf.hash.hex(),
+        "tree_size": anchor.tree_size,
+        "root_hash": anchor.root_hash,
+        "anchor_id": anchor.id,
+        "audit_path": [h.hex() for h in path],
+    }
+
+
+def consistency_proof(log_type: str, first: LogAnchor, second: LogAnchor) -> dict:
+    """Proof that the tree at `second` extends the tree at `first` (first.tree_size <= second's)."""
+    if first.tree_size > second.tree_size:
+        raise ValueError("first anchor must not be newer than second")
+    proof = []
+    if 0 < first.tree_size < second.tree_size:
+        proof = _Tree(log_type).subproof(first.tree_size, 0, second.tree_size, True)
+    return {
+        "log": log_type,
+        "first": first.to_dict(),
+        "second": second.to_dict(),
+        "proof": [h.hex() for h in proof],
+    }
+
+
+# ---------- Verification (what a client does with the proofs; RFC 9162 2.1.3.2 / 2.1.4.2) ----------
+def verify_inclusion(leaf: bytes, index: int, size: int, path: list[bytes], root: bytes) -> bool:
+    if index >= size:
+        return False
+    fn, sn, r = index, size - 1, leaf
+    for p in path:
+        if sn == 0:
+            return False
+        if fn & 1 or fn == sn:
+            r = node_hash(p, r)
+            while not fn & 1 and fn != 0:
+                fn >>= 1
+                sn >>= 1
+        else:
+            r = node_hash(r, p)
+        fn >>= 1
+        sn >>= 1
+    return sn == 0 and r == root
+
+
+def verify_consistency(size1: int, size2: int, proof: list[bytes], root1: bytes, root2: bytes) -> bool:
+    if size1 == size2:
+        return not proof and root1 == root2
+    if size1 == 0 or size1 > size2 or not proof:
+        return False
+    if size1 & (size1 - 1) == 0:
+        proof = [root1] + proof
+    fn, sn = size1 - 1, size2 - 1
+    while fn & 1:
+        fn >>= 1
+        sn >>= 1
+    fr = sr = proof[0]
+    for c in proof[1:]:
+        if sn == 0:
+            return False
+        if fn & 1 or fn == sn:
+            fr = node_hash(c, fr)
+            sr = node_hash(c, sr)
+            while not fn & 1 and fn != 0:
+                fn >>= 1
+                sn >>= 1
+        else:
+            sr = node_hash(sr, c)
+        fn >>= 1
+        sn >>= 1
+    return sn == 0 and fr == root1 and sr == root2
@@ -0,0 +1,154 @@
+# passwords.py
+"""
+bcrypt off the request threads, with admission control.
+
+Each bcrypt call costs tens of milliseconds of CPU. Run inline, a burst of
+logins occupies every gunicorn thread (2 workers x 4 gthreads) and cheap
+endpoints like /me queue behind them. Here hashing runs on a small pool
+per process (bcrypt releases the GIL), and at most BCRYPT_POOL_SIZE +
+BCRYPT_QUEUE_MAX jobs may be admitted at once. Past that, callers get
+PasswordHasherBusy right away, which the app answers with 503 and
+Retry-After, so the other request threads stay free. Keep the bound below
+the gunicorn thread count. BCRYPT_POOL_SIZE=0 runs bcrypt inline, as
+before.
+
+Background jobs (run_later) never take a request's slot: they have one
+thread of their own and at most BCRYPT_DEFERRED_MAX jobs admitted, past
+which they are dropped (0 turns them off).
+
+New hashes use BCRYPT_ROUNDS (see calibrate_bcrypt.py for picking it);
+needs_rehash() tells login to upgrade a hash made with a lower cost.
+"""
+import os
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+import bcrypt
+
+POOL_SIZE = int(os.getenv("BCRYPT_POOL_SIZE", "2"))
+QUEUE_MAX = int(os.getenv("BCRYPT_QUEUE_MAX", "1"))
+RETRY_AFTER_SECONDS = int(os.getenv("BCRYPT_RETRY_AFTER_SECONDS", "1"))
+BCRYPT_ROUNDS = int(os.getenv("BCRYPT_ROUNDS", "12"))
+DEFERRED_MAX = int(os.getenv("BCRYPT_DEFERRED_MAX", "2"))
+
+
+class PasswordHasherBusy(RuntimeError):
+    """Every bcrypt slot is taken; retry after retry_after seconds."""
+
+    def __init__(self, retry_after: int = RETRY_AFTER_SECONDS):
+        super().__init__("password hashing is saturated")
+        self.retry_after = retry_after
+
+
+_pool = None
+_slots = None
+_pool_pid = None
+_pool_lock = threading.Lock()
+rejected = 0   # admissions refused in this process
+
+_deferred = None
+_deferred_slots = None
+_deferred_pid = None
+dropped = 0    # run_later jobs dropped in this process
+
+
+def _get_pool() -> tuple[ThreadPoolExecutor, threading.BoundedSemaphore]:
+    """One pool per process (gunicorn forks after preload, threads don't survive)."""
+    global _pool, _slots, _pool_pid
+    pid = os.getpid()
+    if _pool is None or _pool_pid != pid:
+        with _pool_lock:
+            if _pool is None or _pool_pid != pid:
+                _pool = ThreadPoolExecutor(max_workers=POOL_SIZE, thread_name_prefix="bcrypt")
+                _slots = threading.BoundedSemaphore(POOL_SIZE + QUEUE_MAX)
+                _pool_pid = pid
+    return _pool, _slots
+
+
+def _get_deferred() -> tuple[ThreadPoolExecutor, threading.BoundedSemaphore]:
+    """The run_later pool: one thread, DEFERRED_MAX admissions, per process."""
+    global _deferred, _deferred_slots, _deferred_pid
+    pid = os.getpid()
+    if _deferred is None or _deferred_pid != pid:
+        with _pool_lock:
+            if _deferred is None or _deferred_pid != pid:
+                _deferred = ThreadPoolExecutor(max_workers=1, thread_name_prefix="bcrypt-later")
+                _deferred_slots = threading.BoundedSemaphore(DEFERRED_MAX)
+                _deferred_pid = pid
+    return _deferred, _deferred_slots
+
+
+def _submit(fn, args, pool, slots):
+    """fn(*args) on pool, or None if none of its slots is free."""
+    if not slots.acquire(blocking=False):
+        return None
+    try:
+        future = pool.submit(fn, *args)
+    except BaseException:
+        slots.release()
+        raise
+    future.add_done_callback(lambda _: slots.release())
+    return future
+
+
+def run(fn, *args):
+    """
+    Run fn(*args) on the bcrypt pool and wait for its result. One job is one
+    admission, so a handler that needs several bcrypt calls should make
+    them in a single fn. Raises PasswordHasherBusy if no slot is free.
+    """
+    global rejected
+    if POOL_SIZE <= 0:
+        return fn(*args)
+    future = _submit(fn, args, *_get_pool())
+    if future is None:
+        rejected += 1
+        raise PasswordHasherBusy()
+    return future.result()
+
+
+def run_later(fn, *args) -> bool:
+    """
+    Start fn(*args) on the deferred pool without waiting for it (work off
+    the response path). Returns False, dropping the job, if DEFERRED_MAX
+    jobs are already admitted.
+    """
+    global dropped
+    if DEFERRED_MAX <= 0 or _submit(fn, args, *_get_deferred()) is None:
+        dropped += 1
+        return False
+    return True
+
+
+def gensalt() -> bytes:
+    return bcrypt.gensalt(rounds=BCRYPT_ROUNDS)
+
+
+def hash_cost(hashed: bytes) -> int | None:
+    """The cost factor of a $2a$/$2b$/$2y$ hash, None if it isn't one."""
+    parts = hashed.split(b"$")
+    if len(parts) < 4 or not parts[2].isdigit():
+        return None
+    return int(parts[2])
+
+
+def needs_rehash(hashed: bytes) -> bool:
+    """True below BCRYPT_ROUNDS; a hash at a higher cost is kept (never downgrade)."""
+    cost = hash_cost(hashed)
+    return cost is None or cost < BCRYPT_ROUNDS
+
+
+def _hash(password: str) -> bytes:
+    return bcrypt.hashpw(password.encode("utf-8"), gensalt())
+
+
+def _check(password: str, hashed: bytes) -> bool:
+    return bcrypt.checkpw(password.encode("utf-8"), hashed)
+
+
+def hash_password(password: str) -> bytes:
+    return run(_hash, password)
+
+
+def check_password(password: str, hashed: bytes) -> bool:
+    return run(_check, password, hashed)
@@ -9,8 +9,11 @@ import json
 from db import db
 from auth import require_auth
 from models_privacy import (
-    UserSettings, ConsentLog, ActivityLog, append_activity, UserProfile
+    UserSettings, ConsentLog, ActivityLog, stage_activity, UserProfile,
+    decrypt_activity_rows,
 )
+from models_chain import CHAIN_ACTIVITY
+from models_merkle import get_anchor, inclusion_proof, consistency_proof
 
 privacy_bp = Blueprint('privacy', __name__)
 
@@ -113,15 +116,15 @@ def update_privacy_settings(user):
                 new_val = _to_bool(data[key])
                 old_val = getattr(s, key)
                 if old_val != new_val:
-                    setattr(s, key, new_val)
                     changed[key] = {"old": old_val, "new": new_val}
 
         if not changed:
             return jsonify({"message": "No changes"}), 200
 
-        db.session.commit()
-
-        append_activity(user.id, "PRIVACY_UPDATED", {"changed": changed})
+        # settings, consent rows and the audit event commit together
+        stage_activity(user.id, "PRIVACY_UPDATED", {"changed": changed})
+        for k, v in changed.items():
+            setattr(s, k, v["new"])
         for k in changed.keys():
             db.session.add(ConsentLog(user_id=user.id, item=k, version=None, action="updated"))
         db.session.commit()
@@ -164,10 +167,10 @@ def record_consent(user):
         return jsonify({"message": "Invalid consent payload"}), 400
 
     try:
+        stage_activity(user.id, "CONSENT_" + action.upper(), {"item": item, "version": version})
         row = ConsentLog(user_id=user.id, item=item, version=version, action=action)
         db.session.add(row)
         db.session.commit()
-        append_activity(user.id, "CONSENT_" + action.upper(), {"item": item, "version": version})
         return jsonify({"message": "Consent recorded"}), 201
     except Exception as e:
         current_app.logger.exception("Failed to record consent")
@@ -185,6 +188,7 @@ def my_activity(user):
     limit = max(1, min(limit, 200))
 
     rows = ActivityLog.query.filter_by(user_id=user.id).order_by(ActivityLog.id.desc()).limit(limit).all()
+    decrypt_activity_rows(rows)
     return jsonify([
         {
             "id": r.id,
@@ -195,3 +199,44 @@ def my_activity(user):
             "row_hash": r.row_hash
         } for r in rows
     ])
+
+# ---------- Merkle proofs (see models_merkle) ----------
+@privacy_bp.route('/activity/<int:row_id>/proof', methods=['GET'])
+@cross_origin(origins=ALLOWED_ORIGINS, supports_credentials=True)
+@require_auth
+def activity_proof(user, row_id):
+    r = ActivityLog.query.filter_by(id=row_id, user_id=user.id).first()
+    if not r:
+        return jsonify({"message": "Activity not found"}), 404
+
+    anchor = get_anchor(CHAIN_ACTIVITY, request.args.get('anchor_id', type=int))
+    proof = inclusion_proof(CHAIN_ACTIVITY, r.id, anchor) if anchor else None
+    if not proof:
+        return jsonify({"message": "Not anchored yet"}), 409
+
+    return jsonify({
+        "row": {
+            "id": r.id,
+            "event": r.event,
+            "meta": r.meta,
+            "ts": r.ts.isoformat() + "Z",
+            "prev_hash": r.prev_hash,
+            "row_hash": r.row_hash,
+            "payload_digest": r.payload_digest,
+            "hash_v": r.hash_v,
+        },
+        "proof": proof,
+        "anchor": anchor.to_dict(),
+    })
+
+@privacy_bp.route('/activity/anchors/consistency', methods=['GET'])
+@cross_origin(origins=ALLOWED_ORIGINS, supports_credentials=True)
+@require_auth
+def activity_anchor_consistency(user):
+    first = get_anchor(CHAIN_ACTIVITY, request.args.get('from', type=int))
+    second = get_anchor(CHAIN_ACTIVITY, request.args.get('to', type=int))
+    if not first or not second:
+        return jsonify({"message": "Anchor not found"}), 404
+    if first.tree_size > second.tree_size:
+        return jsonify({"message": "'from' must not be newer than 'to'"}), 400
+    return jsonify(consistency_proof(CHAIN_ACTIVITY, first, second))
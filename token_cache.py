@@ -0,0 +1,67 @@
+# token_cache.py
+"""
+Verified access tokens, so require_auth doesn't re-check the HS256
+signature of the same token on every request (a token lives JWT_EXP_MIN
+minutes and the frontend presents it for each call).
+
+A bounded LRU maps token -> (claims, exp). Only tokens that jwt.decode
+accepted are stored, and an entry is never served at or after its exp;
+from then on the token goes back through jwt.decode, which rejects it.
+The token itself is the dict key: hashing it is what the lookup does
+anyway, and a separate digest would add a hash to every hit.
+"""
+import os
+import threading
+import time
+from collections import OrderedDict
+
+import jwt
+
+JWT_CACHE_SIZE = int(os.getenv("JWT_CACHE_SIZE", "4096"))
+
+
+class VerifiedTokenCache:
+    def __init__(self, size: int):
+        self.size = size
+        self.hits = 0
+        self.misses = 0
+        self._secret = None
+        self._items: OrderedDict[str, tuple[dict, float]] = OrderedDict()
+        self._lock = threading.Lock()
+
+    def decode(self, token: str, secret: str) -> dict:
+        """jwt.decode(token, secret, HS256), served from the cache when possible; raises the same errors."""
+        hit = self._items.get(token)
+        if hit is not None:
+            if hit[1] > time.time() and secret == self._secret:
+                self.hits += 1
+                try:
+                    self._items.move_to_end(token)
+                except KeyError:   # evicted by another thread meanwhile
+                    pass
+                return hit[0]
+            self._items.pop(token, None)   # expired, or checked against another key
+
+        self.misses += 1
+        claims = jwt.decode(token, secret, algorithms=["HS256"])
+        exp = claims.get("exp")
+        if self.size > 0 and isinstance(exp, (int, float)):   # no exp: never cache
+            with self._lock:
+                if secret != self._secret:   # new signing key: old entries are void
+                    self._items.clear()
+                    self._secret = secret
+                self._items[token] = (claims, exp)
+                self._items.move_to_end(token)
+                while len(self._items) > self.size:
+                    self._items.popitem(last=False)
+        return claims
+
+    def clear(self):
+        with self._lock:
+            self._items.clear()
+
+    def stats(self) -> dict:
+        return {"size": len(self._items), "hits": self.hits, "misses": self.misses}
+
+
+verified_tokens = VerifiedTokenCache(JWT_CACHE_SIZE)